@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for sharded_cache.py.
+
+These are not run by runtests.py. Usage:
+  python tests/common/sharded_cache_benchmark.py
+"""
+
+from tests.common import testing
+
+import cPickle as pickle
+import time
+from google.appengine.api import memcache
+from titan.common.lib.google.apputils import app
+from titan.common.lib.google.apputils import basetest
+from titan.common import sharded_cache
+
+PAYLOAD_SIZES_MB = (1, 2, 5, 10, 20, 30)
+NUM_ROUNDS = 3
+
+def _stitch_with_format(shards):
+  """The original shard stitching, for comparison."""
+  value = '%s' * len(shards)
+  return pickle.loads(value % tuple(shards))
+
+class ShardedCacheBenchmark(testing.BaseTestCase):
+
+  def _time(self, func, *args):
+    timings = []
+    for _ in range(NUM_ROUNDS):
+      start = time.time()
+      result = func(*args)
+      timings.append(time.time() - start)
+    return min(timings), result
+
+  def testGetAndSet(self):
+    print
+    for size_mb in PAYLOAD_SIZES_MB:
+      payload = 'a' * (size_mb * memcache.MAX_VALUE_SIZE)
+
+      set_seconds, _ = self._time(sharded_cache.Set, 'bench', payload)
+      get_seconds, value = self._time(sharded_cache.Get, 'bench')
+      self.assertEqual(payload, value)
+
+      # Stitching only, without the memcache stub overhead.
+      pickled = pickle.dumps(payload)
+      shards = [pickled[i:i + memcache.MAX_VALUE_SIZE]
+                for i in range(0, len(pickled), memcache.MAX_VALUE_SIZE)]
+      format_seconds, _ = self._time(_stitch_with_format, shards)
+      shards = [payload[i:i + memcache.MAX_VALUE_SIZE]
+                for i in range(0, len(payload), memcache.MAX_VALUE_SIZE)]
+      join_seconds, _ = self._time(''.join, shards)
+
+      print ('%2d MB: Set %.3fs, Get %.3fs, stitch with format+unpickle '
+             '%.4fs, stitch with join %.4fs.' % (
+                 size_mb, set_seconds, get_seconds, format_seconds,
+                 join_seconds))
+      sharded_cache.Delete('bench')
+
+def main(unused_argv):
+  basetest.main()
+
+if __name__ == '__main__':
+  app.run()
@@ -26,7 +26,7 @@ MAX_VALUE_SIZE = memcache.MAX_VALUE_SIZE
 # 1KB -- Should be packed with the shard_map entry and use 0 real shards.
 SMALL_CONTENT = 'a' * 1000
 
-# 2MB -- Will be slightly >2MB when pickled, so should be in 3 shards.
+# 2MB -- Stored unpickled, so should be in exactly 2 shards.
 LARGE_CONTENT = 'b' * MAX_VALUE_SIZE * 2
 LARGE_CONTENT_PICKLED = pickle.dumps(LARGE_CONTENT)
 
@@ -43,6 +43,11 @@ class ShardedCacheTest(basetest.TestCase):
   def tearDown(self):
     self.testbed.deactivate()
 
+  def _GetShardKeys(self, key):
+    memcache_key = sharded_cache.MEMCACHE_PREFIX + key
+    shard_map = memcache.get(memcache_key)
+    return sharded_cache._GetShardKeys(memcache_key, shard_map)
+
   def testGet(self):
     sharded_cache.Set('foo', SMALL_CONTENT)
     data = sharded_cache.Get('foo')
@@ -55,6 +60,12 @@ class ShardedCacheTest(basetest.TestCase):
     self.assertEqual(len(LARGE_CONTENT), len(data))
     self.assertEqual(LARGE_CONTENT, data)
 
+    # Non-string values are pickled.
+    sharded_cache.Set('foo', [LARGE_CONTENT, u'\xb0'])
+    self.assertEqual([LARGE_CONTENT, u'\xb0'], sharded_cache.Get('foo'))
+    sharded_cache.Set('foo', {'a': 1})
+    self.assertEqual({'a': 1}, sharded_cache.Get('foo'))
+
     # Shard map was evicted.
     sharded_cache.Set('foo', LARGE_CONTENT)
     memcache.delete(sharded_cache.MEMCACHE_PREFIX + 'foo')
@@ -62,59 +73,71 @@ class ShardedCacheTest(basetest.TestCase):
 
     # 1 content shard was evicted.
     sharded_cache.Set('foo', LARGE_CONTENT)
-    memcache.delete(sharded_cache.MEMCACHE_PREFIX + 'foo1')
+    memcache_keys = self._GetShardKeys('foo')
+    memcache.delete(memcache_keys[1])
     self.assertEqual(None, sharded_cache.Get('foo'))
     # The shard map and unevicted shards should be deleted.
-    cache_keys = ['foo', 'foo0', 'foo1', 'foo2', 'foo3']
-    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
+    memcache_keys.append(sharded_cache.MEMCACHE_PREFIX + 'foo')
     content = memcache.get_multi(memcache_keys)
     self.assertFalse(any(content))
 
     # All content shards were evicted.
     sharded_cache.Set('foo', LARGE_CONTENT)
-    cache_keys = ['foo0', 'foo1', 'foo2']
-    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
-    memcache.delete_multi(memcache_keys)
+    memcache.delete_multi(self._GetShardKeys('foo'))
     self.assertEqual(None, sharded_cache.Get('foo'))
 
+    # A shard map from a racing Set() never reads shards of another generation.
+    sharded_cache.Set('foo', LARGE_CONTENT)
+    shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
+    sharded_cache.Set('foo', 'c' * MAX_VALUE_SIZE * 3)
+    memcache.set(sharded_cache.MEMCACHE_PREFIX + 'foo', shard_map)
+    self.assertEqual(LARGE_CONTENT, sharded_cache.Get('foo'))
+    memcache.delete_multi(self._GetShardKeys('foo')[:1])
+    self.assertEqual(None, sharded_cache.Get('foo'))
+
+    # Backwards-compatibility with shard maps without generations.
+    memcache_key = sharded_cache.MEMCACHE_PREFIX + 'foo'
+    memcache.set_multi({
+        memcache_key: {'num_shards': 3},
+        memcache_key + '0': LARGE_CONTENT_PICKLED[:MAX_VALUE_SIZE],
+        memcache_key + '1': LARGE_CONTENT_PICKLED[
+            MAX_VALUE_SIZE:MAX_VALUE_SIZE * 2],
+        memcache_key + '2': LARGE_CONTENT_PICKLED[MAX_VALUE_SIZE * 2:],
+    })
+    self.assertEqual(LARGE_CONTENT, sharded_cache.Get('foo'))
+
   def testSet(self):
     # Set object smaller than 1MB.
     sharded_cache.Set('foo', SMALL_CONTENT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
     self.assertEqual(0, shard_map['num_shards'])
-    self.assertEqual(SMALL_CONTENT, pickle.loads(shard_map['content']))
-    first_shard = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo0')
-    self.assertEqual(None, first_shard)
+    self.assertEqual(SMALL_CONTENT, shard_map['content'])
+    self.assertEqual([], self._GetShardKeys('foo'))
 
     # Set object larger than 1MB.
     sharded_cache.Set('foo', LARGE_CONTENT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
-    cache_keys = ['foo0', 'foo1', 'foo2']
-    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
-    content = memcache.get_multi(memcache_keys)
-    self.assertEqual(3, shard_map['num_shards'])
-    keys = ['%sfoo%d' % (sharded_cache.MEMCACHE_PREFIX, i) for i in xrange(3)]
+    self.assertEqual(2, shard_map['num_shards'])
+    self.assertFalse(shard_map['pickled'])
+    keys = self._GetShardKeys('foo')
+    content = memcache.get_multi(keys)
     expected_content_shards = {
         # 0 to 1MB.
-        keys[0]: LARGE_CONTENT_PICKLED[0:MAX_VALUE_SIZE],
+        keys[0]: LARGE_CONTENT[0:MAX_VALUE_SIZE],
         # 1MB to 2MB.
-        keys[1]: LARGE_CONTENT_PICKLED[MAX_VALUE_SIZE:MAX_VALUE_SIZE * 2],
-        # 2MB to end.
-        keys[2]: LARGE_CONTENT_PICKLED[MAX_VALUE_SIZE * 2:],
+        keys[1]: LARGE_CONTENT[MAX_VALUE_SIZE:],
     }
     self.assertDictEqual(expected_content_shards, content)
-    next_shard = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo3')
-    self.assertEqual(None, next_shard)
+
+    # Each Set uses a new generation of content shards.
+    sharded_cache.Set('foo', LARGE_CONTENT)
+    self.assertNotEqual(keys, self._GetShardKeys('foo'))
 
     # Set object larger than 32MB, should die internally and clear cache.
     sharded_cache.Set('foo', LARGEST_CONTENT)
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
-    cache_keys = ['foo0', 'foo1', 'foo2']
-    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
-    content = memcache.get_multi(memcache_keys)
     self.assertEqual(None, shard_map)
     self.assertEqual(None, sharded_cache.Get('foo'))
-    self.assertDictEqual({}, content)
 
   def testDelete(self):
     # Delete small content with no sharding.
@@ -125,15 +148,48 @@ class ShardedCacheTest(basetest.TestCase):
 
     # Delete content stored in multiple shards.
     sharded_cache.Set('foo', LARGE_CONTENT)
+    memcache_keys = self._GetShardKeys('foo')
     sharded_cache.Delete('foo')
     shard_map = memcache.get(sharded_cache.MEMCACHE_PREFIX + 'foo')
-    cache_keys = ['foo0', 'foo1', 'foo2']
-    memcache_keys = [sharded_cache.MEMCACHE_PREFIX + key for key in cache_keys]
     content = memcache.get_multi(memcache_keys)
     self.assertEqual(None, shard_map)
     self.assertEqual(None, sharded_cache.Get('foo'))
     self.assertDictEqual({}, content)
 
+  def testMultiMethods(self):
+    # SetMulti() and GetMulti().
+    sharded_cache.SetMulti({'foo': SMALL_CONTENT, 'bar': LARGE_CONTENT})
+    self.assertEqual(
+        {'foo': SMALL_CONTENT, 'bar': LARGE_CONTENT},
+        sharded_cache.GetMulti(['foo', 'bar', 'fake']))
+    self.assertEqual({}, sharded_cache.GetMulti([]))
+
+    # Evicted content shards are cleaned up.
+    memcache_keys = self._GetShardKeys('bar')
+    memcache.delete(memcache_keys[1])
+    self.assertEqual(
+        {'foo': SMALL_CONTENT}, sharded_cache.GetMulti(['foo', 'bar']))
+    self.assertIsNone(memcache.get(sharded_cache.MEMCACHE_PREFIX + 'bar'))
+    self.assertIsNone(memcache.get(memcache_keys[0]))
+
+    # Values too large for a single set_multi are set in separate batches.
+    self.assertTrue(sharded_cache.SetMulti({
+        'foo': LARGE_CONTENT * 8,
+        'bar': LARGE_CONTENT * 8,
+    }))
+    self.assertEqual(
+        ['bar', 'foo'], sorted(sharded_cache.GetMulti(['foo', 'bar'])))
+
+    # DeleteMulti().
+    sharded_cache.SetMulti({'foo': SMALL_CONTENT, 'bar': LARGE_CONTENT})
+    memcache_keys = self._GetShardKeys('bar')
+    memcache_keys += [
+        sharded_cache.MEMCACHE_PREFIX + key for key in ('foo', 'bar')]
+    self.assertTrue(sharded_cache.DeleteMulti(['foo', 'bar', 'fake']))
+    self.assertEqual({}, sharded_cache.GetMulti(['foo', 'bar']))
+    self.assertEqual({}, memcache.get_multi(memcache_keys))
+    self.assertTrue(sharded_cache.DeleteMulti(['foo']))
+
   def testMaxValueSize(self):
     # If memcache max value size ever changes, I want to know.
     self.assertEqual(1000000, MAX_VALUE_SIZE)
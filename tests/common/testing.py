@@ -22,6 +22,7 @@ import mox
 from mox import stubout
 from google.appengine.ext import testbed
 from titan.files import dirs
+from titan.files.mixins import versions
 
 class MockableTestCase(common_basetest.AppEngineTestCase):
   """Base test case supporting stubs and mox."""
@@ -57,6 +58,14 @@ class BaseTestCase(MockableTestCase):
     # Make this buffer negative so dir tasks are available instantly for lease.
     self.stubs.SmartSet(dirs, 'TASKQUEUE_LEASE_ETA_BUFFER', -86400)
 
+    # Don't carry over cached dirs and manifests created by other tests.
+    dirs._dir_cache.clear()
+    versions._manifest_cache.clear()
+    versions._file_pointer_cache.clear()
+    versions._changeset_num_allocator.clear()
+    # Allocate changeset numbers one at a time, so tests can rely on them.
+    self.stubs.SmartSet(versions, 'CHANGESET_NUM_BLOCK_SIZE', 1)
+
   def InitTestbed(self):  # Method override, must be named non-PEP8 style.
     # Setup and activate the testbed.
     self.testbed = testbed.Testbed()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for dirs.py.
+
+These are not run by runtests.py. Usage:
+  python tests/files/dirs_benchmark.py
+"""
+
+from tests.common import testing
+
+import collections
+import time
+from google.appengine.api import apiproxy_stub_map
+from titan.common.lib.google.apputils import app
+from titan.common.lib.google.apputils import basetest
+from titan.files import dirs
+from titan.files import files
+
+NUM_FILES = 1000
+
+class DirExistenceCacheBenchmark(testing.BaseTestCase):
+
+  def setUp(self):
+    super(DirExistenceCacheBenchmark, self).setUp()
+    files.register_file_mixins([dirs.DirManagerMixin])
+    self.rpc_counts = collections.Counter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_counter', self._count_rpc)
+
+  def tearDown(self):
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+    files.unregister_file_factory()
+    dirs._dir_cache.clear()
+    super(DirExistenceCacheBenchmark, self).tearDown()
+
+  def _count_rpc(self, service, call, unused_request, unused_response):
+    self.rpc_counts['%s.%s' % (service, call)] += 1
+
+  def _time_writes(self, root_path):
+    # Create the tree first, so that only writes into existing dirs are timed.
+    files.File('%s/a/b/c/d/first' % root_path).write('')
+    self.rpc_counts.clear()
+    start = time.time()
+    for i in range(NUM_FILES):
+      files.File('%s/a/b/c/d/file%d' % (root_path, i)).write('')
+    seconds = time.time() - start
+    return seconds, dict(self.rpc_counts)
+
+  def testWritesIntoExistingTree(self):
+    # The original behavior: every write looks up all of its ancestor dirs.
+    self.stubs.Set(
+        dirs._dir_cache, 'get_available', lambda *args, **kwargs: set())
+    uncached_seconds, uncached_rpcs = self._time_writes('/uncached')
+    self.stubs.UnsetAll()
+    cached_seconds, cached_rpcs = self._time_writes('/cached')
+
+    print '\n%d writes into an existing tree:' % NUM_FILES
+    for name in sorted(set(uncached_rpcs) | set(cached_rpcs)):
+      print '  %-28s uncached %5d, cached %5d' % (
+          name, uncached_rpcs.get(name, 0), cached_rpcs.get(name, 0))
+    print ('  Total RPCs: uncached %d, cached %d. Time: uncached %.3fs, '
+           'cached %.3fs, %.1fx speedup.' % (
+               sum(uncached_rpcs.values()), sum(cached_rpcs.values()),
+               uncached_seconds, cached_seconds,
+               uncached_seconds / cached_seconds))
+
+def main(unused_argv):
+  basetest.main()
+
+if __name__ == '__main__':
+  app.run()
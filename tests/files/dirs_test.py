@@ -19,8 +19,10 @@ from tests.common import testing
 
 import datetime
 import time
+from google.appengine.ext import ndb
 from titan.common.lib.google.apputils import basetest
 from titan import files
+from titan import tasks
 from titan.files import dirs
 
 PATH_WRITE_ACTION = dirs.ModifiedPath.WRITE
@@ -30,6 +32,8 @@ class DirManagerTest(testing.BaseTestCase):
 
   def tearDown(self):
     files.unregister_file_factory()
+    files.unregister_file_counter()
+    dirs._dir_cache.clear()
     super(DirManagerTest, self).tearDown()
 
   def testEndToEnd(self):
@@ -83,6 +87,313 @@ class DirManagerTest(testing.BaseTestCase):
     self.assertEqual('b', titan_dir.name)
     self.assertEqual('/a/b', titan_dir.path)
 
+  def testWriteMulti(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    files.Files.write_multi({
+        '/a/b/foo': '',
+        '/a/b/bar': '',
+        '/a/d/foo': '',
+        '/e/foo': '',
+    })
+    self.assertEqual(dirs.Dirs(['/a', '/e']), dirs.Dirs.list('/'))
+    self.assertEqual(dirs.Dirs(['/a/b', '/a/d']), dirs.Dirs.list('/a/'))
+
+  def testChildCounts(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    files.register_file_counter(dirs.count_files)
+    files.File('/a/b/foo').write('')
+    files.File('/a/b/bar').write('')
+    files.File('/a/c/foo').write('')
+    # Overwrites don't change the counts.
+    files.File('/a/b/foo').write('foo')
+    files.Files.write_multi({'/a/b/baz': '', '/a/b/foo': 'bar'})
+    expected = {'/a': (0, 2), '/a/b': (3, 0), '/a/c': (1, 0)}
+    self.assertEqual(
+        expected, dirs._get_dir_counts(['/a', '/a/b', '/a/c']))
+    self.assertEqual(3, files.Files.count('/a/b/'))
+    self.assertEqual(0, files.Files.count('/a'))
+
+    # Counted dirs which still have children are skipped without queries.
+    def _Fail(*args, **kwargs):
+      self.fail('Counted dirs should not be listed.')
+    self.stubs.Set(dirs.DirService, '_get_dir_children_async', _Fail)
+    files.Files(['/a/b/foo', '/a/b/bar']).delete()
+    self.assertTrue(dirs.Dir('/a/b').exists)
+    self.stubs.UnsetAll()
+    # Deletes of non-existent files are not counted.
+    files.Files(['/a/b/fake']).delete()
+    self.assertEqual(1, dirs.count_files('/a/b'))
+    files.File('/a/b/baz').delete()
+    self.assertFalse(dirs.Dir('/a/b').exists)
+    self.assertTrue(dirs.Dir('/a').exists)
+    expected = {'/a': (0, 1), '/a/b': (0, 0)}
+    self.assertEqual(expected, dirs._get_dir_counts(['/a', '/a/b']))
+    files.File('/a/c/foo').delete()
+    self.assertEqual(dirs.Dirs([]), dirs.Dirs.list('/'))
+
+    # Overwriting copies don't change the counts.
+    files.File('/d/foo').write('foo')
+    files.File('/e/foo').write('')
+    files.Files(['/d/foo']).copy_to('/e', strip_prefix='/d')
+    self.assertEqual(1, dirs.count_files('/e'))
+
+    # Counters which have drifted too low don't delete dirs with files, such
+    # as after a delete task was delivered twice.
+    files.File('/e/bar').write('')
+    dirs._offset_dir_counts_async('/e', num_files=-1).get_result()
+    files.File('/e/foo').delete()
+    self.assertEqual(0, dirs.count_files('/e'))
+    self.assertTrue(dirs.Dir('/e').exists)
+
+    # Dirs without counters are checked with queries and counted by queries.
+    files.File('/x/y/foo', _no_mixins=True).write('')
+    files.File('/x/y/bar', _no_mixins=True).write('')
+    dirs._TitanDir(id='/x', name='x', parent_path='/',
+                   parent_paths=['/']).put()
+    dirs._TitanDir(id='/x/y', name='y', parent_path='/x',
+                   parent_paths=['/', '/x']).put()
+    self.assertIsNone(dirs.count_files('/x/y'))
+    self.assertEqual(2, files.Files.count('/x/y'))
+    files.File('/x/y/foo').delete()
+    self.assertTrue(dirs.Dir('/x/y').exists)
+
+    # Backfill the counters.
+    self.assertEqual(2, dirs.backfill_dir_counts(batch_size=2))
+    self.RunDeferredTasks()
+    self.assertEqual(1, dirs.count_files('/x/y'))
+    expected = {'/x': (0, 1), '/x/y': (1, 0)}
+    self.assertEqual(expected, dirs._get_dir_counts(['/x', '/x/y']))
+    files.File('/x/y/bar').delete()
+    self.assertEqual(dirs.Dirs([]), dirs.Dirs.list('/'))
+
+    # Writes only add pull tasks for new files, which DirTaskConsumer counts.
+    self.stubs.Set(
+        dirs.DirTaskConsumer, 'process_next_window', lambda self: None)
+    self.stubs.Set(dirs, '_offset_dir_counts_async', None)
+    files.File('/f/foo').write('')
+    files.Files.write_multi({'/f/bar': ''})
+    self.stubs.UnsetAll()
+    self.assertTrue(dirs.Dir('/f').exists)
+    self.assertEqual(0, dirs.count_files('/f'))
+    dirs.DirTaskConsumer().process_next_window()
+    self.assertEqual(2, dirs.count_files('/f'))
+
+  def testDirExistenceCache(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    files.File('/a/b/foo').write('')
+    self.assertEqual(
+        set(['/a', '/a/b']),
+        dirs._dir_cache.get_available(set(['/a', '/a/b', '/c'])))
+
+    # Writes into known dirs don't touch the dir entities. Only overwrite, since
+    # new files are also counted by DirTaskConsumer, which updates their dirs.
+    ndb.Key(dirs._TitanDir, '/a/b').delete()
+    files.File('/a/b/foo').write('foo')
+    self.assertFalse(dirs.Dir('/a/b').exists)
+
+    # The memcache record is shared after the local record is gone.
+    dirs._dir_cache.clear()
+    self.assertEqual(set(['/a/b']), dirs._dir_cache.get_available(['/a/b']))
+    dirs._dir_cache.invalidate(['/a/b'])
+    files.File('/a/b/baz').write('')
+    self.assertTrue(dirs.Dir('/a/b').exists)
+
+    # Deleted dirs are invalidated.
+    files.Files(['/a/b/foo', '/a/b/baz']).delete()
+    self.assertFalse(dirs.Dir('/a/b').exists)
+    self.assertEqual(set(), dirs._dir_cache.get_available(['/a/b']))
+    files.File('/a/b/foo').write('')
+    self.assertTrue(dirs.Dir('/a/b').exists)
+
+    # Local records of other instances are stale once dirs are deleted.
+    other_cache = dirs._DirExistenceCache()
+    self.assertEqual(set(['/a/b']), other_cache.get_available(['/a/b']))
+    dirs._dir_cache.invalidate(['/a/b'])
+    self.assertEqual(set(), other_cache.get_available(['/a/b']))
+
+    # Records from before a delete are never stored as current.
+    generation = dirs._dir_cache.get_generation()
+    dirs._dir_cache.invalidate(['/a/b'])
+    dirs._dir_cache.set_available(['/a/b'], generation)
+    self.assertEqual(set(), dirs._dir_cache.get_available(['/a/b']))
+
+    # Namespaces are cached separately.
+    dirs._dir_cache.set_available(['/a/b'], dirs._dir_cache.get_generation())
+    self.assertEqual(
+        set(), dirs._dir_cache.get_available(['/a/b'], namespace='aaa'))
+
+  def testDirTaskConsumer(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    namespaces = (None, 'aaa', 'bbb')
+    for namespace in namespaces:
+      files.File('/a/b/foo', namespace=namespace).write('')
+
+    # Queue deletes across namespaces without consuming them right away.
+    self.stubs.Set(
+        dirs.DirTaskConsumer, 'process_next_window', lambda self: None)
+    for namespace in namespaces:
+      files.File('/a/b/foo', namespace=namespace).delete()
+    self.stubs.UnsetAll()
+
+    # An error in one namespace doesn't stop the others.
+    update_affected_dirs_async = dirs.DirService.update_affected_dirs_async
+    def _UpdateAffectedDirsAsync(dir_service, *args, **kwargs):
+      if kwargs['namespace'] == 'bbb':
+        raise ValueError()
+      return update_affected_dirs_async(dir_service, *args, **kwargs)
+    self.stubs.Set(
+        dirs.DirService, 'update_affected_dirs_async',
+        _UpdateAffectedDirsAsync)
+    dir_task_consumer = dirs.DirTaskConsumer()
+    self.assertRaises(ValueError, dir_task_consumer.process_next_window)
+    self.assertFalse(dirs.Dir('/a/b').exists)
+    self.assertFalse(dirs.Dir('/a/b', namespace='aaa').exists)
+    self.assertTrue(dirs.Dir('/a/b', namespace='bbb').exists)
+    self.stubs.UnsetAll()
+
+    # Shard tasks by namespace across consumers.
+    self.stubs.SmartSet(dirs, 'TASKQUEUE_NUM_SHARDS', 2)
+    self.assertRaises(ValueError, dirs.DirTaskConsumer, shard=2)
+    for namespace in (None, 'aaa'):
+      files.File('/c/d/foo', namespace=namespace).write('')
+    self.stubs.Set(
+        dirs.DirTaskConsumer, 'process_next_window', lambda self: None)
+    for namespace in (None, 'aaa'):
+      files.File('/c/d/foo', namespace=namespace).delete()
+    self.stubs.UnsetAll()
+    modified_paths = dirs.DirTaskConsumer(shard=1).process_next_window()
+    self.assertEqual(['aaa'], [path.namespace for path in modified_paths])
+    self.assertTrue(dirs.Dir('/c/d').exists)
+    self.assertFalse(dirs.Dir('/c/d', namespace='aaa').exists)
+    modified_paths = dirs.DirTaskConsumer(shard=0).process_next_window()
+    self.assertEqual([None], [path.namespace for path in modified_paths])
+    self.assertFalse(dirs.Dir('/c/d').exists)
+    self.stubs.SmartUnsetAll()
+
+    # When the leases run low, only the next group of namespaces is extended,
+    # and groups with too many tasks are left to a later window.
+    self.stubs.SmartSet(dirs, 'MAX_CONCURRENT_NAMESPACES', 1)
+    self.stubs.SmartSet(dirs, 'TASKQUEUE_MAX_LEASE_EXTENSIONS', 0)
+    lease_tasks = dirs.DirTaskConsumer._lease_tasks
+    self.stubs.Set(
+        dirs.DirTaskConsumer, '_lease_tasks',
+        lambda self, queue: (lease_tasks(self, queue)[0], time.time()))
+    def _WriteAndDelete(path):
+      for namespace in (None, 'aaa'):
+        files.File(path, namespace=namespace).write('')
+      process_next_window = dirs.DirTaskConsumer.process_next_window
+      self.stubs.Set(
+          dirs.DirTaskConsumer, 'process_next_window', lambda self: None)
+      for namespace in (None, 'aaa'):
+        files.File(path, namespace=namespace).delete()
+      self.stubs.Set(
+          dirs.DirTaskConsumer, 'process_next_window', process_next_window)
+    _WriteAndDelete('/e/f/foo')
+    self.assertEqual([], dirs.DirTaskConsumer().process_next_window())
+    self.assertTrue(dirs.Dir('/e/f').exists)
+    self.assertTrue(dirs.Dir('/e/f', namespace='aaa').exists)
+
+    self.stubs.SmartSet(dirs, 'TASKQUEUE_MAX_LEASE_EXTENSIONS', 1)
+    _WriteAndDelete('/g/h/foo')
+    modified_paths = dirs.DirTaskConsumer().process_next_window()
+    self.assertEqual(
+        set([None, 'aaa']), set(path.namespace for path in modified_paths))
+    self.assertFalse(dirs.Dir('/g/h').exists)
+    self.assertFalse(dirs.Dir('/g/h', namespace='aaa').exists)
+
+  def testListPagination(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    files.Files.write_multi(
+        dict(('/a/dir%d/foo' % i, '') for i in range(5)))
+    dirs.Dir('/a/dir0').set_meta({'flag': True})
+
+    # Page through the sub-directories.
+    titan_dirs = dirs.Dirs.list('/a', page_size=2)
+    self.assertEqual(['/a/dir0', '/a/dir1'], titan_dirs.keys())
+    self.assertTrue(titan_dirs.has_more)
+    titan_dirs = dirs.Dirs.list(
+        '/a', cursor=titan_dirs.cursor.urlsafe(), page_size=2)
+    self.assertEqual(['/a/dir2', '/a/dir3'], titan_dirs.keys())
+    titan_dirs = dirs.Dirs.list('/a', cursor=titan_dirs.cursor)
+    self.assertEqual(['/a/dir4'], titan_dirs.keys())
+    self.assertFalse(titan_dirs.has_more)
+    self.assertIsNone(titan_dirs.cursor)
+    self.assertRaises(ValueError, dirs.Dirs.list, '/a', cursor='bad')
+    self.assertRaises(ValueError, dirs.Dirs.list, '/a', page_size=0)
+    self.assertRaises(
+        ValueError, dirs.Dirs.list, '/a', limit=1, page_size=1)
+
+    # Loaded dirs need no more RPCs for meta and exists.
+    self.stubs.Set(dirs._TitanDir, 'get_by_id', None)
+    titan_dirs = dirs.Dirs.list('/a', page_size=2, load=True)
+    self.assertTrue(titan_dirs['/a/dir0'].meta.flag)
+    self.assertTrue(titan_dirs['/a/dir1'].exists)
+    titan_dirs = dirs.Dirs.list('/a', load=True, strip_prefix='/a')
+    self.assertEqual('/dir0', titan_dirs['/dir0'].path)
+    self.assertTrue(titan_dirs['/dir0'].meta.flag)
+    self.stubs.UnsetAll()
+
+    # Batch load, which also removes non-existent dirs.
+    titan_dirs = dirs.Dirs(['/a/dir0', '/a/dir1', '/a/fake'])
+    self.assertEqual(titan_dirs, titan_dirs.load())
+    self.assertEqual(['/a/dir0', '/a/dir1'], titan_dirs.keys())
+    self.stubs.Set(dirs._TitanDir, 'get_by_id', None)
+    self.assertTrue(titan_dirs['/a/dir0'].meta.flag)
+    self.stubs.UnsetAll()
+
+  def testCopyMoveAndDeleteDir(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    files.Files.write_multi({
+        '/a/foo': 'foo',
+        '/a/b/bar': 'bar',
+        '/a/b/c/baz': 'baz',
+    })
+
+    # Copy, in batches of one file per task.
+    task_manager = dirs.Dir('/a').copy_to(
+        dirs.Dir('/x/y'), batch_size=1, page_size=2)
+    self.assertEqual(3, task_manager.num_total)
+    # The destination dirs are written before the files are copied.
+    self.assertEqual(dirs.Dirs(['/x/y/b']), dirs.Dirs.list('/x/y'))
+    self.assertTrue(dirs.Dir('/x/y/b/c').exists)
+    self.assertFalse(files.File('/x/y/foo').exists)
+    self.RunDeferredTasks()
+    task_manager = tasks.TaskManager(key=task_manager.key)
+    self.assertEqual(3, task_manager.num_successful)
+    self.assertEqual('baz', files.File('/x/y/b/c/baz').content)
+    self.assertEqual(3, len(files.Files.list('/a', recursive=True)))
+
+    # Move to another namespace, with a caller-managed task manager.
+    task_manager = tasks.TaskManager.new()
+    self.assertEqual(
+        task_manager,
+        dirs.Dir('/x').move_to(
+            dirs.Dir('/x', namespace='aaa'), task_manager=task_manager))
+    task_manager.finalize()
+    self.assertEqual(1, task_manager.num_total)
+    self.RunDeferredTasks()
+    task_manager = tasks.TaskManager(key=task_manager.key)
+    self.assertEqual(1, task_manager.num_successful)
+    self.assertEqual('bar', files.File('/x/y/b/bar', namespace='aaa').content)
+    self.assertTrue(dirs.Dir('/x/y/b/c', namespace='aaa').exists)
+    self.assertFalse(files.Files.list('/x', recursive=True))
+    self.assertFalse(dirs.Dir('/x').exists)
+
+    # Delete.
+    task_manager = dirs.Dir('/a').delete(batch_size=2)
+    self.assertEqual(2, task_manager.num_total)
+    self.RunDeferredTasks()
+    task_manager = tasks.TaskManager(key=task_manager.key)
+    self.assertEqual(2, task_manager.num_successful)
+    self.assertFalse(files.Files.list('/a', recursive=True))
+    self.assertFalse(dirs.Dir('/a/b').exists)
+
+    # A dir cannot be copied or moved into itself.
+    self.assertRaises(ValueError, dirs.Dir('/a').copy_to, dirs.Dir('/a'))
+    self.assertRaises(ValueError, dirs.Dir('/a').move_to, dirs.Dir('/a/b'))
+    dirs.Dir('/a').copy_to(dirs.Dir('/ab'))
+    dirs.Dir('/a').copy_to(dirs.Dir('/a', namespace='aaa'))
+
   def testStripPrefix(self):
     files.register_file_mixins([dirs.DirManagerMixin])
     titan_dir = dirs.Dir('/a/b', strip_prefix='/a')
@@ -105,6 +416,7 @@ class DirManagerTest(testing.BaseTestCase):
         'namespace': None,
         'modified': now,
         'action': dirs._STATUS_AVAILABLE,
+        'created': True,
     }
     self.assertEqual(expected, dirs.ModifiedPath(**expected).serialize())
 
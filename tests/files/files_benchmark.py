@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for files.py.
+
+These are not run by runtests.py. Usage:
+  python tests/files/files_benchmark.py
+"""
+
+from tests.common import testing
+
+import time
+from titan.common.lib.google.apputils import app
+from titan.common.lib.google.apputils import basetest
+from titan.files import files
+from titan.files.mixins import json_mixin
+from titan.files.mixins import microversions
+from titan.files.mixins import stats_recorder
+from titan.files.mixins import versions
+
+NUM_FILES = 10000
+NUM_ROUNDS = 3
+
+MIXINS = [
+    stats_recorder.StatsRecorderMixin,
+    json_mixin.JsonMixin,
+    microversions.MicroversioningMixin,
+    versions.FileVersioningMixin,
+]
+
+def _register_unmemoized_file_mixins(mixin_classes):
+  """The original register_file_mixins factory, for comparison."""
+
+  def DynamicFileFactory(**kwargs):
+    base_classes = []
+    shared_mixin_state = {}
+    for mixin_cls in mixin_classes:
+      should_apply_mixin_fn = getattr(mixin_cls, 'should_apply_mixin', None)
+      if (not should_apply_mixin_fn
+          or should_apply_mixin_fn(_mixin_state=shared_mixin_state, **kwargs)):
+        base_classes.append(mixin_cls)
+    base_classes.append(files.File)
+    return type('DynamicFile', tuple(base_classes), {})
+  files.register_file_factory(DynamicFileFactory)
+
+class FileFactoryBenchmark(testing.BaseTestCase):
+
+  def setUp(self):
+    super(FileFactoryBenchmark, self).setUp()
+    # Files.list() constructs a Files object from the paths of the query
+    # result, so this is the same code path without the datastore query.
+    self.paths = []
+    for i in range(NUM_FILES):
+      extension = '.json' if i % 2 else '.html'
+      self.paths.append('/bench/dir%d/file%d%s' % (i % 100, i, extension))
+
+  def tearDown(self):
+    files.unregister_file_factory()
+    super(FileFactoryBenchmark, self).tearDown()
+
+  def _time_construction(self, **kwargs):
+    timings = []
+    for _ in range(NUM_ROUNDS):
+      start = time.time()
+      titan_files = files.Files(paths=self.paths, **kwargs)
+      timings.append(time.time() - start)
+      self.assertEqual(NUM_FILES, len(titan_files))
+    return min(timings)
+
+  def testConstructListResults(self):
+    for kwargs in ({}, {'changeset': 1}):
+      _register_unmemoized_file_mixins(MIXINS)
+      unmemoized_seconds = self._time_construction(**kwargs)
+      num_classes = len(set(
+          [type(f) for f in files.Files(paths=self.paths[:100]).values()]))
+
+      files.register_file_mixins(MIXINS)
+      memoized_seconds = self._time_construction(**kwargs)
+      memoized_num_classes = len(set(
+          [type(f) for f in files.Files(paths=self.paths).values()]))
+
+      print ('\n%d files %r: unmemoized %.3fs (%d classes per 100 files), '
+             'memoized %.3fs (%d classes total), %.1fx speedup.' % (
+                 NUM_FILES, kwargs, unmemoized_seconds, num_classes,
+                 memoized_seconds, memoized_num_classes,
+                 unmemoized_seconds / memoized_seconds))
+
+def main(unused_argv):
+  basetest.main()
+
+if __name__ == '__main__':
+  app.run()
@@ -114,6 +114,14 @@ class FilesClientTestCase(testing.BaseTestCase):
     remote_files.list('/', recursive=True)
     self.assertEqual(['/a/foo'], remote_files.keys())
 
+    # Paginated List().
+    files.File('/a/bar').write('bar!')
+    files.File('/b/baz').write('baz!')
+    remote_files.list('/', recursive=True, page_size=1)
+    self.assertSameElements(['/a/foo', '/a/bar', '/b/baz'], remote_files.keys())
+    files.File('/a/bar').delete()
+    files.File('/b/baz').delete()
+
     # Test Delete().
     remote_files.delete()
     actual_file = files.File('/a/foo')
@@ -22,12 +22,15 @@ import cPickle as pickle
 import copy
 import datetime
 import hashlib
+import zlib
 from google.appengine.api import files as blobstore_files
 from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
 from titan.common.lib.google.apputils import app
 from titan.common.lib.google.apputils import basetest
 from titan.files import files
 from titan.common import utils
+from titan import tasks
 from titan import users
 
 # Content larger than the arbitrary max content size and the 1MB RPC limit.
@@ -192,6 +195,7 @@ class FileTestCase(testing.BaseTestCase):
         # Arbitrary meta data for expando:
         color=u'blue',
         flag=False,
+        content_size=len('Test'),
         md5_hash=hashlib.md5('Test').hexdigest(),
     )
     original_expected_file = copy.deepcopy(expected_file)
@@ -213,6 +217,7 @@ class FileTestCase(testing.BaseTestCase):
     actual_file = files.File('/foo/bar.html')
     actual_file.write('New content', meta=new_meta, mime_type='fake/type')
     expected_file.content = 'New content'
+    expected_file.content_size = len('New content')
     expected_file.md5_hash = hashlib.md5('New content').hexdigest()
     expected_file.flag = True
     expected_file.mime_type = 'fake/type'
@@ -362,6 +367,7 @@ class FileTestCase(testing.BaseTestCase):
         'blobs',
         'created_by',
         'modified_by',
+        'content_size',
         'md5_hash',
         # NDB reserved:
         'key',
@@ -380,6 +386,178 @@ class FileTestCase(testing.BaseTestCase):
         self.fail(
             'Invalid meta key should have failed: {!r}'.format(key))
 
+  def testSize(self):
+    files.File('/foo/a.txt').write(u'\xb0')
+    files.File('/foo/b.txt').write(LARGE_FILE_CONTENT)
+    files.File('/foo/c.txt').write(blob=self.blob_key)
+    files.File('/foo/d.txt').write('d' * 100, compression='zlib')
+    self.assertEqual(2, files.File('/foo/a.txt')._file.content_size)
+    self.assertEqual(
+        len(LARGE_FILE_CONTENT), files.File('/foo/b.txt')._file.content_size)
+    self.assertEqual(
+        len('Blobstore!'), files.File('/foo/c.txt')._file.content_size)
+    self.assertEqual(
+        hashlib.md5('Blobstore!').hexdigest(),
+        files.File('/foo/c.txt')._file.md5_hash)
+    self.assertEqual(100, files.File('/foo/d.txt').size)
+
+    # Serializing does not read content or BlobInfo.
+    self.stubs.Set(files, '_read_content_or_blob', None)
+    self.stubs.Set(files.blobstore.BlobInfo, 'get', None)
+    self.assertEqual(
+        len(LARGE_FILE_CONTENT), files.File('/foo/b.txt').serialize()['size'])
+    self.stubs.SmartUnsetAll()
+
+    # Filter and order by size.
+    filters = [files.FileProperty('content_size') > 2]
+    order = [files.FileProperty('content_size')]
+    titan_files = files.OrderedFiles.list(
+        '/foo', filters=filters, order=order)
+    self.assertEqual(['/foo/c.txt', '/foo/d.txt', '/foo/b.txt'],
+                     titan_files.keys())
+
+    # A "size" meta property does not collide with the stored content size.
+    files.File('/foo/e.txt').write('e', meta={'size': 5})
+    self.assertEqual(1, files.File('/foo/e.txt').size)
+    self.assertEqual(5, files.File('/foo/e.txt').meta.size)
+
+    # Backfill entities written before "content_size" existed.
+    for path in ('/foo/a.txt', '/foo/b.txt', '/foo/d.txt', '/foo/e.txt'):
+      file_ent = files.File(path)._file
+      file_ent.content_size = None
+      file_ent.md5_hash = None
+      file_ent.put()
+    self.assertEqual(100, files.File('/foo/d.txt').size)
+    self.assertEqual(2, files.backfill_file_sizes(batch_size=2))
+    self.RunDeferredTasks()
+    self.assertEqual(2, files.File('/foo/a.txt')._file.content_size)
+    self.assertEqual(
+        len(LARGE_FILE_CONTENT), files.File('/foo/b.txt')._file.content_size)
+    self.assertEqual(
+        hashlib.md5(LARGE_FILE_CONTENT).hexdigest(),
+        files.File('/foo/b.txt')._file.md5_hash)
+    self.assertEqual(100, files.File('/foo/d.txt')._file.content_size)
+    self.assertEqual(1, files.File('/foo/e.txt')._file.content_size)
+    self.assertEqual(5, files.File('/foo/e.txt').meta.size)
+
+  def testCompression(self):
+    # Content which would otherwise go to blobstore is stored inline.
+    titan_file = files.File('/foo/bar.json').write(
+        LARGE_FILE_CONTENT, compression='zlib')
+    titan_file = files.File('/foo/bar.json')
+    self.assertIsNone(titan_file.blob)
+    self.assertEqual('zlib', titan_file._file.compression)
+    self.assertLess(len(titan_file._file.content), files.MAX_CONTENT_SIZE)
+    self.assertEqual(LARGE_FILE_CONTENT, titan_file.content)
+    self.assertEqual(len(LARGE_FILE_CONTENT), titan_file.size)
+    self.assertEqual(
+        hashlib.md5(LARGE_FILE_CONTENT).hexdigest(), titan_file.md5_hash)
+    self.assertEqual(LARGE_FILE_CONTENT, titan_file.open().read())
+    self.assertNotIn('compression', titan_file.meta.serialize())
+
+    # Unicode content and copies.
+    files.File('/foo/bar.txt').write(u'\xb0' * 100, compression='zlib')
+    files.File('/foo/bar.txt').copy_to(files.File('/foo/qux.txt'))
+    files.Files(['/foo/bar.txt']).copy_to('/bar', strip_prefix='/foo')
+    for path in ('/foo/bar.txt', '/foo/qux.txt', '/bar/bar.txt'):
+      self.assertEqual(u'\xb0' * 100, files.File(path).content)
+      self.assertEqual('zlib', files.File(path)._file.compression)
+
+    # Incompressible content is stored as-is.
+    files.File('/foo/bar.json').write('a', compression='zlib')
+    self.assertIsNone(files.File('/foo/bar.json')._file.compression)
+    self.assertEqual('a', files.File('/foo/bar.json').content)
+
+    # Pluggable codecs.
+    files.register_compression_codec(
+        'reversed-zlib',
+        lambda content: zlib.compress(content)[::-1],
+        lambda content: zlib.decompress(content[::-1]))
+    files.File('/foo/bar.json').write('b' * 100, compression='reversed-zlib')
+    self.assertEqual('b' * 100, files.File('/foo/bar.json').content)
+    self.assertRaises(
+        ValueError, files.File('/foo/bar.json').write, 'b', compression='fake')
+
+  def testOpen(self):
+    # Inline content.
+    files.File('/foo/bar.txt').write(u'\xb0\nbar\n')
+    with files.File('/foo/bar.txt').open() as fp:
+      self.assertEqual(['\xc2\xb0\n', 'bar\n'], list(fp))
+      fp.seek(1)
+      self.assertEqual('\xb0', fp.read(1))
+      self.assertEqual(2, fp.tell())
+
+    # Blob content, streamed in small ranged reads.
+    lines = ['%07d\n' % i for i in range(len(LARGE_FILE_CONTENT) / 8)]
+    content = ''.join(lines)
+    files.File('/foo/big.txt').write(content)
+    files._clear_blob_cache_for_paths(['/foo/big.txt'])
+    fp = files.File('/foo/big.txt').open(buffer_size=1024)
+    self.assertEqual(lines[0], fp.readline())
+    fp.seek(8 * 1000)
+    self.assertEqual(lines[1000] + lines[1001], fp.read(16))
+    fp.seek(0)
+    self.assertEqual(lines, list(fp))
+    fp.close()
+
+    self.assertRaises(ValueError, files.File('/foo/bar.txt').open, 'w+')
+    self.assertRaises(files.BadFileError, files.File('/fake').open)
+    self.assertRaises(TypeError, files.File('/foo/bar.txt').open, meta={})
+
+  def testOpenForWriting(self):
+    # Small content is written inline.
+    with files.File('/foo/bar.txt').open('w', meta={'color': 'blue'}) as fp:
+      fp.write('foo')
+      fp.writelines(['bar\n', 'baz\n'])
+    titan_file = files.File('/foo/bar.txt')
+    self.assertEqual('foobar\nbaz\n', titan_file.content)
+    self.assertEqual('blue', titan_file.meta.color)
+    self.assertIsNone(titan_file.blob)
+    self.assertRaises(ValueError, fp.write, 'foo')
+
+    # Large content is streamed to blobstore in chunks.
+    lines = ['%07d\n' % i for i in range(len(LARGE_FILE_CONTENT) / 8)]
+    content = ''.join(lines)
+    fp = files.File('/foo/big.txt').open('w', buffer_size=1024)
+    for line in lines:
+      fp.write(line)
+    self.assertFalse(files.File('/foo/big.txt').exists)
+    # The size and md5 hash of the streamed blob are not fetched again.
+    self.stubs.SmartSet(blobstore.BlobInfo, 'get', None)
+    fp.close()
+    self.stubs.SmartUnsetAll()
+    titan_file = files.File('/foo/big.txt')
+    self.assertEqual(len(content), titan_file._file.content_size)
+    self.assertEqual(
+        hashlib.md5(content).hexdigest(), titan_file._file.md5_hash)
+    self.assertEqual(content, titan_file.content)
+    self.assertEqual(hashlib.md5(content).hexdigest(), fp.md5_hash)
+    self.assertEqual(len(content), fp.size)
+    blob_key = titan_file.blob.key()
+    self.assertEqual(hashlib.md5(content).hexdigest(), titan_file.blob.md5_hash)
+
+    # Rewriting the same content keeps the same blob.
+    with files.File('/foo/big.txt').open('w') as fp:
+      fp.write(content)
+    self.assertEqual(blob_key, files.File('/foo/big.txt').blob.key())
+
+    # Errors inside of the with statement do not write the file.
+    try:
+      with files.File('/foo/failed.txt').open('w') as fp:
+        fp.write(content)
+        raise ValueError
+    except ValueError:
+      pass
+    self.assertFalse(files.File('/foo/failed.txt').exists)
+
+    fp = files.File('/foo/bar.txt').open('w')
+    self.assertRaises(TypeError, fp.write, u'foo')
+    self.assertRaises(
+        TypeError, files.File('/foo/bar.txt').open, 'w', content='foo')
+    self.assertRaises(
+        files.InvalidMetaError,
+        files.File('/foo/bar.txt').open, 'w', meta={'path': 'x'})
+
   def testDelete(self):
     # Synchronous delete.
     titan_file = files.File('/foo/bar.html').write('')
@@ -391,6 +569,58 @@ class FileTestCase(testing.BaseTestCase):
     # Error handling.
     self.assertRaises(files.BadFileError, files.File('/fake.html').delete)
 
+  def testAsync(self):
+    futures = [
+        files.File('/foo/a.txt').write_async(u'\xb0'),
+        files.File('/foo/b.txt').write_async(LARGE_FILE_CONTENT),
+    ]
+    ndb.Future.wait_all(futures)
+    self.assertEqual('/foo/a.txt', futures[0].get_result().path)
+    self.assertEqual(u'\xb0', files.File('/foo/a.txt').content)
+
+    # Loading and reading.
+    titan_file = files.File('/foo/b.txt')
+    self.assertFalse(titan_file.is_loaded)
+    self.assertEqual(titan_file, titan_file.load_async().get_result())
+    self.assertTrue(titan_file.is_loaded)
+    futures = [
+        files.File('/foo/a.txt').read_async(),
+        files.File('/foo/b.txt').read_async(),
+    ]
+    self.assertEqual(u'\xb0', futures[0].get_result())
+    self.assertEqual(LARGE_FILE_CONTENT, futures[1].get_result())
+    self.assertFalse(files.File('/fake').load_async().get_result().exists)
+
+    # Updates.
+    files.File('/foo/a.txt').write_async(meta={'color': 'blue'}).get_result()
+    self.assertEqual('blue', files.File('/foo/a.txt').meta.color)
+    self.assertEqual(u'\xb0', files.File('/foo/a.txt').content)
+
+    # Existence checks don't block.
+    self.stubs.SmartSet(files._TitanFile, 'get_by_id', None)
+    files.File('/foo/c.txt').write_async('c').get_result()
+    self.stubs.SmartUnsetAll()
+    self.assertEqual('c', files.File('/foo/c.txt').content)
+
+    # Deleting.
+    blob_key = files.File('/foo/b.txt').blob.key()
+    futures = [
+        files.File('/foo/a.txt').delete_async(),
+        files.File('/foo/b.txt').delete_async(),
+    ]
+    ndb.Future.wait_all(futures)
+    self.assertFalse(files.File('/foo/a.txt').exists)
+    self.assertFalse(files.File('/foo/b.txt').exists)
+    self.assertIsNone(blobstore.get(blob_key))
+
+    # Error handling.
+    future = files.File('/fake').read_async()
+    self.assertRaises(files.BadFileError, future.get_result)
+    future = files.File('/fake').delete_async()
+    self.assertRaises(files.BadFileError, future.get_result)
+    future = files.File('/foo').write_async('foo', _batch=None)
+    self.assertRaises(ValueError, future.get_result)
+
   def testFileMixins(self):
     # Support behavior: subclass File and make write() also touch a
     # centralized file, while avoiding infinite recursion.
@@ -643,6 +873,10 @@ class NamespaceTestCase(testing.BaseTestCase):
 
 class MixinsTestCase(testing.BaseTestCase):
 
+  def tearDown(self):
+    files.unregister_file_factory()
+    super(MixinsTestCase, self).tearDown()
+
   def testRegisterFileFactory(self):
 
     class FooFile(files.File):
@@ -691,6 +925,49 @@ class MixinsTestCase(testing.BaseTestCase):
     self.assertTrue(isinstance(bar_file, BarFileMixin))
     self.assertTrue(isinstance(bar_file, FooFileMixin))
 
+    # Generated classes are memoized per combination of applied mixins.
+    self.assertIs(type(foo_file), type(files.File('/foo/files/b')))
+    self.assertIs(type(bar_file), type(files.File('/bar/files/c')))
+    self.assertIsNot(type(foo_file), type(bar_file))
+
+  def testRegisterFileMixinsDecisionKeys(self):
+    calls = []
+
+    class FooFileMixin(files.File):
+
+      @classmethod
+      def should_apply_mixin(cls, **kwargs):
+        calls.append(kwargs['path'])
+        return kwargs['path'].startswith('/foo/')
+
+      @classmethod
+      def get_mixin_decision_key(cls, **kwargs):
+        return kwargs['path'].startswith('/foo/')
+
+    class BarFileMixin(FooFileMixin):
+
+      @classmethod
+      def should_apply_mixin(cls, **kwargs):
+        calls.append(kwargs['path'])
+        return kwargs['path'].startswith('/bar/')
+
+    # Decisions are memoized per decision key.
+    files.register_file_mixins([FooFileMixin])
+    self.assertTrue(isinstance(files.File('/foo/a'), FooFileMixin))
+    self.assertTrue(isinstance(files.File('/foo/b'), FooFileMixin))
+    self.assertFalse(isinstance(files.File('/qux/a'), FooFileMixin))
+    self.assertFalse(isinstance(files.File('/qux/b'), FooFileMixin))
+    self.assertEqual(['/foo/a', '/qux/a'], calls)
+
+    # A subclass which overrides should_apply_mixin without also overriding
+    # get_mixin_decision_key must not use the inherited decision key.
+    calls[:] = []
+    files.register_file_mixins([BarFileMixin])
+    self.assertTrue(isinstance(files.File('/bar/a'), BarFileMixin))
+    self.assertTrue(isinstance(files.File('/bar/b'), BarFileMixin))
+    self.assertFalse(isinstance(files.File('/foo/a'), BarFileMixin))
+    self.assertEqual(['/bar/a', '/bar/b', '/foo/a'], calls)
+
 class FilesTestCase(testing.BaseTestCase):
 
   def testFilesList(self):
@@ -751,6 +1028,34 @@ class FilesTestCase(testing.BaseTestCase):
     titan_files = files.Files.list('/foo', recursive=True, limit=1)
     self.assertEqual(1, len(titan_files))
 
+    # Paginate with cursors.
+    titan_files = files.OrderedFiles.list('/', recursive=True, page_size=4)
+    self.assertEqual(4, len(titan_files))
+    self.assertTrue(titan_files.has_more)
+    next_titan_files = files.OrderedFiles.list(
+        '/', recursive=True, cursor=titan_files.cursor, page_size=4)
+    self.assertEqual(2, len(next_titan_files))
+    self.assertFalse(next_titan_files.has_more)
+    self.assertIsNone(next_titan_files.cursor)
+    self.assertSameObjects(
+        all_files, files.Files.merge(titan_files, next_titan_files))
+    # Web-safe cursor strings are also supported.
+    next_titan_files = files.OrderedFiles.list(
+        '/', recursive=True, cursor=titan_files.cursor.urlsafe(), page_size=4)
+    self.assertEqual(2, len(next_titan_files))
+
+    # Iterate over pages.
+    pages = list(files.Files.iter_list('/', recursive=True, page_size=4))
+    self.assertEqual([4, 2], [len(page) for page in pages])
+    self.assertTrue(pages[0].has_more)
+    self.assertFalse(pages[1].has_more)
+    self.assertSameObjects(all_files, files.Files.merge(*pages))
+    pages = list(files.Files.iter_list('/', recursive=True, page_size=3))
+    self.assertEqual(3, len(pages[0]))
+    self.assertSameObjects(
+        all_files, files.Files.merge(pages[0], pages[1]))
+    self.assertEqual([], list(files.Files.iter_list('/fake/path'))[0].keys())
+
     # Support trailing slashes.
     self.assertSameObjects(second_level, files.Files.list('/foo/bar/'))
     titan_files = files.Files.list('/foo/bar/', recursive=True)
@@ -784,6 +1089,30 @@ class FilesTestCase(testing.BaseTestCase):
     titan_files = files.Files.list('/a/', recursive=True, filters=filters)
     self.assertEqual(files.Files(['/a/bar/qux']), titan_files)
 
+    # Metadata-only listings return read-only stubs.
+    files.File('/a/foo').write('foo', mime_type='text/plain')
+    titan_files = files.OrderedFiles.list('/a', metadata_only=True)
+    self.assertEqual(['/a/baz', '/a/foo'], titan_files.keys())
+    stub = titan_files['/a/foo']
+    self.assertTrue(isinstance(stub, files.FileStub))
+    titan_file = files.File('/a/foo')
+    self.assertEqual('foo', stub.name)
+    self.assertEqual('/a', stub.dir_path)
+    self.assertEqual('text/plain', stub.mime_type)
+    self.assertEqual(3, stub.size)
+    self.assertEqual(titan_file.modified, stub.modified)
+    self.assertEqual(titan_file.created_by, stub.created_by)
+    self.assertRaises(AttributeError, lambda: stub.content)
+    expected = titan_file.serialize()
+    for key in ('paths', 'blob', 'md5_hash', 'meta'):
+      del expected[key]
+    self.assertEqual(expected, stub.serialize())
+    self.assertRaises(ValueError, stub.serialize, full=True)
+    titan_files = files.Files.list(
+        '/', recursive=True, page_size=4, metadata_only=True)
+    self.assertEqual(4, len(titan_files))
+    self.assertTrue(titan_files.has_more)
+
     # Error handling.
     self.assertRaises(ValueError, files.Files.list, '')
     self.assertRaises(ValueError, files.Files.list, '//')
@@ -792,6 +1121,9 @@ class FilesTestCase(testing.BaseTestCase):
                       recursive=True, depth=0)
     self.assertRaises(ValueError, files.Files.list, '/',
                       recursive=False, depth=1)
+    self.assertRaises(ValueError, files.Files.list, '/', cursor='invalid')
+    self.assertRaises(ValueError, files.Files.list, '/', page_size=0)
+    self.assertRaises(ValueError, files.Files.list, '/', limit=1, page_size=1)
 
   def testFilesCount(self):
     # Create files for testing.
@@ -960,6 +1292,44 @@ class FilesTestCase(testing.BaseTestCase):
     # Verify that the NDB in-context cache was cleared correctly.
     self.assertTrue(files.File('/x/b/foo').exists)
 
+    # Blobs are shared with the destination without copying content, and
+    # overwriting a destination which shares the blob does not delete it.
+    files.File('/big/foo').write(LARGE_FILE_CONTENT, meta={'color': 'blue'})
+    files.File('/big/bar').write(u'\xb0', mime_type='text/foo')
+    files.File('/y/foo').write('old', meta={'flag': True})
+    blob_key = files.File('/big/foo').blob.key()
+    for _ in range(2):
+      files.Files.list('/big/').copy_to('/y', strip_prefix='/big/')
+      self.assertEqual(blob_key, files.File('/y/foo').blob.key())
+      self.assertEqual(LARGE_FILE_CONTENT, files.File('/y/foo').content)
+      self.assertEqual('blue', files.File('/y/foo').meta.color)
+      self.assertFalse(hasattr(files.File('/y/foo').meta, 'flag'))
+      self.assertEqual(u'\xb0', files.File('/y/bar').content)
+      self.assertEqual('text/foo', files.File('/y/bar').mime_type)
+    self.assertTrue(blobstore.get(blob_key))
+
+    # Small batches.
+    result_files = files.Files()
+    files.Files.list('/a/', recursive=True).copy_to(
+        '/z', strip_prefix='/a/', batch_size=1, result_files=result_files)
+    self.assertEqual(files.Files(['/z/foo', '/z/b/foo']), result_files)
+    self.assertEqual(result_files, files.Files(['/z/foo', '/z/b/foo']).load())
+
+    # Fan out into deferred tasks.
+    task_manager = tasks.TaskManager.new()
+    result_files = files.Files()
+    files.Files.list('/a/', recursive=True).copy_to(
+        '/w', strip_prefix='/a/', batch_size=1, result_files=result_files,
+        task_manager=task_manager)
+    task_manager.finalize()
+    self.assertEqual(files.Files(['/w/foo', '/w/b/foo']), result_files)
+    self.assertEqual(2, task_manager.num_total)
+    self.assertFalse(files.File('/w/foo').exists)
+    self.RunDeferredTasks()
+    task_manager = tasks.TaskManager(key=task_manager.key)
+    self.assertEqual(2, task_manager.num_successful)
+    self.assertEqual(result_files, files.Files(['/w/foo', '/w/b/foo']).load())
+
   def testMoveTo(self):
     # Populate the in-context cache by reading the file before creation.
     self.assertFalse(files.File('/x/b/foo').exists)
@@ -1003,6 +1373,50 @@ class FilesTestCase(testing.BaseTestCase):
     # Verify that the NDB in-context cache was cleared correctly.
     self.assertTrue(files.File('/x/b/foo').exists)
 
+  def testWriteMulti(self):
+    files.File('/qux').write(LARGE_FILE_CONTENT)
+    old_blob_key = files.File('/qux').blob.key()
+    titan_files = files.Files.write_multi({
+        '/foo': 'foo',
+        '/bar': {'content': u'bar', 'meta': {'color': 'blue'}},
+        '/baz': LARGE_FILE_CONTENT,
+        '/qux': 'qux',
+    })
+    self.assertEqual(
+        files.Files(['/foo', '/bar', '/baz', '/qux']), titan_files)
+    self.assertEqual('foo', files.File('/foo').content)
+    self.assertEqual(u'bar', files.File('/bar').content)
+    self.assertEqual('blue', files.File('/bar').meta.color)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/baz').content)
+    self.assertTrue(files.File('/baz').blob)
+    self.assertEqual('qux', files.File('/qux').content)
+    # Verify that the replaced blob is deleted after the batch is written.
+    self.assertIsNone(blobstore.get(old_blob_key))
+
+    # Meta-only updates of existing files.
+    files.Files.write_multi({'/foo': {'meta': {'color': 'red'}}})
+    self.assertEqual('red', files.File('/foo').meta.color)
+    self.assertEqual('foo', files.File('/foo').content)
+
+    # Small batch sizes.
+    paths = ['/batch/%d' % i for i in range(5)]
+    files.Files.write_multi(
+        dict((path, path) for path in paths), batch_size=2)
+    self.assertEqual(files.Files(paths), files.Files(paths).load())
+
+    # All arguments are validated before anything is written.
+    self.assertRaises(
+        files.BadFileError,
+        files.Files.write_multi,
+        {'/new': 'new', '/fake': {'meta': {'color': 'red'}}})
+    self.assertFalse(files.File('/new').exists)
+    self.assertRaises(
+        TypeError, files.Files.write_multi, {'/new': {}})
+    self.assertRaises(
+        ValueError, files.Files.write_multi, {'/new': {'_batch': None}})
+    self.assertRaises(ValueError, files.Files.write_multi, ['/new'])
+    self.assertFalse(files.File('/new').exists)
+
   def testLoad(self):
     files.File('/foo').write('')
     files.File('/bar').write('')
@@ -1026,6 +1440,31 @@ class FilesTestCase(testing.BaseTestCase):
     # Verify that the blob is also deleted.
     self.assertIsNone(blobstore.get(blob_key))
 
+  def testAsync(self):
+    future = files.Files.write_multi_async({
+        '/foo': 'foo',
+        '/bar': LARGE_FILE_CONTENT,
+    })
+    titan_files = future.get_result()
+    self.assertEqual(files.Files(['/foo', '/bar']), titan_files)
+
+    titan_files = files.Files(['/foo', '/bar', '/fake'])
+    self.assertEqual(
+        files.Files(['/foo', '/bar']), titan_files.load_async().get_result())
+    titan_files = files.Files(['/foo', '/bar', '/fake'])
+    files._clear_blob_cache_for_paths(['/bar'])
+    self.assertEqual(
+        {'/foo': 'foo', '/bar': LARGE_FILE_CONTENT},
+        titan_files.read_async().get_result())
+    # Blob content read from blobstore is stored in the blob cache.
+    self.assertEqual(LARGE_FILE_CONTENT, files._get_blob_cache('/bar'))
+    self.assertEqual(
+        {'/bar': LARGE_FILE_CONTENT}, files._get_blob_cache_multi(['/bar']))
+
+    titan_files.delete_async().get_result()
+    self.assertEqual(
+        files.Files([]), files.Files(['/foo', '/bar']).load())
+
   def testSerialize(self):
     # serialize().
     first_file = files.File('/foo/bar').write('foobar')
@@ -1081,6 +1520,11 @@ class FileCacheTestCase(testing.BaseTestCase):
     files._clear_blob_cache_for_paths(['/foo.html'])
     self.assertIsNone(files._get_blob_cache('/foo.html'))
 
+    # Content over the size threshold is never cached whole.
+    content = 'a' * (files.MAX_BLOB_CACHE_SIZE + 1)
+    self.assertFalse(files._store_blob_cache('/foo.html', content))
+    self.assertIsNone(files._get_blob_cache('/foo.html'))
+
 def main(unused_argv):
   basetest.main()
 
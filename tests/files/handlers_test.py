@@ -24,6 +24,7 @@ import webtest
 from google.appengine.api import blobstore
 from titan.common.lib.google.apputils import basetest
 from titan import files
+from titan.files import dirs
 from titan.files import handlers
 from titan.common import utils
 
@@ -75,6 +76,41 @@ class HandlersTest(testing.BaseTestCase):
     response = self.app.get('/_titan/dirs/processdata?runtime=1')
     self.assertEqual(200, response.status_int)
     self.assertIn(json.dumps({}), response.body)
+    response = self.app.get('/_titan/dirs/processdata?runtime=1&shard=0')
+    self.assertEqual(200, response.status_int)
+    for shard in ('foo', '-1', str(dirs.TASKQUEUE_NUM_SHARDS)):
+      response = self.app.get(
+          '/_titan/dirs/processdata?runtime=1&shard=' + shard,
+          expect_errors=True)
+      self.assertEqual(400, response.status_int)
+
+  def testDirsHandler(self):
+    files.register_file_mixins([dirs.DirManagerMixin])
+    for i in range(3):
+      files.File('/a/dir%d/foo' % i).write('')
+    response = self.app.get('/_titan/dirs', {'dir_path': '/a'})
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(
+        ['dir0', 'dir1', 'dir2'], sorted(json.loads(response.body).keys()))
+
+    # Page through the sub-directories.
+    response = self.app.get('/_titan/dirs',
+                            {'dir_path': '/a', 'page_size': '2'})
+    data = json.loads(response.body)
+    self.assertEqual(['dir0', 'dir1'], sorted(data['dirs'].keys()))
+    self.assertTrue(data['has_more'])
+    response = self.app.get('/_titan/dirs',
+                            {'dir_path': '/a', 'cursor': data['cursor']})
+    data = json.loads(response.body)
+    self.assertEqual(['dir2'], data['dirs'].keys())
+    self.assertFalse(data['has_more'])
+    self.assertIsNone(data['cursor'])
+
+    response = self.app.get('/_titan/dirs',
+                            {'dir_path': '/a', 'page_size': 'foo'},
+                            expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    files.unregister_file_factory()
 
   def testFileHandlerPost(self):
     params = {
@@ -198,6 +234,43 @@ class HandlersTest(testing.BaseTestCase):
     self.assertEqual(200, response.status_int)
     self.assertEqual(expected_paths, json.loads(response.body))
 
+    # Pagination.
+    params = {'dir_path': '/abc', 'recursive': 'true', 'ids_only': 'true',
+              'page_size': '2'}
+    response = self.app.get('/_titan/files', params)
+    self.assertEqual(200, response.status_int)
+    data = json.loads(response.body)
+    self.assertEqual(['/abc/123', '/abc/456/10/22/34'], data['paths'])
+    self.assertTrue(data['has_more'])
+    params['cursor'] = data['cursor']
+    response = self.app.get('/_titan/files', params)
+    data = json.loads(response.body)
+    self.assertEqual(['/abc/def/ghi'], data['paths'])
+    self.assertFalse(data['has_more'])
+    self.assertIsNone(data['cursor'])
+
+    params = {'dir_path': '/abc', 'recursive': 'true', 'page_size': '1'}
+    response = self.app.get('/_titan/files', params)
+    data = json.loads(response.body)
+    self.assertEqual(['/abc/123'], data['files'].keys())
+    self.assertTrue(data['has_more'])
+
+    # Metadata-only listings.
+    params = {'dir_path': '/abc', 'metadata_only': 'true'}
+    response = self.app.get('/_titan/files', params)
+    self.assertEqual(200, response.status_int)
+    data = json.loads(response.body)
+    self.assertEqual(['/abc/123'], data.keys())
+    self.assertEqual(len('abcdef'), data['/abc/123']['size'])
+    self.assertNotIn('meta', data['/abc/123'])
+
+    params = {'dir_path': '/abc', 'page_size': 'foo'}
+    response = self.app.get('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+    params = {'dir_path': '/abc', 'cursor': 'invalid'}
+    response = self.app.get('/_titan/files', params, expect_errors=True)
+    self.assertEqual(400, response.status_int)
+
   def testFileReadHandler(self):
     files.File('/foo/bar').write('foobar')
     response = self.app.get('/_titan/file/read', {'path': '/foo/bar'})
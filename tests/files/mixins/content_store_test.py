@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for content_store.py."""
+
+from tests.common import testing
+
+import hashlib
+from google.appengine.ext import blobstore
+from titan.common.lib.google.apputils import basetest
+from titan import files
+from titan.files.mixins import content_store
+
+LARGE_FILE_CONTENT = 'a' * (1 << 21)  # 2 MiB.
+LARGE_FILE_MD5 = hashlib.md5(LARGE_FILE_CONTENT).hexdigest()
+
+class ContentStoreTestCase(testing.BaseTestCase):
+
+  def setUp(self):
+    super(ContentStoreTestCase, self).setUp()
+    files.register_file_mixins([content_store.ContentStoreMixin])
+
+  def tearDown(self):
+    files.unregister_file_factory()
+    super(ContentStoreTestCase, self).tearDown()
+
+  def _get_refcount(self):
+    return content_store._TitanContent.get_by_md5(LARGE_FILE_MD5).refcount
+
+  def testContentStore(self):
+    # Identical content is only stored once, across paths and namespaces.
+    files.File('/foo').write(LARGE_FILE_CONTENT)
+    files.File('/bar').write(LARGE_FILE_CONTENT)
+    files.File('/foo', namespace='aaa').write(LARGE_FILE_CONTENT)
+    blob_key = files.File('/foo').blob.key()
+    self.assertEqual(blob_key, files.File('/bar').blob.key())
+    self.assertEqual(blob_key, files.File('/foo', namespace='aaa').blob.key())
+    self.assertEqual(3, self._get_refcount())
+
+    # Copies only add references.
+    files.File('/foo').copy_to(files.File('/baz'))
+    self.assertEqual(blob_key, files.File('/baz').blob.key())
+    self.assertEqual(4, self._get_refcount())
+    files.File('/baz').move_to(files.File('/qux'))
+    self.assertEqual(4, self._get_refcount())
+
+    # Rewriting the same content does not change the reference count.
+    files.File('/foo').write(LARGE_FILE_CONTENT)
+    files.File('/foo').write(meta={'color': 'blue'})
+    self.assertEqual(4, self._get_refcount())
+
+    # Overwrites and deletes release references, but keep the blob.
+    files.File('/foo').write('foo')
+    files.File('/bar').delete()
+    files.Files(['/qux']).delete()
+    self.assertEqual(1, self._get_refcount())
+    self.assertTrue(blobstore.get(blob_key))
+    self.assertEqual(
+        LARGE_FILE_CONTENT, files.File('/foo', namespace='aaa').content)
+
+    # Referenced content is never collected.
+    self.assertFalse(content_store.collect_garbage(LARGE_FILE_MD5, 0))
+    files.File('/foo', namespace='aaa').delete()
+    self.assertEqual(0, self._get_refcount())
+
+    # Unreferenced content is only collected after the grace period.
+    self.assertFalse(content_store.collect_garbage(LARGE_FILE_MD5))
+    self.assertTrue(content_store.collect_garbage(LARGE_FILE_MD5, 0))
+    self.assertIsNone(content_store._TitanContent.get_by_md5(LARGE_FILE_MD5))
+    self.assertIsNone(blobstore.get(blob_key))
+
+  def testUnmanagedBlobs(self):
+    # Blobs written without the store are adopted, but never collected.
+    files.File('/foo', _no_mixins=True).write(LARGE_FILE_CONTENT)
+    blob_key = files.File('/foo').blob.key()
+    files.File('/bar').write(blob=blob_key)
+    self.assertEqual(1, self._get_refcount())
+    files.File('/bar').delete()
+    self.assertTrue(content_store.collect_garbage(LARGE_FILE_MD5, 0))
+    self.assertTrue(blobstore.get(blob_key))
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/foo').content)
+
+    # Blobs of files written before the store existed are still deleted.
+    files.File('/foo').write('foo')
+    self.assertIsNone(blobstore.get(blob_key))
+
+if __name__ == '__main__':
+  basetest.main()
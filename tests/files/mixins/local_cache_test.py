@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for local_cache.py."""
+
+from tests.common import testing
+
+import os
+import time
+from titan.common.lib.google.apputils import basetest
+from titan import activities
+from titan import files
+from titan.files.mixins import local_cache
+
+LARGE_FILE_CONTENT = 'a' * (1 << 21)  # 2 MiB.
+
+class LocalCacheTestCase(testing.BaseTestCase):
+
+  def setUp(self):
+    super(LocalCacheTestCase, self).setUp()
+    files.register_file_mixins([local_cache.LocalCacheMixin])
+    local_cache.reset()
+
+  def tearDown(self):
+    files.unregister_file_factory()
+    local_cache.reset()
+    super(LocalCacheTestCase, self).tearDown()
+
+  def testLocalCache(self):
+    files.File('/foo').write('foo')
+    files.File('/bar').write(LARGE_FILE_CONTENT)
+    self.assertEqual('foo', files.File('/foo').content)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/bar').content)
+
+    # Changes which bypass the mixin are not seen until the TTL passes.
+    files.File('/foo', _no_mixins=True).write('new foo')
+    self.assertEqual('foo', files.File('/foo').content)
+    self.stubs.Set(time, 'time', lambda: 1e10)
+    self.assertEqual('new foo', files.File('/foo').content)
+
+    # Blob content is reused if the reloaded file has the same md5 hash.
+    self.stubs.Set(files, '_read_content_or_blob', None)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/bar').content)
+    self.stubs.UnsetAll()
+
+    # Each File object gets its own copy of the cached entity.
+    titan_file = files.File('/foo')
+    titan_file._file.mime_type = 'text/fake'
+    self.assertNotEqual('text/fake', files.File('/foo').mime_type)
+
+    # Writes and deletes invalidate the local entry.
+    files.File('/foo').write('foo')
+    self.assertEqual('foo', files.File('/foo').content)
+    files.Files.write_multi({'/foo': 'multi foo'})
+    self.assertEqual('multi foo', files.File('/foo').content)
+    files.File('/bar').write('bar')
+    self.assertEqual('bar', files.File('/bar').content)
+    files.File('/foo').delete()
+    self.assertFalse(files.File('/foo').exists)
+    self.assertFalse(files.File('/foo').load_async().get_result().exists)
+
+    # Hits, misses and evictions are recorded.
+    counter_names = set([counter.name for counter in self.GetCounters()])
+    self.assertIn('files/local_cache/hits', counter_names)
+    self.assertIn('files/local_cache/misses', counter_names)
+    local_cache.reset(max_bytes=len(LARGE_FILE_CONTENT) + 100)
+    files.File('/baz').write(LARGE_FILE_CONTENT)
+    self.assertEqual(LARGE_FILE_CONTENT, files.File('/baz').content)
+    self.assertEqual('bar', files.File('/bar').content)
+    counter_names = set([counter.name for counter in self.GetCounters()])
+    self.assertIn('files/local_cache/evictions', counter_names)
+    self.assertLessEqual(
+        local_cache._local_cache.size, len(LARGE_FILE_CONTENT) + 100)
+
+  def GetCounters(self):
+    counters = []
+    loggers = os.environ[activities.ACTIVITIES_ENVIRON_KEY]
+    for logger in loggers:
+      counters += getattr(logger.activity, 'counters', [])
+    return counters
+
+if __name__ == '__main__':
+  basetest.main()
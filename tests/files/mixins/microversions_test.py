@@ -87,6 +87,21 @@ class MicroversionsTest(testing.BaseTestCase):
     self.assertEqual(
         LARGE_FILE_CONTENT, files.File('/foo', _no_mixins=True).content)
 
+  def testWriteMulti(self):
+    files.Files.write_multi({
+        '/foo': 'foo',
+        '/bar': LARGE_FILE_CONTENT,
+    })
+    self.assertEqual(2, len(self.taskqueue_stub.get_filtered_tasks()))
+    self.assertEqual('foo', files.File('/foo', _no_mixins=True).content)
+    process_microversions()
+    file_versions = self.vcs.get_file_versions('/bar')
+    titan_file = files.File('/bar', changeset=file_versions[0].changeset)
+    self.assertEqual(LARGE_FILE_CONTENT, titan_file.content)
+    file_versions = self.vcs.get_file_versions('/foo')
+    titan_file = files.File('/foo', changeset=file_versions[0].changeset)
+    self.assertEqual('foo', titan_file.content)
+
   def testContentAndBlobsHandling(self):
     files.File('/foo').write('foo')
     files.File('/foo').delete()
@@ -19,7 +19,10 @@
 from tests.common import testing
 
 import datetime
+from google.appengine.api import memcache
 from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from titan.common import strong_counters
 from titan.common.lib.google.apputils import basetest
 from titan.files import files
 from titan.files.mixins import versions
@@ -173,6 +176,16 @@ class VersionsTest(testing.BaseTestCase):
     self.assertEqual('red', titan_file.meta.color)
     self.assertEqual(False, titan_file.meta.flag)  # untouched meta property.
 
+    # Async methods resolve committed files and only mark files for deletion.
+    titan_file = files.File('/bar').load_async().get_result()
+    self.assertTrue(titan_file.is_loaded)
+    self.assertEqual('bar-versioned', titan_file.read_async().get_result())
+    self.assertFalse(files.File('/fake').load_async().get_result().exists)
+    titan_file = files.File('/bar', changeset=changeset)
+    titan_file.delete_async().get_result()
+    self.assertFalse(files.File('/bar', changeset=changeset).exists)
+    self.assertTrue(files.File('/bar').exists)
+
   def testEmptyRootFile(self):
     # Regression test: make sure that content='' is correctly handled when
     # copying root file attributes.
@@ -254,6 +267,164 @@ class VersionsTest(testing.BaseTestCase):
     self.assertRaises(versions.ChangesetError, titan_file.write, '')
     self.assertRaises(versions.ChangesetError, titan_file.delete)
 
+  def testManifestCache(self):
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/foo', changeset=changeset).write('foo')
+    files.File('/a/bar', changeset=changeset).write('bar')
+    changeset.finalize_associated_files()
+    final_changeset = self.vcs.commit(changeset)
+    self.assertEqual(
+        'foo', final_changeset.get_file_from_manifest('/foo').content)
+
+    # Manifest shards are immutable, so once read they are served from the
+    # instance-local cache and then from memcache.
+    ndb.delete_multi(versions._make_manifest_shard_keys(final_changeset))
+    final_changeset = versions.Changeset(final_changeset.num)
+    self.assertTrue(final_changeset.get_file_from_manifest('/foo'))
+    self.assertIsNone(final_changeset.get_file_from_manifest('/qux'))
+    versions._manifest_cache.clear()
+    self.assertEqual(
+        ['/a/bar'], final_changeset.list_files(
+            '/a', include_manifested=True).keys())
+    memcache.flush_all()
+    versions._manifest_cache.clear()
+    self.assertRaises(
+        versions.CommitError, final_changeset.get_file_from_manifest, '/foo')
+
+  def testLoadResolvesRealPathsInBatches(self):
+    self.make_namespaced_testdata()
+    staging_changeset = self.vcs.new_staging_changeset()
+    files.File('/qux', changeset=staging_changeset).write('qux')
+    paths = ['/foo', '/bar', '/qux', '/fake']
+
+    expected_paths = [
+        (3, ['/foo']),  # 'deleted-by-submit', read through the manifest at 2.
+        (4, ['/bar', '/foo']),  # 'submitted'.
+        (staging_changeset.num, ['/bar', '/foo', '/qux']),
+    ]
+    for changeset_num, existing_paths in expected_paths:
+      changeset = versions.Changeset(changeset_num)
+      expected_real_paths = dict(
+          (path, files.File(path, changeset=changeset).real_path)
+          for path in existing_paths)
+      # Files.load must not look up each file in the manifest.
+      titan_files = files.Files(paths, changeset=changeset)
+      self.stubs.Set(versions.Changeset, 'get_file_from_manifest', None)
+      titan_files.load()
+      self.stubs.UnsetAll()
+      self.assertEqual(
+          expected_real_paths,
+          dict((path, f.real_path) for path, f in titan_files.iteritems()))
+    self.assertEqual('qux', titan_files['/qux'].content)
+
+  def testLoadFilesAtHead(self):
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/foo', changeset=changeset).write('foo')
+    files.File('/bar', changeset=changeset).write('bar')
+    changeset.finalize_associated_files()
+    final_changeset = self.vcs.commit(changeset)
+
+    titan_files = files.Files(['/foo', '/bar', '/fake']).load()
+    self.assertEqual(['/bar', '/foo'], sorted(titan_files.keys()))
+    self.assertEqual(final_changeset, titan_files['/foo'].changeset)
+    self.assertEqual('foo', titan_files['/foo'].content)
+
+    # File pointers at HEAD are cached until the next commit.
+    versions._FilePointer.make_key('/bar', namespace=None).delete()
+    versions._file_pointer_cache.clear()  # Still cached in memcache.
+    titan_files = files.Files(['/foo', '/bar']).load()
+    self.assertEqual(['/bar', '/foo'], sorted(titan_files.keys()))
+
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/foo', changeset=changeset).write('newfoo')
+    changeset.finalize_associated_files()
+    self.vcs.commit(changeset)
+    titan_files = files.Files(['/foo', '/bar']).load()
+    self.assertEqual(['/foo'], titan_files.keys())
+    self.assertEqual('newfoo', titan_files['/foo'].content)
+
+  def testChangesetNumBlocksAndSequencer(self):
+    self.stubs.SmartSet(versions, 'CHANGESET_NUM_BLOCK_SIZE', 3)
+    changeset = self.vcs.new_staging_changeset()
+    other_changeset = self.vcs.new_staging_changeset()
+    self.assertEqual([1, 2], [changeset.num, other_changeset.num])
+    self.assertIsNone(self.vcs.get_last_submitted_changeset())
+
+    # Final changesets are numbered by the sequencer in commit order, after
+    # all numbers which were reserved for staging changesets.
+    files.File('/foo', changeset=changeset).write('foo')
+    changeset.finalize_associated_files()
+    final_changeset = self.vcs.commit(changeset)
+    self.assertEqual(4, final_changeset.num)
+    self.assertEqual(final_changeset, self.vcs.get_last_submitted_changeset())
+    changeset = self.vcs.new_staging_changeset()
+    self.assertEqual(3, changeset.num)
+    self.assertEqual(final_changeset, changeset.base_changeset)
+    self.assertEqual(5, self.vcs.new_staging_changeset().num)
+    sequencer = versions._ChangesetSequencer.make_key(None).get()
+    self.assertEqual(8, sequencer.next_num)
+    self.assertEqual(4, sequencer.head_num)
+
+    # Changesets are their own entity groups, and pointers and file versions
+    # are grouped by the hash of their path.
+    self.assertIsNone(final_changeset.changeset_ent.key.parent())
+    file_pointer = versions._FilePointer.make_key('/foo', namespace=None).get()
+    self.assertEqual(1, file_pointer.changeset_num)
+    file_versions = self.vcs.get_file_versions('/foo')
+    self.assertEqual([4], [v.changeset.num for v in file_versions])
+    self.assertEqual(FILE_CREATED, file_versions[0].status)
+    self.assertEqual('foo', files.File('/foo').content)
+    self.assertEqual(final_changeset, files.File('/foo').changeset)
+
+  def testLegacyEntityGroups(self):
+    # Setup a namespace as committed before changesets, pointers and file
+    # versions were split into many entity groups.
+    strong_counters.StrongCounter(
+        id=versions._CHANGESET_COUNTER_NAME, count=2).put()
+    root_changeset = versions._Changeset.get_root_key(namespace=None)
+    staging_key = ndb.Key(versions._Changeset, '1', parent=root_changeset)
+    final_key = ndb.Key(versions._Changeset, '2', parent=root_changeset)
+    ndb.put_multi([
+        versions._Changeset(
+            key=staging_key, num=1, status=CHANGESET_DELETED_BY_SUBMIT,
+            linked_changeset=final_key),
+        versions._Changeset(
+            key=final_key, num=2, status=CHANGESET_SUBMITTED,
+            linked_changeset=staging_key),
+        versions._FileVersion(
+            id='2:/foo', parent=final_key, path='/foo', changeset_num=2,
+            status=FILE_CREATED),
+        versions._FilePointer(
+            id='/foo', parent=versions._FilePointer.get_root_key(None),
+            changeset_num=1),
+    ])
+    files.File('/_titan/ver/1/foo', _from_factory=True).write('foo')
+
+    # Legacy changesets and pointers are still read.
+    self.assertEqual(2, self.vcs.get_last_submitted_changeset().num)
+    self.assertEqual('foo', files.File('/foo').content)
+    self.assertEqual(versions.Changeset(2), files.File('/foo').changeset)
+    titan_files = files.Files(['/foo']).load()
+    self.assertEqual('foo', titan_files['/foo'].content)
+
+    # Numbering continues from the legacy counter, and committing moves the
+    # file's pointer out of the legacy entity group.
+    changeset = self.vcs.new_staging_changeset()
+    self.assertEqual(3, changeset.num)
+    self.assertEqual(versions.Changeset(2), changeset.base_changeset)
+    files.File('/foo', changeset=changeset).write('foo2')
+    changeset.finalize_associated_files()
+    final_changeset = self.vcs.commit(changeset, save_manifest=False)
+    self.assertEqual(4, final_changeset.num)
+    self.assertIsNone(ndb.Key(
+        versions._FilePointer, '/foo',
+        parent=versions._FilePointer.get_root_key(None)).get())
+    self.assertEqual('foo2', files.File('/foo').content)
+    file_versions = self.vcs.get_file_versions('/foo')
+    self.assertEqual([4, 2], [v.changeset.num for v in file_versions])
+    self.assertEqual(FILE_EDITED, file_versions[0].status)
+    self.assertEqual(FILE_CREATED, file_versions[1].status)
+
   def testCommitManyFiles(self):
     # Regression test for "operating on too many entity groups in a
     # single transaction" error. This usually happens through the HTTP API
@@ -430,6 +601,33 @@ class VersionsTest(testing.BaseTestCase):
         changeset=changeset, dir_path='/b', recursive=True)
     self.assertSameElements(['/b/foo'], paths_to_changeset_num.keys())
 
+    # Manifest shards hold ranges of sorted paths, so listing a dir only reads
+    # the shards which overlap with its subtree.
+    self.stubs.SmartSet(versions, '_MAX_MANIFEST_SHARD_PATHS', 1)
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/b/bar', changeset=changeset).write('')
+    changeset.finalize_associated_files()
+    changeset = self.vcs.commit(changeset)  # Changeset 4.
+    self.assertEqual(
+        ['/', '/a/bar', '/a/foo', '/b/bar', '/b/foo', '/foo'],
+        changeset.changeset_ent.manifest_shard_start_paths)
+    self.assertEqual(3, len(changeset._get_manifest_shard_keys_for_dir('/b/')))
+    self.assertEqual(6, len(changeset._get_manifest_shard_keys_for_dir('/')))
+    paths_to_changeset_num = versions._list_manifested_paths(
+        changeset=changeset, dir_path='/b', recursive=True)
+    self.assertEqual({'/b/bar': 4, '/b/foo': 2}, paths_to_changeset_num)
+
+    # Only changed shards are written again.
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/a/a/foo', changeset=changeset).delete()
+    changeset.finalize_associated_files()
+    changeset = self.vcs.commit(changeset)  # Changeset 6.
+    self.assertEqual(
+        [6, 4, 4, 4, 4, 4], changeset._manifest_shard_changeset_nums)
+    paths_to_changeset_num = versions._list_manifested_paths(
+        changeset=changeset, dir_path='/a', recursive=True)
+    self.assertSameElements(['/a/foo', '/a/bar'], paths_to_changeset_num.keys())
+
   def testListDirectories(self):
     changeset = self.vcs.new_staging_changeset()
     files.File('/foo', changeset=changeset).write('')
@@ -636,8 +834,8 @@ class VersionsTest(testing.BaseTestCase):
     self.assertEqual(4, changeset._num_manifest_shards)
     # Verify that hash is evenly distributing the paths over the shards by
     # verifying the shards are not nearly full to 1000 paths.
-    manifest_shard = changeset._get_manifest_shard_ent('/foo0')
-    self.assertLess(900, len(manifest_shard.paths_to_changeset_num))
+    manifest_shard = changeset._get_manifest_shard('/foo0')
+    self.assertGreater(900, len(manifest_shard))
 
     # Rebase the staging changeset and verify the new manifest files.
     changeset = versions.Changeset(5)  # 'staging'
@@ -656,6 +854,41 @@ class VersionsTest(testing.BaseTestCase):
         versions.NamespaceMismatchError, changeset.rebase,
         versions.Changeset(7, namespace='aaa'))
 
+    # Cannot commit until rebased to the head, also when another commit lands
+    # after the check outside of the commit transaction.
+    self.assertRaises(
+        versions.InvalidBaseChangesetCommitError, self.vcs.commit, changeset,
+        force=True)
+    self.stubs.Set(
+        versions, '_get_changeset_sequencer',
+        lambda namespace: versions._ChangesetSequencer(next_num=10, head_num=7))
+    self.assertRaises(
+        versions.InvalidBaseChangesetCommitError, self.vcs.commit, changeset,
+        force=True)
+    self.stubs.UnsetAll()
+    self.assertEqual(versions.ChangesetStatus.staging, changeset.status)
+
+    # Changeset 10 and 11: only the manifest shards with changed paths are
+    # written, the others are shared with the base changeset.
+    changeset = self.vcs.new_staging_changeset()
+    files.File('/foo1', changeset=changeset).write('foo1')  # Shard 0.
+    files.File('/bar', changeset=changeset).delete()  # Shard 0.
+    changeset.finalize_associated_files()
+    changeset = self.vcs.commit(changeset)
+    self.assertEqual(11, changeset.num)
+    self.assertEqual(4, changeset._num_manifest_shards)
+    self.assertEqual([11, 9, 9, 9], changeset._manifest_shard_changeset_nums)
+    self.assertEqual('foo1', files.File('/foo1', changeset=changeset).content)
+    self.assertEqual('NEWfoo', files.File('/foo', changeset=changeset).content)
+    self.assertFalse(files.File('/bar', changeset=changeset).exists)
+    self.assertTrue(files.File('/foo5', changeset=changeset).exists)  # Shard 3.
+    titan_files = changeset.list_files(
+        '/', recursive=True, include_deleted=False, include_manifested=True)
+    self.assertEqual(3201, len(titan_files))
+    self.assertEqual(
+        3202, len(versions.Changeset(9).list_files(
+            '/', recursive=True, include_manifested=True)))
+
   def make_namespaced_testdata(self):
     meta = {'color': 'blue'}
 
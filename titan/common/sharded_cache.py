@@ -20,10 +20,16 @@ be read into app memory often, but can't be cached due to size limits.
 
 This module should not be used with very large objects, keeping in mind the
 32 MB limit of memcache.set_multi.
+
+Each Set() of a sharded value writes its content shards under keys tagged with
+a new generation token, which is stored in the shard map. A read therefore
+never stitches together shards written by two racing Set() calls; it either
+finds all shards of the generation in the shard map, or treats it as a miss.
 """
 
 import cPickle as pickle
 import logging
+import random
 from google.appengine.api import memcache
 
 # Pseudo namespace for memcache values.
@@ -41,70 +47,100 @@ DEFAULT_EXPIRATION_SECONDS = 24 * 60 * 60  # 1 day
 # max number of bytes of the pickled shard_map dict (without content).
 MIN_SHARDING_SIZE = memcache.MAX_VALUE_SIZE - 1000  # 999 KB
 
+# Max total size of the values in a single memcache.set_multi call.
+MAX_SET_MULTI_SIZE = 32 * memcache.MAX_VALUE_SIZE
+
 def Get(key):
   """Get a memcache entry, or None."""
-  key = MEMCACHE_PREFIX + key
-  shard_map = memcache.get(key)
-  if not shard_map:
-    # The shard_map was evicted or never set.
-    return
-
-  # If zero shards, the content was small enough and stored in the shard_map.
-  num_shards = shard_map['num_shards']
-  if num_shards == 0:
-    return pickle.loads(shard_map['content'])
-
-  keys = ['%s%d' % (key, i) for i in range(num_shards)]
-  shards = memcache.get_multi(keys)
-  if len(shards) != num_shards:
-    # One or more content shards were evicted, delete map and content shards.
-    memcache.delete_multi([key] + keys)
-    return
-
-  # All shards present, stitch contents back together and unpickle.
-  shards = tuple([shards[key] for key in keys])
-  value = '%s' * shard_map['num_shards']
-  value = pickle.loads(value % shards)
-  return value
+  return GetMulti([key]).get(key)
+
+def GetMulti(keys):
+  """Get many memcache entries with at most two memcache round trips.
+
+  Args:
+    keys: An iterable of keys.
+  Returns:
+    A dictionary mapping the keys which were found to their values.
+  """
+  memcache_keys = dict((MEMCACHE_PREFIX + key, key) for key in keys)
+  shard_maps = memcache.get_multi(memcache_keys.keys())
+
+  values = {}
+  sharded_keys = {}
+  for memcache_key, shard_map in shard_maps.iteritems():
+    # If zero shards, the content was small enough and stored in the shard_map.
+    if shard_map['num_shards'] == 0:
+      values[memcache_keys[memcache_key]] = _LoadValue(
+          shard_map, shard_map['content'])
+    else:
+      sharded_keys[memcache_key] = (
+          shard_map, _GetShardKeys(memcache_key, shard_map))
+  if not sharded_keys:
+    return values
+
+  # Fetch the content shards of all sharded values at once.
+  all_shard_keys = []
+  for _, shard_keys in sharded_keys.itervalues():
+    all_shard_keys.extend(shard_keys)
+  shards = memcache.get_multi(all_shard_keys)
+
+  keys_to_delete = []
+  for memcache_key, (shard_map, shard_keys) in sharded_keys.iteritems():
+    if not all(shard_key in shards for shard_key in shard_keys):
+      # One or more content shards of this generation were evicted (or
+      # overwritten by a concurrent Set), delete map and content shards.
+      keys_to_delete.append(memcache_key)
+      keys_to_delete.extend(shard_keys)
+      continue
+    # All shards present, stitch contents back together with a single copy.
+    data = ''.join([shards[shard_key] for shard_key in shard_keys])
+    values[memcache_keys[memcache_key]] = _LoadValue(shard_map, data)
+  if keys_to_delete:
+    memcache.delete_multi(keys_to_delete)
+  return values
 
 def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS):
   """Set a memcache entry."""
-  key = MEMCACHE_PREFIX + key
-  value = pickle.dumps(value)
-
-  # The original key is used as the shard map.
-  # The content shards are stored as '<key>0', '<key>1', etc.
-  num_shards = (len(value) / memcache.MAX_VALUE_SIZE) + 1
-  content_map = {}
-  content_map[key] = {'num_shards': num_shards}
-  for i in range(num_shards):
-    # [0:1MB] first, [1MB:2MB] second, etc.
-    begin_slice = i * memcache.MAX_VALUE_SIZE
-    end_slice = begin_slice + memcache.MAX_VALUE_SIZE
-    content_map[key + str(i)] = value[begin_slice:end_slice]
+  return SetMulti({key: value}, time=time)
+
+def SetMulti(mapping, time=DEFAULT_EXPIRATION_SECONDS):
+  """Set many memcache entries, batching them into few set_multi calls.
+
+  Args:
+    mapping: A dictionary mapping keys to values.
+    time: The expiration time of the entries, in seconds.
+  Returns:
+    False if setting any of the entries failed and its partially-set shards
+    could not be cleaned up, True otherwise.
+  """
+  # Batches of memcache entries, each small enough for one set_multi call.
+  # Entries for a single key are never split across batches.
+  batches = [{}]
+  batch_size = 0
+  for key, value in mapping.iteritems():
+    content_map, content_size = _MakeContentMap(MEMCACHE_PREFIX + key, value)
+    if batches[-1] and batch_size + content_size > MAX_SET_MULTI_SIZE:
+      batches.append({})
+      batch_size = 0
+    batches[-1].update(content_map)
+    batch_size += content_size
 
-  # Optimization: for small content, store the content in the shard_map
-  # dictionary directly instead of actually sharding.
-  if num_shards == 1 and len(value) < MIN_SHARDING_SIZE:
-    content_map[key]['num_shards'] = num_shards = 0
-    content_map[key]['content'] = value
-    del content_map[key + '0']
-
-  # Set the shard map and all content shards.
   is_successful = True
-  failed_keys = memcache.set_multi(content_map, time=time)
-  if failed_keys:
-    is_successful = False
+  for content_map in batches:
+    if not content_map:
+      continue
+    failed_keys = memcache.set_multi(content_map, time=time)
+    if not failed_keys:
+      continue
     logging.error('Sharded cache set_multi failed. '
                   'Attempting to delete keys...\n %r', failed_keys)
-    # Failed. Delete the sharp_map and any keys which succeeded.
+    # Failed. Delete the shard maps and any keys which succeeded.
     delete_result = memcache.delete_multi(content_map.keys())
-    if delete_result:
+    if not delete_result:
+      is_successful = False
       logging.error('Sharded cache delete_multi failed! '
                     'Some keys may still remain and contaminate the cache.')
-    else:
-      # If the set_mutli failed but was cleaned up correctly, mark successful.
-      is_successful = True
+    # If the set_multi failed but was cleaned up correctly, it is successful.
   return is_successful
 
 def Delete(key, seconds=0):
@@ -114,5 +150,65 @@ def Delete(key, seconds=0):
   if not shard_map:
     # The shard_map was evicted or never set.
     return memcache.DELETE_ITEM_MISSING
-  keys = [key] + ['%s%d' % (key, i) for i in range(shard_map['num_shards'])]
+  keys = [key] + _GetShardKeys(key, shard_map)
   return memcache.delete_multi(keys, seconds=seconds)
+
+def DeleteMulti(keys, seconds=0):
+  """Delete many memcache entries with two memcache round trips.
+
+  Args:
+    keys: An iterable of keys.
+    seconds: Optional number of seconds to lock the keys from being added.
+  Returns:
+    True if all existing entries were deleted, False otherwise.
+  """
+  memcache_keys = [MEMCACHE_PREFIX + key for key in keys]
+  shard_maps = memcache.get_multi(memcache_keys)
+  if not shard_maps:
+    # The shard_maps were evicted or never set.
+    return True
+  keys_to_delete = []
+  for memcache_key, shard_map in shard_maps.iteritems():
+    keys_to_delete.append(memcache_key)
+    keys_to_delete.extend(_GetShardKeys(memcache_key, shard_map))
+  return memcache.delete_multi(keys_to_delete, seconds=seconds)
+
+def _MakeContentMap(key, value):
+  """Returns the memcache entries for a value, and the value's stored size."""
+  # Optimization: byte strings are stored as-is, without pickling.
+  is_pickled = not isinstance(value, str)
+  data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL) if is_pickled else value
+  shard_map = {'pickled': is_pickled}
+  content_map = {key: shard_map}
+
+  # Optimization: for small content, store the content in the shard_map
+  # dictionary directly instead of actually sharding.
+  if len(data) < MIN_SHARDING_SIZE:
+    shard_map['num_shards'] = 0
+    shard_map['content'] = data
+    return content_map, len(data)
+
+  # The original key is used as the shard map. The content shards are stored
+  # as '<key>:<generation>:0', '<key>:<generation>:1', etc.
+  max_value_size = memcache.MAX_VALUE_SIZE
+  shard_map['num_shards'] = (len(data) + max_value_size - 1) / max_value_size
+  shard_map['generation'] = '%08x' % random.getrandbits(32)
+  for i, shard_key in enumerate(_GetShardKeys(key, shard_map)):
+    # [0:1MB] first, [1MB:2MB] second, etc.
+    content_map[shard_key] = data[i * max_value_size:(i + 1) * max_value_size]
+  return content_map, len(data)
+
+def _GetShardKeys(key, shard_map):
+  """Returns the memcache keys of the content shards of a shard map."""
+  generation = shard_map.get('generation')
+  if generation is None:
+    # Backwards-compatibility with shard maps set before generations existed.
+    return ['%s%d' % (key, i) for i in range(shard_map['num_shards'])]
+  return ['%s:%s:%d' % (key, generation, i)
+          for i in range(shard_map['num_shards'])]
+
+def _LoadValue(shard_map, data):
+  # Backwards-compatibility: shard maps without "pickled" are always pickled.
+  if shard_map.get('pickled', True):
+    return pickle.loads(data)
+  return data
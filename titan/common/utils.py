@@ -15,7 +15,6 @@
 
 """Common utility functions."""
 
-import cStringIO
 import datetime
 import errno
 import functools
@@ -291,19 +290,54 @@ def write_to_blobstore(content, old_blobinfo=None):
     return old_blobinfo.key()
 
   # write new blob.
-  filename = blobstore_files.blobstore.create()
-  content_file = cStringIO.StringIO(content)
-  blobstore_file = blobstore_files.open(filename, 'a')
-  # Blobstore writes cannot exceed an RPC size limit, so chunk the writes.
-  while True:
-    content_chunk = content_file.read(BLOBSTORE_APPEND_CHUNK_SIZE)
-    if not content_chunk:
-      break
-    blobstore_file.write(content_chunk)
-  blobstore_file.close()
-  blobstore_files.finalize(filename)
-  blob_key = blobstore_files.blobstore.get_blob_key(filename)
-  return blob_key
+  blobstore_writer = BlobstoreWriter()
+  blobstore_writer.write(content)
+  return blobstore_writer.close()
+
+class BlobstoreWriter(object):
+  """Streams content to a new blob, tracking its md5 hash and size.
+
+  Usage:
+    blobstore_writer = utils.BlobstoreWriter()
+    for chunk in chunks:
+      blobstore_writer.write(chunk)
+    blob_key = blobstore_writer.close()
+  Attributes:
+    md5_hash: The hex md5 hash of the content written so far.
+    size: The number of bytes written so far.
+  """
+
+  def __init__(self, mime_type=None):
+    if mime_type:
+      self._filename = blobstore_files.blobstore.create(mime_type=mime_type)
+    else:
+      self._filename = blobstore_files.blobstore.create()
+    self._blobstore_file = blobstore_files.open(self._filename, 'a')
+    self._md5 = hashlib.md5()
+    self.size = 0
+
+  @property
+  def md5_hash(self):
+    return self._md5.hexdigest()
+
+  def write(self, content):
+    """Appends a byte-string to the blob."""
+    assert not isinstance(content, unicode)
+    # Blobstore writes cannot exceed an RPC size limit, so chunk the writes.
+    for i in xrange(0, len(content), BLOBSTORE_APPEND_CHUNK_SIZE):
+      self._blobstore_file.write(content[i:i + BLOBSTORE_APPEND_CHUNK_SIZE])
+    self._md5.update(content)
+    self.size += len(content)
+
+  def close(self):
+    """Finalizes the blob.
+
+    Returns:
+      The BlobKey of the new blob.
+    """
+    self._blobstore_file.close()
+    blobstore_files.finalize(self._filename)
+    return blobstore_files.blobstore.get_blob_key(self._filename)
 
 def run_with_backoff(func, runtime=60, min_backoff=1, max_backoff=10,
                    expontential_backoff=True, stop_on_success=False, **kwargs):
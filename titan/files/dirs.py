@@ -16,21 +16,51 @@
 import collections
 import datetime
 import json
+import logging
 import os
+import random
+import threading
 import time
+import zlib
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from titan import files
+from titan import tasks
 from titan.common import utils
 
 WINDOW_SIZE_SECONDS = 10
 TASKQUEUE_NAME = 'titan-dirs'
 TASKQUEUE_LEASE_SECONDS = 3 * WINDOW_SIZE_SECONDS  # 30 second leasing buffer.
 TASKQUEUE_LEASE_MAX_TASKS = 1000
+# Max number of tasks to lease for processing in one window.
+TASKQUEUE_MAX_WINDOW_TASKS = 5 * TASKQUEUE_LEASE_MAX_TASKS
+# Max number of task leases extended before processing a group of namespaces.
+# Leases are extended one RPC at a time, so larger groups are left to expire
+# and be leased again by a later window.
+TASKQUEUE_MAX_LEASE_EXTENSIONS = 100
+# Number of shards of namespaces, which may each have a separate consumer:
+#   /_titan/dirs/processdata?shard=0, /_titan/dirs/processdata?shard=1, ...
+# Tasks of all shards are still consumed if the shard param is not given.
+TASKQUEUE_NUM_SHARDS = 1
+# Max number of namespaces whose dirs are updated in parallel.
+MAX_CONCURRENT_NAMESPACES = 50
 TASKQUEUE_LEASE_ETA_BUFFER = TASKQUEUE_LEASE_SECONDS
 DEFAULT_CRON_RUNTIME_SECONDS = 60
 INITIALIZER_BATCH_SIZE = 100
 INITIALIZER_NUM_BATCHES = 50
+# Number of shards of each directory's file and subdir counters.
+NUM_COUNTER_SHARDS = 10
+# Seconds that an instance keeps its own record of an available directory.
+# Records of all tiers are only trusted at the current generation in memcache.
+DIR_CACHE_LOCAL_TTL_SECONDS = 10
+DIR_CACHE_MEMCACHE_TTL_SECONDS = 60 * 60
+DIR_CACHE_LOCAL_MAX_PATHS = 10000
+
+_DIR_MEMCACHE_PREFIX = 'titan-dir:'
+# Cannot collide with dir paths, which always start with a slash.
+_DIR_GENERATION_KEY = 'generation'
 
 _STATUS_AVAILABLE = 1
 _STATUS_DELETED = 2
@@ -55,98 +85,144 @@ class DirManagerMixin(files.File):
 
   def write(self, *args, **kwargs):
     async = kwargs.pop('_dir_manager_async', True)
+    batch = kwargs.get('_batch')
+    # The file is loaded by the write anyway, so this costs no extra RPC.
+    created = not self.exists
     result = super(DirManagerMixin, self).write(*args, **kwargs)
+    modified_path = self._make_modified_path(created=created)
+    if batch is not None:
+      # Update all parent dirs of the batch at once after it is committed.
+      batch.add_hook_item(
+          'dirs:update_titan_dirs', _update_titan_dirs_for_batch,
+          modified_path)
+      return result
     # Update parent dirs synchronously (the actual directory update RPC is
     # asynchronous, to effectively ignore write contention issues which will
     # rarely occur when many parent dirs don't exist and a large set of files
     # with common parent parents are concurrently created).
-    self.update_titan_dirs(async=async)
+    _update_titan_dirs([modified_path], async=async)
     return result
 
   def delete(self, *args, **kwargs):
+    # Only files which actually existed are uncounted from their dir.
+    deleted = self.exists
     result = super(DirManagerMixin, self).delete(*args, **kwargs)
     # Update dirs eventually.
-    self.add_titan_dir_delete_task()
+    self.add_titan_dir_delete_task(deleted=deleted)
     return result
 
   def update_titan_dirs(self, async=True):
     """Updates parent path directories to make sure they exist."""
-    modified_path = ModifiedPath(
+    _update_titan_dirs([self._make_modified_path()], async=async)
+
+  def _make_modified_path(self, created=False):
+    return ModifiedPath(
         path=self.real_path,
         namespace=self.namespace,
         modified=time.time(),
         action=_STATUS_AVAILABLE,
+        created=created,
     )
-    dir_service = DirService()
-    affected_dirs_kwargs = dir_service.compute_affected_dirs([modified_path])
 
-    # Evil, but really really convenient. If in test or dev_appserver, just
-    # update the directory entities synchronously with the request.
-    server_software = os.environ.get('SERVER_SOFTWARE', '')
-    if server_software.lower().startswith(('dev', 'test')):
-      async = False
+  def add_titan_dir_delete_task(self, deleted=True):
+    """Add a task to the pull queue about which path was deleted.
 
-    affected_dirs_kwargs['async'] = async
-    dir_service.update_affected_dirs(**affected_dirs_kwargs)
-
-  def add_titan_dir_delete_task(self):
-    """Add a task to the pull queue about which path was deleted."""
-    now = time.time()
-    window = _get_window(now)
-    path_data = {
-        'path': self.path,
-        'namespace': self.namespace,
-        'modified': now,
-        'action': _STATUS_DELETED,
-    }
-    # Important: unlock tasks in the same window at the same time, and
-    # after the window itself has passed.
-    current_task_eta = datetime.datetime.utcfromtimestamp(
-        window + TASKQUEUE_LEASE_ETA_BUFFER)
-    task = taskqueue.Task(
-        method='PULL',
-        payload=json.dumps(path_data),
-        tag=str(window),
-        eta=current_task_eta)
-    task.add(queue_name=TASKQUEUE_NAME)
-
-    # Evil, but really really convenient. If in test or dev_appserver, just
-    # update the directory entities synchronously with the request.
-    server_software = os.environ.get('SERVER_SOFTWARE', '')
-    if server_software.lower().startswith(('dev', 'test')):
-      dir_task_consumer = DirTaskConsumer()
-      dir_task_consumer.process_next_window()
+    Args:
+      deleted: Whether a file existed at the path and was deleted, as opposed
+          to a delete of a non-existent path.
+    """
+    modified_path = ModifiedPath(
+        path=self.path,
+        namespace=self.namespace,
+        modified=time.time(),
+        action=_STATUS_DELETED,
+        deleted=deleted,
+    )
+    _make_dir_task(modified_path).add(queue_name=TASKQUEUE_NAME)
+    _maybe_process_dir_tasks()
+
+def _update_titan_dirs(modified_paths, async=True):
+  """Updates parent dirs of the given ModifiedPaths to make sure they exist."""
+  # New files are counted in batch by DirTaskConsumer, so the request only
+  # adds pull tasks for them, in parallel with the directory updates.
+  created_paths = [modified_path for modified_path in modified_paths
+                   if modified_path.created]
+  queue = taskqueue.Queue(TASKQUEUE_NAME)
+  add_rpcs = [
+      queue.add_async([_make_dir_task(path) for path in paths])
+      for paths in utils.chunk_generator(created_paths, chunk_size=100)]
+
+  dir_service = DirService()
+  affected_dirs_kwargs = dir_service.compute_affected_dirs(modified_paths)
+
+  # Skip the dirs which are known to exist. Writes into existing trees then
+  # need no directory RPCs.
+  affected_dirs_kwargs['dirs_with_adds'] -= _dir_cache.get_available(
+      affected_dirs_kwargs['dirs_with_adds'],
+      namespace=affected_dirs_kwargs['namespace'])
+
+  # Evil, but really really convenient. If in test or dev_appserver, just
+  # update the directory entities synchronously with the request.
+  server_software = os.environ.get('SERVER_SOFTWARE', '')
+  if server_software.lower().startswith(('dev', 'test')):
+    async = False
+
+  affected_dirs_kwargs['async'] = async
+  affected_dirs_kwargs['update_counts'] = False
+  dir_service.update_affected_dirs(**affected_dirs_kwargs)
+  for add_rpc in add_rpcs:
+    add_rpc.get_result()
+  if created_paths:
+    _maybe_process_dir_tasks()
+
+def _update_titan_dirs_for_batch(modified_paths):
+  """files._WriteBatch hook to update the parent dirs of all written files."""
+  _update_titan_dirs(modified_paths, async=True)
 
 class DirTaskConsumer(object):
-  """Service which consumes and processes path-modification tasks."""
+  """Service which consumes and processes path-modification tasks.
+
+  Tasks are grouped by namespace and the namespaces are processed in
+  parallel. If TASKQUEUE_NUM_SHARDS is greater than one, each shard of
+  namespaces can be consumed by a separate consumer.
+  """
+
+  def __init__(self, shard=None):
+    """Constructor.
+
+    Args:
+      shard: The shard of tasks to consume, from 0 to TASKQUEUE_NUM_SHARDS - 1.
+          If not given, tasks of all shards are consumed.
+    Raises:
+      ValueError: If given an invalid shard.
+    """
+    if shard is not None and not 0 <= shard < TASKQUEUE_NUM_SHARDS:
+      raise ValueError('Invalid shard: %r' % shard)
+    self.shard = shard
 
   def process_next_window(self):
     """Lease one window-worth of tasks and update the corresponding dirs.
 
+    If the leases run low and the next group of namespaces has more than
+    TASKQUEUE_MAX_LEASE_EXTENSIONS tasks, the rest of the window is left to
+    be leased again by a later window.
+
+    Raises:
+      Any error raised while updating the dirs of a namespace, after the
+      tasks of all other namespaces have been processed.
     Returns:
       A list of ModifiedPaths.
     """
     queue = taskqueue.Queue(TASKQUEUE_NAME)
-    # Don't specify a tag; this pulls the oldest tasks of the same tag.
-    tasks = queue.lease_tasks_by_tag(lease_seconds=TASKQUEUE_LEASE_SECONDS,
-                                     max_tasks=TASKQUEUE_LEASE_MAX_TASKS)
+    tasks, lease_expires = self._lease_tasks(queue)
     if not tasks:
       return {}
 
-    # Keep leasing similar tasks if we hit the per-request leasing max.
-    have_all_tasks = True if len(tasks) < TASKQUEUE_LEASE_MAX_TASKS else False
-    while not have_all_tasks:
-      tasks_in_window = queue.lease_tasks_by_tag(
-          lease_seconds=TASKQUEUE_LEASE_SECONDS,
-          max_tasks=TASKQUEUE_LEASE_MAX_TASKS,
-          tag=tasks[0].tag)
-      tasks.extend(tasks_in_window)
-      if len(tasks_in_window) < TASKQUEUE_LEASE_MAX_TASKS:
-        have_all_tasks = True
-
-    # Package each task's data into a ModifiedPath and pass it on.
-    # Don't deal with ordering or chronologically collapsing paths here.
-    modified_paths = []
+    # Package each task's data into a ModifiedPath and group them by
+    # namespace. Don't deal with ordering or chronologically collapsing paths
+    # here.
+    tasks_by_namespace = collections.defaultdict(list)
+    modified_paths_by_namespace = collections.defaultdict(list)
     for task in tasks:
       path_data = json.loads(task.payload)
       modified_path = ModifiedPath(
@@ -154,18 +230,96 @@ class DirTaskConsumer(object):
           namespace=path_data['namespace'],
           modified=path_data['modified'],
           action=path_data['action'],
+          created=path_data.get('created', False),
+          deleted=path_data.get('deleted', True),
       )
-      modified_paths.append(modified_path)
+      tasks_by_namespace[modified_path.namespace].append(task)
+      modified_paths_by_namespace[modified_path.namespace].append(
+          modified_path)
 
-    # Compute the affected directories and then update them if needed.
-    dir_service = DirService()
-    affected_dirs = dir_service.compute_affected_dirs(modified_paths)
-    dir_service.update_affected_dirs(**affected_dirs)
+    # Update the dirs of many namespaces at once. Tasks are deleted as soon as
+    # their namespace is done, so an error in one namespace only leaves its own
+    # tasks to be leased again.
+    modified_paths = []
+    errors = []
+    namespaces = modified_paths_by_namespace.keys()
+    for i in range(0, len(namespaces), MAX_CONCURRENT_NAMESPACES):
+      namespaces_chunk = namespaces[i:i + MAX_CONCURRENT_NAMESPACES]
+      if lease_expires - time.time() < TASKQUEUE_LEASE_SECONDS / 2.0:
+        # Only extend the leases of the tasks about to be processed.
+        chunk_tasks = [task for namespace in namespaces_chunk
+                       for task in tasks_by_namespace[namespace]]
+        if len(chunk_tasks) > TASKQUEUE_MAX_LEASE_EXTENSIONS:
+          logging.info('Leaving dir tasks of %d namespaces to a later window.',
+                       len(namespaces) - i)
+          break
+        for task in chunk_tasks:
+          queue.modify_task_lease(task, TASKQUEUE_LEASE_SECONDS)
+      futures = [self._process_namespace_async(
+          modified_paths_by_namespace[namespace])
+                 for namespace in namespaces_chunk]
+      ndb.Future.wait_all(futures)
+
+      finished_tasks = []
+      for namespace, future in zip(namespaces_chunk, futures):
+        namespace_tasks = tasks_by_namespace[namespace]
+        if future.get_exception():
+          logging.error('Error updating dirs in namespace %r: %r',
+                        namespace, future.get_exception())
+          errors.append(future.get_exception())
+        else:
+          finished_tasks.extend(namespace_tasks)
+          modified_paths.extend(modified_paths_by_namespace[namespace])
+      for tasks_to_delete in utils.chunk_generator(finished_tasks):
+        queue.delete_tasks(tasks_to_delete)
+
+    if errors:
+      raise errors[0]
+    return modified_paths
 
-    for tasks_to_delete in utils.chunk_generator(tasks):
-      queue.delete_tasks(tasks_to_delete)
+  def _lease_tasks(self, queue):
+    """Leases the oldest window of tasks of this consumer's shard.
 
-    return modified_paths
+    Args:
+      queue: The taskqueue.Queue to lease from.
+    Returns:
+      A two-tuple of the list of leased tasks and the unix time at which the
+      earliest lease expires.
+    """
+    lease_expires = time.time() + TASKQUEUE_LEASE_SECONDS
+    if self.shard is None:
+      # Don't specify a tag; this pulls the oldest tasks of the same tag.
+      tag = None
+    else:
+      tag = _make_shard_tag(self.shard)
+    tasks = queue.lease_tasks_by_tag(lease_seconds=TASKQUEUE_LEASE_SECONDS,
+                                     max_tasks=TASKQUEUE_LEASE_MAX_TASKS,
+                                     tag=tag)
+    if not tasks:
+      return [], lease_expires
+
+    # Keep leasing similar tasks if we hit the per-request leasing max, while
+    # at least half of the first lease is left.
+    have_all_tasks = True if len(tasks) < TASKQUEUE_LEASE_MAX_TASKS else False
+    while (not have_all_tasks and len(tasks) < TASKQUEUE_MAX_WINDOW_TASKS
+           and lease_expires - time.time() > TASKQUEUE_LEASE_SECONDS / 2.0):
+      tasks_in_window = queue.lease_tasks_by_tag(
+          lease_seconds=TASKQUEUE_LEASE_SECONDS,
+          max_tasks=TASKQUEUE_LEASE_MAX_TASKS,
+          tag=tasks[0].tag)
+      tasks.extend(tasks_in_window)
+      if len(tasks_in_window) < TASKQUEUE_LEASE_MAX_TASKS:
+        have_all_tasks = True
+    return tasks, lease_expires
+
+  @ndb.tasklet
+  def _process_namespace_async(self, modified_paths):
+    """Updates the dirs affected by the ModifiedPaths of one namespace."""
+    dir_service = DirService()
+    affected_dirs = dir_service.compute_affected_dirs(modified_paths)
+    affected_dirs['file_count_deltas'] = (
+        dir_service.compute_file_count_deltas(modified_paths))
+    yield dir_service.update_affected_dirs_async(**affected_dirs)
 
   def process_windows_with_backoff(self, runtime=DEFAULT_CRON_RUNTIME_SECONDS):
     """Long-running function to process multiple windows.
@@ -187,7 +341,8 @@ class ModifiedPath(object):
   WRITE = 1
   DELETE = 2
 
-  def __init__(self, path, namespace, modified, action):
+  def __init__(self, path, namespace, modified, action, created=False,
+               deleted=True):
     """Constructor.
 
     Args:
@@ -195,12 +350,16 @@ class ModifiedPath(object):
       namespace: The namespace of the modified file.
       modified: Unix timestamp float.
       action: One of ModifiedPath.WRITE or ModifiedPath.DELETE.
+      created: For writes, whether the file did not exist before.
+      deleted: For deletes, whether the file existed before.
     """
     Dir.validate_path(path, namespace=namespace)
     self.path = path
     self.namespace = namespace
     self.modified = modified
     self.action = action
+    self.created = created
+    self.deleted = deleted
 
   def serialize(self):
     results = {
@@ -208,6 +367,8 @@ class ModifiedPath(object):
         'namespace': self.namespace,
         'modified': self.modified,
         'action': self.action,
+        'created': self.created,
+        'deleted': self.deleted,
     }
     return results
 
@@ -264,51 +425,139 @@ class DirService(object):
     }
     return affected_dirs
 
-  @ndb.toplevel
+  def compute_file_count_deltas(self, modified_paths):
+    """Compute how the number of files directly in each dir has changed.
+
+    Unlike compute_affected_dirs, modifications of the same path are not
+    merged, since each one created or deleted a file. Only writes which
+    created a file and deletes which deleted one change the counts.
+
+    Args:
+      modified_paths: A list of ModifiedPath objects.
+    Returns:
+      A dictionary mapping dir paths to the non-zero change in their number
+      of files.
+    """
+    file_count_deltas = collections.defaultdict(int)
+    for modified_path in modified_paths:
+      dir_path = os.path.dirname(modified_path.path)
+      if modified_path.action == ModifiedPath.DELETE:
+        if modified_path.deleted:
+          file_count_deltas[dir_path] -= 1
+      elif modified_path.created:
+        file_count_deltas[dir_path] += 1
+    # Ignore root dir; it has no directory entity to be counted with.
+    file_count_deltas.pop('/', None)
+    return dict((path, delta) for path, delta in file_count_deltas.iteritems()
+                if delta)
+
   def update_affected_dirs(self, dirs_with_adds, dirs_with_deletes,
-                           namespace=None, async=False):
-    """Manage changes to _TitanDir entities computed by compute_affected_dirs."""
+                           namespace=None, async=False,
+                           file_count_deltas=None, update_counts=True):
+    """Manage changes to _TitanDir entities computed by compute_affected_dirs.
+
+    Args:
+      dirs_with_adds: A set of dir paths which had files written.
+      dirs_with_deletes: A set of dir paths which had files deleted.
+      namespace: The filesystem namespace.
+      async: Whether to put the changed dir entities in parallel with the
+          counter updates, instead of before them.
+      file_count_deltas: A dictionary from compute_file_count_deltas, used
+          to update the file counters of each dir.
+      update_counts: Whether to count dirs which become available or deleted
+          in the subdir counters of their parents. Writes leave this to
+          DirTaskConsumer, which gets a task for each created file.
+    """
+    self.update_affected_dirs_async(
+        dirs_with_adds, dirs_with_deletes, namespace=namespace, async=async,
+        file_count_deltas=file_count_deltas,
+        update_counts=update_counts).get_result()
+
+  @ndb.tasklet
+  def update_affected_dirs_async(self, dirs_with_adds, dirs_with_deletes,
+                                 namespace=None, async=False,
+                                 file_count_deltas=None, update_counts=True):
+    """Asynchronous version of update_affected_dirs()."""
+    ns = namespace
+    file_count_deltas = file_count_deltas or {}
+    # Read the cache generation before the dirs, so that dirs which are
+    # deleted after they are read here are never recorded as available.
+    cache_generation = None
+    if dirs_with_adds:
+      cache_generation = _dir_cache.get_generation(namespace=ns)
+    count_futures = [
+        _offset_dir_counts_async(path, namespace=ns, num_files=delta)
+        for path, delta in file_count_deltas.iteritems()]
+
     # Order deletes by depth first. This isn't actually by depth, but all we
     # need to guarantee here is that paths with common subdirs are deleted
     # depth-first, which can be accomplished by sorting in reverse
     # alphabetical order.
     dirs_with_deletes = sorted(list(dirs_with_deletes), reverse=True)
 
-    # For every directory which contained a deleted file (including children),
-    # check if the directory should disappear. It should disappear if:
-    #   1. There are no files in the directory, and...
-    #   2. There are no child directories, and...
-    #   3. The directory path is not present in dirs_with_adds.
-    dirs_paths_to_delete = []
-    for path in dirs_with_deletes:
-      if path in dirs_with_adds or files.Files.list(
-          path, namespace=namespace, limit=1, _internal=True):
-        # The directory is marked for addition, or files still exist in it.
-        continue
-      subdirs = Dirs.list(path, limit=2)
-      if len(subdirs) > 1:
-        # Multiple subdirs exist, cannot delete dir.
-        continue
-      elif len(subdirs) == 1:
-        # Handle the case where the only remaining subdir is marked for delete.
-        if subdirs.values()[0].path not in dirs_paths_to_delete:
-          continue
-      dirs_paths_to_delete.append(path)
-
     # Batch get all directory entities, both added and deleted.
-    ns = namespace
     dir_keys = [
-        ndb.Key(_TitanDir, path, namespace=ns) for path in dirs_paths_to_delete]
+        ndb.Key(_TitanDir, path, namespace=ns) for path in dirs_with_deletes]
     dir_keys += [
         ndb.Key(_TitanDir, path, namespace=ns) for path in dirs_with_adds]
-    existing_dir_ents = ndb.get_multi(dir_keys)
+    existing_dir_ents = yield ndb.get_multi_async(dir_keys)
     # Transform into a dictionary mapping paths to existing entities:
     existing_dirs = {}
     for ent in existing_dir_ents:
       if ent:
         existing_dirs[ent.path] = ent
 
+    # For every directory which contained a deleted file (including children),
+    # check if the directory should disappear. It should disappear if:
+    #   1. There are no files in the directory, and...
+    #   2. There are no child directories, and...
+    #   3. The directory path is not present in dirs_with_adds.
+    maybe_empty_paths = [
+        path for path in dirs_with_deletes if path not in dirs_with_adds]
+
+    # Dirs with counters which still count children are skipped after a
+    # single batch get, once this batch's file counts have been applied.
+    counted_paths = [
+        path for path in maybe_empty_paths
+        if path in existing_dirs and existing_dirs[path].has_child_counts]
+    child_counts = {}
+    if counted_paths:
+      if count_futures:
+        yield count_futures
+      child_counts = yield _get_dir_counts_async(counted_paths, namespace=ns)
+    # Mapping of dir paths to the number of their counted subdirs which may
+    # be deleted.
+    num_deleted_subdirs = collections.defaultdict(int)
+    query_paths = []
+    for path in maybe_empty_paths:
+      if path in child_counts and min(child_counts[path]) >= 0:
+        num_files, num_subdirs = child_counts[path]
+        if num_files or num_subdirs > num_deleted_subdirs[path]:
+          continue
+      query_paths.append(path)
+      if (path in existing_dirs
+          and existing_dirs[path].status == _STATUS_AVAILABLE
+          and existing_dirs[path].counted_in_parent):
+        num_deleted_subdirs[os.path.dirname(path)] += 1
+
+    # Counters can drift below the real number of children, such as when a
+    # pull task is delivered twice, so emptiness is always confirmed with
+    # keys-only queries. The queries of all dirs run in parallel, and each
+    # fetches enough subdirs to tell if any is not deleted along with it.
+    children = yield [
+        self._get_dir_children_async(
+            path, ns, max_subdirs=len(query_paths) + 1)
+        for path in query_paths]
+    dirs_paths_to_delete = []
+    for path, (has_files, subdir_paths) in zip(query_paths, children):
+      # Handle the case where all remaining subdirs are marked for delete.
+      if not has_files and all(
+          subdir_path in dirs_paths_to_delete for subdir_path in subdir_paths):
+        dirs_paths_to_delete.append(path)
+
     changed_dir_ents = []
+    # Mapping of dir paths to the change in their number of subdirs.
+    subdir_count_deltas = collections.defaultdict(int)
     for path in dirs_paths_to_delete:
       if path in existing_dirs:
         # Existing directory, mark as deleted.
@@ -317,6 +566,9 @@ class DirService(object):
           # Skip this entity entirely if it's already correct.
           continue
         ent.status = _STATUS_DELETED
+        if update_counts and ent.counted_in_parent:
+          ent.counted_in_parent = False
+          subdir_count_deltas[ent.parent_path] -= 1
       else:
         # Missing directory entity, create a new one and mark as deleted.
         ent = _TitanDir(
@@ -336,12 +588,14 @@ class DirService(object):
       if path in existing_dirs:
         # Existing directory, make sure it's marked as available.
         ent = existing_dirs[path]
-        if ent.status == _STATUS_AVAILABLE:
+        if (ent.status == _STATUS_AVAILABLE
+            and (ent.counted_in_parent or not update_counts)):
           # Skip this entity entirely if it's already correct.
           continue
         ent.status = _STATUS_AVAILABLE
       else:
         # Missing directory entity, create a new one and mark as available.
+        # All of its children are created after it, so it can be counted.
         ent = _TitanDir(
             # NDB properties:
             id=path,
@@ -351,15 +605,54 @@ class DirService(object):
             parent_path=os.path.dirname(path),
             parent_paths=utils.split_path(path),
             status=_STATUS_AVAILABLE,
+            has_child_counts=True,
         )
+      if update_counts:
+        ent.counted_in_parent = True
+        subdir_count_deltas[ent.parent_path] += 1
       # Whitespace. Important.
       changed_dir_ents.append(ent)
 
     for dir_ents in utils.chunk_generator(changed_dir_ents, chunk_size=100):
       if not async:
-        ndb.put_multi(dir_ents)
+        yield ndb.put_multi_async(dir_ents)
       else:
-        ndb.put_multi_async(dir_ents)
+        count_futures.extend(ndb.put_multi_async(dir_ents))
+    for path, delta in subdir_count_deltas.iteritems():
+      if path != '/' and delta:
+        count_futures.append(
+            _offset_dir_counts_async(path, namespace=ns, num_subdirs=delta))
+    if count_futures:
+      yield count_futures
+
+    # Stop writes from skipping deleted dirs, once they are stored as deleted.
+    if dirs_paths_to_delete:
+      _dir_cache.invalidate(dirs_paths_to_delete, namespace=ns)
+    if dirs_with_adds:
+      # Only remember available dirs once they have been stored.
+      _dir_cache.set_available(
+          dirs_with_adds, cache_generation, namespace=ns)
+
+  @ndb.tasklet
+  def _get_dir_children_async(self, path, namespace, max_subdirs):
+    """Gets if a dir has files, and some of its available subdirs.
+
+    Args:
+      path: The dir path.
+      namespace: The filesystem namespace.
+      max_subdirs: The max number of subdir paths to get.
+    Returns:
+      A two-tuple of whether the dir has any files, and a list of the paths
+      of up to max_subdirs available subdirs.
+    """
+    files_query = files._create_files_query(path, namespace=namespace)
+    dirs_query = _TitanDir.query(namespace=namespace)
+    dirs_query = dirs_query.filter(_TitanDir.parent_path == path)
+    dirs_query = dirs_query.filter(_TitanDir.status == _STATUS_AVAILABLE)
+    file_keys, subdir_keys = yield (
+        files_query.fetch_async(1, keys_only=True),
+        dirs_query.fetch_async(max_subdirs, keys_only=True))
+    raise ndb.Return((bool(file_keys), [key.id() for key in subdir_keys]))
 
 class Dir(object):
   """A simple directory."""
@@ -435,6 +728,136 @@ class Dir(object):
       setattr(self._dir, key, value)
     self._dir.put()
 
+  def copy_to(self, destination_dir, task_manager=None,
+              batch_size=files.DEFAULT_BATCH_SIZE,
+              page_size=files.DEFAULT_PAGE_SIZE):
+    """Copy all files in this directory tree to a different directory.
+
+    The tree is walked in pages of file paths and each batch of files is
+    copied in a deferred task of a task manager, which reports progress and
+    failures. The destination directory entities are written in bulk while
+    walking, instead of by each batch of copied files.
+
+    Args:
+      destination_dir: A Dir object of the new path of this directory. It may
+          be in a different namespace.
+      task_manager: An optional, existing tasks.TaskManager. If not given, a
+          new task manager is created and finalized. Otherwise, finalizing
+          the task manager is left to the caller.
+      batch_size: The number of files to copy per task.
+      page_size: The number of file paths to list per query.
+    Raises:
+      ValueError: If the destination is this directory or inside of it.
+    Returns:
+      The tasks.TaskManager of the copy.
+    """
+    return self._move_or_copy_to(
+        destination_dir, is_move=False, task_manager=task_manager,
+        batch_size=batch_size, page_size=page_size)
+
+  def move_to(self, destination_dir, task_manager=None,
+              batch_size=files.DEFAULT_BATCH_SIZE,
+              page_size=files.DEFAULT_PAGE_SIZE):
+    """Move all files in this directory tree to a different directory.
+
+    Like copy_to, but each task also deletes its batch of source files. The
+    source directory entities are then removed by the DirTaskConsumer.
+
+    Args:
+      destination_dir: A Dir object of the new path of this directory. It may
+          be in a different namespace.
+      task_manager: An optional, existing tasks.TaskManager. If not given, a
+          new task manager is created and finalized. Otherwise, finalizing
+          the task manager is left to the caller.
+      batch_size: The number of files to move per task.
+      page_size: The number of file paths to list per query.
+    Raises:
+      ValueError: If the destination is this directory or inside of it.
+    Returns:
+      The tasks.TaskManager of the move.
+    """
+    return self._move_or_copy_to(
+        destination_dir, is_move=True, task_manager=task_manager,
+        batch_size=batch_size, page_size=page_size)
+
+  def delete(self, task_manager=None, batch_size=files.DEFAULT_BATCH_SIZE,
+             page_size=files.DEFAULT_PAGE_SIZE):
+    """Delete all files in this directory tree.
+
+    The tree is walked in pages of file paths and each batch of files is
+    deleted in a deferred task of a task manager. The directory entities are
+    then removed by the DirTaskConsumer.
+
+    Args:
+      task_manager: An optional, existing tasks.TaskManager. If not given, a
+          new task manager is created and finalized. Otherwise, finalizing
+          the task manager is left to the caller.
+      batch_size: The number of files to delete per task.
+      page_size: The number of file paths to list per query.
+    Returns:
+      The tasks.TaskManager of the delete.
+    """
+    new_task_manager = task_manager is None
+    if new_task_manager:
+      task_manager = tasks.TaskManager.new(
+          description='Delete %s' % self._path)
+    for titan_files in files.Files.iter_list(
+        self._path, namespace=self.namespace, recursive=True,
+        page_size=page_size):
+      for paths_chunk in utils.chunk_generator(
+          titan_files.keys(), chunk_size=batch_size):
+        task_manager.defer_task(
+            'delete:%s' % paths_chunk[0], _delete_paths, paths_chunk,
+            namespace=self.namespace)
+    if new_task_manager:
+      task_manager.finalize()
+    return task_manager
+
+  def _move_or_copy_to(self, destination_dir, is_move, task_manager,
+                       batch_size, page_size):
+    """This encapsulates repeated logic for copy_to and move_to methods."""
+    source_prefix = self._path.rstrip('/') + '/'
+    if (destination_dir.namespace == self.namespace
+        and (destination_dir._path + '/').startswith(source_prefix)):
+      raise ValueError(
+          'Cannot copy or move "%s" into itself: "%s"'
+          % (self._path, destination_dir._path))
+    new_task_manager = task_manager is None
+    if new_task_manager:
+      task_manager = tasks.TaskManager.new(description='%s %s to %s' % (
+          'Move' if is_move else 'Copy', self._path, destination_dir._path))
+
+    dir_service = DirService()
+    written_dir_paths = set()
+    for titan_files in files.Files.iter_list(
+        self._path, namespace=self.namespace, recursive=True,
+        page_size=page_size):
+      destination_map = utils.make_destination_paths_map(
+          titan_files.keys(), destination_dir_path=destination_dir._path,
+          strip_prefix=self._path)
+
+      # Write the destination dirs of this page which have not been seen yet.
+      dir_paths = set()
+      for destination_path in destination_map.itervalues():
+        dir_paths.update(utils.split_path(destination_path))
+      dir_paths.discard('/')
+      dir_paths -= written_dir_paths
+      written_dir_paths.update(dir_paths)
+      dir_paths -= _dir_cache.get_available(
+          dir_paths, namespace=destination_dir.namespace)
+      if dir_paths:
+        dir_service.update_affected_dirs(
+            dirs_with_adds=dir_paths, dirs_with_deletes=set(),
+            namespace=destination_dir.namespace)
+
+      titan_files._move_or_copy_to(
+          destination_dir._path, namespace=destination_dir.namespace,
+          is_move=is_move, strip_prefix=self._path, batch_size=batch_size,
+          task_manager=task_manager)
+    if new_task_manager:
+      task_manager.finalize()
+    return task_manager
+
   def serialize(self):
     data = {
         'meta': self._meta.serialize() if self.meta else None,
@@ -444,7 +867,14 @@ class Dir(object):
     return data
 
 class Dirs(collections.Mapping):
-  """An ordered mapping of directory paths to Dir objects."""
+  """An ordered mapping of directory paths to Dir objects.
+
+  Attributes:
+    cursor: If this object is a page of a paginated listing, an ndb.Cursor
+        pointing to the next page, or None if there are no more results.
+    has_more: If this object is a page of a paginated listing, whether or not
+        more results may exist after this page.
+  """
 
   def __init__(self, paths=None, dirs=None, namespace=None, **kwargs):
     """Constructor.
@@ -461,6 +891,8 @@ class Dirs(collections.Mapping):
     self._titan_dirs = {}
     self._ordered_paths = []
     self._namespace = namespace
+    self.cursor = None
+    self.has_more = False
     if paths is not None and dirs is not None:
       raise TypeError('Either "paths" or "dirs" must be given.')
     if paths is not None and not hasattr(paths, '__iter__'):
@@ -537,15 +969,53 @@ class Dirs(collections.Mapping):
   def sort(self):
     self._ordered_paths.sort()
 
+  def load(self):
+    """Loads all unloaded dirs in one batch and removes non-existent ones.
+
+    Returns:
+      Self-reference.
+    """
+    titan_dirs = [titan_dir for titan_dir in self.itervalues()
+                  if not titan_dir._dir_ent]
+    dir_keys = [ndb.Key(_TitanDir, titan_dir._path, namespace=self.namespace)
+                for titan_dir in titan_dirs]
+    dir_ents = ndb.get_multi(dir_keys)
+    paths_to_remove = set()
+    for titan_dir, dir_ent in zip(titan_dirs, dir_ents):
+      if not dir_ent or dir_ent.status == _STATUS_DELETED:
+        paths_to_remove.add(titan_dir.path)
+      else:
+        # Inject the fetched entity into the current Dir object.
+        titan_dir._dir_ent = dir_ent
+    if paths_to_remove:
+      # Rebuild the ordering once, instead of removing paths one at a time.
+      self._ordered_paths = [path for path in self._ordered_paths
+                             if path not in paths_to_remove]
+      for path in paths_to_remove:
+        del self._titan_dirs[path]
+    return self
+
   @classmethod
-  def list(cls, path, namespace=None, limit=None, **kwargs):
+  def list(cls, path, namespace=None, limit=None, cursor=None,
+           page_size=None, load=False, **kwargs):
     """List the sub-directories of a directory.
 
     Args:
       path: An absolute directory path.
       namespace: The filesystem namespace.
       limit: An integer limiting the number of sub-directories returned.
+      cursor: An ndb.Cursor or a web-safe cursor string from a previous page's
+          "cursor" attribute. If given, only one page of results is returned.
+      page_size: The number of sub-directories in a page. If given, only one
+          page of results is returned and the "cursor" and "has_more"
+          attributes of the result are populated. Defaults to
+          files.DEFAULT_PAGE_SIZE if only "cursor" is given. Cannot be
+          combined with "limit".
+      load: Whether to fetch the directory entities with the query, so that
+          reading "meta" or "exists" of the listed dirs needs no more RPCs.
       **kwargs: Keyword arguments to pass through to Dir objects.
+    Raises:
+      ValueError: If given an invalid cursor or page_size argument.
     Returns:
       A lazy Dirs mapping.
     """
@@ -558,17 +1028,130 @@ class Dirs(collections.Mapping):
     dirs_query = _TitanDir.query(namespace=namespace)
     dirs_query = dirs_query.filter(_TitanDir.parent_path == path)
     dirs_query = dirs_query.filter(_TitanDir.status == _STATUS_AVAILABLE)
-    dir_keys = dirs_query.fetch(limit=limit, keys_only=True)
-    titan_dirs = cls(
-        [key.id() for key in dir_keys], namespace=namespace, **kwargs)
+    if cursor is None and page_size is None:
+      results = dirs_query.fetch(limit=limit, keys_only=not load)
+      return cls._make_dirs(results, namespace=namespace, **kwargs)
+
+    if limit is not None:
+      raise ValueError('"limit" cannot be combined with "page_size".')
+    page_size = files._validate_page_size(page_size)
+    results, next_cursor, has_more = dirs_query.fetch_page(
+        page_size, start_cursor=files._make_cursor(cursor),
+        keys_only=not load)
+    titan_dirs = cls._make_dirs(results, namespace=namespace, **kwargs)
+    titan_dirs.has_more = bool(has_more and next_cursor)
+    titan_dirs.cursor = next_cursor if titan_dirs.has_more else None
     return titan_dirs
 
+  @classmethod
+  def _make_dirs(cls, results, namespace=None, **kwargs):
+    """Makes a Dirs mapping from keys-only or full query results."""
+    if results and isinstance(results[0], _TitanDir):
+      titan_dirs = []
+      for dir_ent in results:
+        titan_dir = Dir(path=dir_ent.path, namespace=namespace, **kwargs)
+        titan_dir._dir_ent = dir_ent
+        titan_dirs.append(titan_dir)
+      return cls(dirs=titan_dirs, namespace=namespace)
+    return cls([key.id() for key in results], namespace=namespace, **kwargs)
+
   def serialize(self):
     data = {}
     for titan_dir in self.itervalues():
       data[titan_dir.name] = titan_dir.serialize()
     return data
 
+def count_files(dir_path, namespace=None):
+  """Counts the files directly within a directory from its counters.
+
+  Only files written and deleted through DirManagerMixin are counted, once
+  DirTaskConsumer has processed their window.
+
+  Usage:
+    files.register_file_counter(dirs.count_files)
+    files.Files.count('/path/to/dir')
+
+  Args:
+    dir_path: An absolute directory path.
+    namespace: The filesystem namespace.
+  Returns:
+    The number of files, or None if the directory is not counted.
+  """
+  if dir_path != '/' and dir_path.endswith('/'):
+    dir_path = dir_path[:-1]
+  if dir_path == '/':
+    return None
+  # Get the dir entity and its counter shards in a single batch.
+  dir_key = ndb.Key(_TitanDir, dir_path, namespace=namespace)
+  ents = ndb.get_multi(
+      [dir_key] + _make_counter_keys(dir_path, namespace=namespace))
+  dir_ent = ents[0]
+  if not dir_ent or not dir_ent.has_child_counts:
+    return None
+  num_files = sum(ent.num_files for ent in ents[1:] if ent)
+  # Counters which have drifted below zero are not trusted.
+  return num_files if num_files >= 0 else None
+
+def backfill_dir_counts(namespace=None, cursor=None,
+                        batch_size=INITIALIZER_BATCH_SIZE):
+  """Migration to count the files and subdirs of pre-existing directories.
+
+  Processes one batch of directories, then defers itself to process the next
+  batch until all directories in the namespace have been visited. This also
+  repairs counters of directories which are already counted. Writes and
+  deletes within a directory while it is being counted may be missed.
+
+  Usage:
+    deferred.defer(dirs.backfill_dir_counts, namespace='some-namespace')
+
+  Args:
+    namespace: The filesystem namespace.
+    cursor: A web-safe cursor string of where to resume the migration.
+    batch_size: The number of directories to process per task.
+  Returns:
+    The number of directories counted in this batch.
+  """
+  query = _TitanDir.query(namespace=namespace)
+  dir_ents, next_cursor, more = query.fetch_page(
+      batch_size,
+      start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+
+  count_futures = []
+  for dir_ent in dir_ents:
+    files_query = files._create_files_query(dir_ent.path, namespace=namespace)
+    dirs_query = _TitanDir.query(namespace=namespace)
+    dirs_query = dirs_query.filter(_TitanDir.parent_path == dir_ent.path)
+    dirs_query = dirs_query.filter(_TitanDir.status == _STATUS_AVAILABLE)
+    count_futures.append(
+        (files_query.count_async(), dirs_query.count_async()))
+
+  # Store the absolute counts in the first shard and clear the others.
+  counter_ents = []
+  stale_counter_keys = []
+  for dir_ent, (num_files_future, num_subdirs_future) in zip(
+      dir_ents, count_futures):
+    counter_keys = _make_counter_keys(dir_ent.path, namespace=namespace)
+    counter_ents.append(_TitanDirCounter(
+        key=counter_keys[0],
+        num_files=num_files_future.get_result(),
+        num_subdirs=num_subdirs_future.get_result()))
+    stale_counter_keys.extend(counter_keys[1:])
+    dir_ent.has_child_counts = True
+    # Its parent counts it if it is available, in its own batch.
+    dir_ent.counted_in_parent = dir_ent.status == _STATUS_AVAILABLE
+  ndb.delete_multi(stale_counter_keys)
+  ndb.put_multi(counter_ents + dir_ents)
+
+  if more and next_cursor:
+    deferred.defer(backfill_dir_counts, namespace=namespace,
+                   cursor=next_cursor.urlsafe(), batch_size=batch_size)
+  return len(dir_ents)
+
+def _delete_paths(paths, namespace=None):
+  """Deferred task to delete a batch of files."""
+  # Loading drops files which were deleted by an earlier run of the task.
+  files.Files(paths, namespace=namespace).load().delete()
+
 class _TitanDir(ndb.Expando):
   """Model for representing a dir; don't use directly outside of this module.
 
@@ -582,6 +1165,12 @@ class _TitanDir(ndb.Expando):
     parent_paths: A list of parent directories.
         Example: ['/', '/path', '/path/to', '/path/to/dir']
     status: If the directory is available or deleted.
+    has_child_counts: Whether the _TitanDirCounter shards of the directory
+        hold its number of files and subdirs. False for directories created
+        before counters existed, until backfill_dir_counts() is run.
+    counted_in_parent: Whether the directory is counted in the subdirs of its
+        parent. Writes create directories uncounted, and DirTaskConsumer
+        counts them.
   """
   name = ndb.StringProperty()
   parent_path = ndb.StringProperty()
@@ -589,12 +1178,16 @@ class _TitanDir(ndb.Expando):
   status = ndb.IntegerProperty(
       default=_STATUS_AVAILABLE,
       choices=[_STATUS_AVAILABLE, _STATUS_DELETED])
+  has_child_counts = ndb.BooleanProperty(default=False, indexed=False)
+  counted_in_parent = ndb.BooleanProperty(default=False, indexed=False)
 
   BASE_PROPERTIES = frozenset((
       'name',
       'parent_path',
       'parent_paths',
       'status',
+      'has_child_counts',
+      'counted_in_parent',
   ))
 
   def __repr__(self):
@@ -621,6 +1214,195 @@ class _TitanDir(ndb.Expando):
       if key in _TitanDir.BASE_PROPERTIES:
         raise InvalidMetaError('Invalid name for meta property: "%s"' % key)
 
+def _make_dir_task(modified_path):
+  """Makes a pull task for DirTaskConsumer about a ModifiedPath."""
+  window = _get_window(modified_path.modified)
+  # Important: unlock tasks in the same window at the same time, and
+  # after the window itself has passed.
+  current_task_eta = datetime.datetime.utcfromtimestamp(
+      window + TASKQUEUE_LEASE_ETA_BUFFER)
+  if TASKQUEUE_NUM_SHARDS > 1:
+    # Shard by namespace, so that each namespace has a single consumer.
+    # Tasks of the same shard are still unlocked together by their eta.
+    tag = _make_shard_tag(_get_namespace_shard(modified_path.namespace))
+  else:
+    tag = str(window)
+  return taskqueue.Task(
+      method='PULL',
+      payload=json.dumps(modified_path.serialize()),
+      tag=tag,
+      eta=current_task_eta)
+
+def _maybe_process_dir_tasks():
+  # Evil, but really really convenient. If in test or dev_appserver, just
+  # update the directory entities synchronously with the request.
+  server_software = os.environ.get('SERVER_SOFTWARE', '')
+  if server_software.lower().startswith(('dev', 'test')):
+    dir_task_consumer = DirTaskConsumer()
+    dir_task_consumer.process_next_window()
+
 def _get_window(timestamp=None, window_size=WINDOW_SIZE_SECONDS):
   """Get the window for the given unix time and window size."""
   return int(window_size * round(float(timestamp) / window_size))
+
+def _get_namespace_shard(namespace):
+  return (zlib.crc32(namespace or '') & 0xffffffff) % TASKQUEUE_NUM_SHARDS
+
+def _make_shard_tag(shard):
+  return 'shard-%d' % shard
+
+class _DirExistenceCache(object):
+  """Instance-local and memcache record of directories known to exist.
+
+  Records are tagged with the generation of their namespace in memcache, and
+  only trusted while it is current. Marking dirs deleted increments the
+  generation, which also makes the local records of other instances stale.
+  """
+
+  def __init__(self, local_ttl_seconds=DIR_CACHE_LOCAL_TTL_SECONDS,
+               max_local_paths=DIR_CACHE_LOCAL_MAX_PATHS):
+    self.local_ttl_seconds = local_ttl_seconds
+    self.max_local_paths = max_local_paths
+    self._lock = threading.Lock()
+    # Mapping of (namespace, path) tuples to (expiration, generation) tuples.
+    self._local_paths = {}
+
+  def get_available(self, paths, namespace=None):
+    """Returns the subset of the given dir paths known to be available."""
+    now = time.time()
+    local_generations = {}
+    with self._lock:
+      for path in paths:
+        expires, generation = self._local_paths.get(
+            (namespace, path), (0, None))
+        if expires > now:
+          local_generations[path] = generation
+    missing_paths = [path for path in paths if path not in local_generations]
+    memcache_values = memcache.get_multi(
+        [_DIR_GENERATION_KEY] + missing_paths,
+        key_prefix=_DIR_MEMCACHE_PREFIX, namespace=namespace)
+    generation = self._get_generation(memcache_values, namespace=namespace)
+    if generation is None:
+      return set()
+    available_paths = set(
+        path for path, local_generation in local_generations.iteritems()
+        if local_generation == generation)
+    memcache_paths = [path for path in missing_paths
+                      if memcache_values.get(path) == generation]
+    self._set_local(memcache_paths, generation, namespace=namespace)
+    available_paths.update(memcache_paths)
+    return available_paths
+
+  def get_generation(self, namespace=None):
+    """Returns the current generation, to be passed to set_available."""
+    memcache_values = memcache.get_multi(
+        [_DIR_GENERATION_KEY], key_prefix=_DIR_MEMCACHE_PREFIX,
+        namespace=namespace)
+    return self._get_generation(memcache_values, namespace=namespace)
+
+  def set_available(self, paths, generation, namespace=None):
+    """Records available dirs.
+
+    Args:
+      paths: An iterable of dir paths.
+      generation: The result of get_generation(), from before the dirs were
+          read or written as available.
+      namespace: The filesystem namespace.
+    """
+    if generation is None:
+      return
+    self._set_local(paths, generation, namespace=namespace)
+    memcache.set_multi(
+        dict((path, generation) for path in paths),
+        key_prefix=_DIR_MEMCACHE_PREFIX, time=DIR_CACHE_MEMCACHE_TTL_SECONDS,
+        namespace=namespace)
+
+  def invalidate(self, paths, namespace=None):
+    """Stops trusting all records of the namespace, after dirs are deleted."""
+    with self._lock:
+      for path in paths:
+        self._local_paths.pop((namespace, path), None)
+    memcache.incr(
+        _DIR_MEMCACHE_PREFIX + _DIR_GENERATION_KEY, namespace=namespace)
+
+  def clear(self):
+    with self._lock:
+      self._local_paths.clear()
+
+  def _get_generation(self, memcache_values, namespace=None):
+    generation = memcache_values.get(_DIR_GENERATION_KEY)
+    if generation is None:
+      # Start from a new value if the generation was evicted, so that no
+      # earlier records are trusted again.
+      generation = int(time.time() * 1000000)
+      if not memcache.add(_DIR_MEMCACHE_PREFIX + _DIR_GENERATION_KEY,
+                          generation, namespace=namespace):
+        # Another request just added it; trust nothing until the next call.
+        return None
+    return generation
+
+  def _set_local(self, paths, generation, namespace=None):
+    expires = time.time() + self.local_ttl_seconds
+    with self._lock:
+      if len(self._local_paths) + len(paths) > self.max_local_paths:
+        self._local_paths.clear()
+      for path in paths:
+        self._local_paths[(namespace, path)] = (expires, generation)
+
+class _TitanDirCounter(ndb.Model):
+  """Model for one shard of the child counters of a _TitanDir.
+
+  Counters are sharded so that many files can be created and deleted in the
+  same directory without contention. The sums of the shards of a directory
+  are its number of files and of available subdirs.
+
+  Attributes:
+    num_files: The change in the number of files in the directory.
+    num_subdirs: The change in the number of available subdirs.
+  """
+  num_files = ndb.IntegerProperty(default=0, indexed=False)
+  num_subdirs = ndb.IntegerProperty(default=0, indexed=False)
+
+def _make_counter_keys(path, namespace=None):
+  return [ndb.Key(_TitanDirCounter, '%s:%d' % (path, i), namespace=namespace)
+          for i in range(NUM_COUNTER_SHARDS)]
+
+def _get_dir_counts(paths, namespace=None):
+  """Sums the counter shards of the given dirs in a single batch get.
+
+  Args:
+    paths: A list of dir paths.
+    namespace: The filesystem namespace.
+  Returns:
+    A dictionary mapping dir paths to (num_files, num_subdirs) tuples.
+  """
+  return _get_dir_counts_async(paths, namespace=namespace).get_result()
+
+@ndb.tasklet
+def _get_dir_counts_async(paths, namespace=None):
+  counter_keys = []
+  for path in paths:
+    counter_keys.extend(_make_counter_keys(path, namespace=namespace))
+  counter_ents = yield ndb.get_multi_async(counter_keys)
+  dir_counts = {}
+  for i, path in enumerate(paths):
+    shard_ents = counter_ents[
+        i * NUM_COUNTER_SHARDS:(i + 1) * NUM_COUNTER_SHARDS]
+    dir_counts[path] = (
+        sum(ent.num_files for ent in shard_ents if ent),
+        sum(ent.num_subdirs for ent in shard_ents if ent))
+  raise ndb.Return(dir_counts)
+
+@ndb.transactional_tasklet
+def _offset_dir_counts_async(path, namespace=None, num_files=0,
+                             num_subdirs=0):
+  """Transactionally offsets a random counter shard of a dir."""
+  counter_key = random.choice(_make_counter_keys(path, namespace=namespace))
+  counter_ent = yield counter_key.get_async()
+  if not counter_ent:
+    counter_ent = _TitanDirCounter(key=counter_key)
+  counter_ent.num_files += num_files
+  counter_ent.num_subdirs += num_subdirs
+  yield counter_ent.put_async()
+
+_dir_cache = _DirExistenceCache()
@@ -24,8 +24,17 @@ Usage:
   titan_file.delete()
   titan_file.copy_to(files.File('/destination/file'))
   titan_file.move_to(files.File('/destination/file'))
+  for line in titan_file.open():
+    pass
+
+  # Overlap independent RPCs with ndb futures.
+  futures = [files.File('/a').read_async(), files.File('/b').write_async('b')]
+  ndb.Future.wait_all(futures)
 
   titan_files = files.Files.list('/some/dir')
+  for titan_files_page in files.Files.iter_list('/some/dir', page_size=100):
+    titan_files_page.load()
+  files.Files.write_multi({'/some/dir/a': 'a', '/some/dir/b': 'b'})
   titan_files.copy_to('/destination/', strip_prefix='/some')
   titan_files.move_to('/destination/', strip_prefix='/some')
   titan_files.load()
@@ -40,17 +49,15 @@ except ImportError:
   appengine_config = None
 
 import collections
+import cStringIO
 import datetime
 import hashlib
+import inspect
 import logging
 import os
+import zlib
 
-try:
-  from concurrent import futures
-except ImportError:
-  # Allow Titan Files to be imported without the futures library present,
-  # since only copy_to and move_to methods require this dependency.
-  futures = None
+from google.appengine.api import datastore_errors
 from google.appengine.ext import blobstore
 from google.appengine.ext import ndb
 
@@ -63,6 +70,9 @@ __all__ = [
     'MAX_CONTENT_SIZE',
     'DEFAULT_BATCH_SIZE',
     'DEFAULT_MAX_WORKERS',
+    'DEFAULT_PAGE_SIZE',
+    'DEFAULT_BUFFER_SIZE',
+    'MAX_BLOB_CACHE_SIZE',
     # Errors.
     'Error',
     'BadFileError',
@@ -74,11 +84,16 @@ __all__ = [
     'File',
     'Files',
     'OrderedFiles',
+    'FileStub',
     'FileProperty',
     # Functions.
     'register_file_factory',
     'unregister_file_factory',
     'register_file_mixins',
+    'register_compression_codec',
+    'register_file_counter',
+    'unregister_file_counter',
+    'backfill_file_sizes',
 ]
 
 # Arbitrary cutoff for when content will be stored in blobstore.
@@ -87,9 +102,19 @@ MAX_CONTENT_SIZE = 1 << 19  # 500 KiB
 
 DEFAULT_BATCH_SIZE = 100
 DEFAULT_MAX_WORKERS = 25
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_BUFFER_SIZE = 1 << 19  # 512 KiB
+
+# Blob content larger than this is never stored whole in the blob cache.
+MAX_BLOB_CACHE_SIZE = 1 << 23  # 8 MiB
 
 _BLOB_MEMCACHE_PREFIX = 'titan-blob:'
 
+# Mapping of compression codec names to (compress, decompress) functions.
+_compression_codecs = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
 class Error(Exception):
   pass
 
@@ -161,6 +186,11 @@ class File(object):
       especially if a File object is long-lived.
   """
 
+  # Whether Files.delete() should delete the blobs of deleted files. Mixins
+  # which manage blob lifetimes themselves disable this and release blobs in
+  # delete(_run_mixins_only=True) instead.
+  _delete_blobs_with_file = True
+
   def __new__(cls, path, namespace=None, _file_ent=None, _from_factory=False,
               **kwargs):
     """Factory handling for File objects.
@@ -202,6 +232,8 @@ class File(object):
     self._name = os.path.basename(self._path)
     self._name_clean, self._extension = os.path.splitext(self._name)
     self._file_ent = _file_ent
+    # The real_path which load_async() last found not to exist, if any.
+    self._missing_real_path = None
     self._meta = None
     kwargs.pop('_from_factory', None)
     self._original_kwargs = kwargs
@@ -257,6 +289,9 @@ class File(object):
     try:
       if self._file_ent:
         return self._file_ent
+      if (self._missing_real_path is not None
+          and self._missing_real_path == self.real_path):
+        raise BadFileError('File does not exist: %s' % self.real_path)
       # Haven't initialized a File object yet.
       self._file_ent = _TitanFile.get_by_id(
           self.real_path, namespace=self.namespace)
@@ -275,6 +310,7 @@ class File(object):
 
   def unload(self):
     self._file_ent = None
+    self._missing_real_path = None
 
   @property
   def name(self):
@@ -373,6 +409,9 @@ class File(object):
 
   @property
   def size(self):
+    if self._file.content_size is not None:
+      return self._file.content_size
+    # Backwards-compatibility with entities which predate "content_size".
     if self.blob:
       return self.blob.size
     content = self.content
@@ -382,7 +421,9 @@ class File(object):
 
   @property
   def md5_hash(self):
-    return self.blob.md5_hash if self.blob else self._file.md5_hash
+    if self._file.md5_hash is not None:
+      return self._file.md5_hash
+    return self.blob.md5_hash if self.blob else None
 
   @property
   def meta(self):
@@ -398,6 +439,49 @@ class File(object):
   def read(self):
     return self.content
 
+  @ndb.tasklet
+  def load_async(self):
+    """Asynchronously loads the file entity, if not already loaded.
+
+    Returns:
+      An ndb.Future whose result is this File. The file does not exist if
+      "exists" is False once the future is resolved.
+    """
+    if not self._file_ent:
+      real_path = self.real_path
+      self._file_ent = yield _TitanFile.get_by_id_async(
+          real_path, namespace=self.namespace)
+      # Remember missing files, so that exists doesn't fetch them again.
+      self._missing_real_path = None if self._file_ent else real_path
+    raise ndb.Return(self)
+
+  @classmethod
+  @ndb.tasklet
+  def _resolve_real_paths_async(cls, titan_files):
+    """Batch hook for mixins to determine the real paths of many files.
+
+    This is called by Files.load before each file's real_path is used, so
+    that mixins which compute real_path with RPCs can do so in batches.
+
+    Args:
+      titan_files: A list of File objects of this class.
+    Returns:
+      An ndb.Future which is resolved once the real paths are determined.
+    """
+    pass
+
+  @ndb.tasklet
+  def read_async(self):
+    """Asynchronously reads the file content.
+
+    Raises:
+      BadFileError: If the file does not exist, when the future is resolved.
+    Returns:
+      An ndb.Future whose result is the same as the "content" property.
+    """
+    contents = yield _read_contents_async([self])
+    raise ndb.Return(contents[self.path])
+
   def close(self):
     pass
 
@@ -414,6 +498,16 @@ class File(object):
       content = content.encode(encoding)
     return content, encoding
 
+  def _maybe_compress_content(self, content, compression):
+    if content is None or compression is None:
+      return content, None
+    compress = _compression_codecs[compression][0]
+    compressed_content = compress(content)
+    if (len(compressed_content) >= len(content)
+        or len(compressed_content) > MAX_CONTENT_SIZE):
+      return content, None
+    return compressed_content, compression
+
   def _maybe_write_to_blobstore(self, content, blob, force_blobstore=False):
     if content and blob:
       raise TypeError('Exactly one of "content" or "blob" must be given.')
@@ -428,10 +522,69 @@ class File(object):
       content = None
     return content, blob
 
+  def open(self, mode='r', buffer_size=DEFAULT_BUFFER_SIZE, **kwargs):
+    """Open the file for streaming reads or writes.
+
+    Unlike the "content" property and write(), content is never held in memory
+    all at once.
+
+    In read mode, the returned object supports read(size), readline(), seek(),
+    tell(), close() and line iteration. Reads always return byte strings,
+    regardless of the file's encoding.
+
+    In write mode, the returned object supports write(), writelines() and
+    close(). Written chunks are streamed to blobstore once the content
+    outgrows MAX_CONTENT_SIZE, and the file is only written on close(). If an
+    error is raised inside of a "with" statement, the file is not written.
+
+    Usage:
+      with titan_file.open() as fp:
+        fp.seek(1024)
+        data = fp.read(4096)
+
+      with titan_file.open('w', mime_type='text/csv') as fp:
+        for row in rows:
+          fp.write(row)
+
+    Args:
+      mode: The mode, either 'r' or 'w'.
+      buffer_size: For reads, the number of bytes fetched per blobstore RPC.
+          For writes, the number of bytes buffered before appending to
+          blobstore.
+      **kwargs: For writes, keyword arguments to pass to write() on close, such
+          as mime_type or meta.
+    Raises:
+      ValueError: If given an invalid mode or write arguments.
+      TypeError: If given invalid keyword arguments.
+      BadFileError: If reading a file which does not exist.
+    Returns:
+      A file-like object.
+    """
+    if mode in ('w', 'wb'):
+      if 'content' in kwargs or 'blob' in kwargs:
+        raise TypeError('"content" and "blob" cannot be passed to open().')
+      self._validate_write_args(content='', **kwargs)
+      return _FileWriter(self, buffer_size=buffer_size, write_kwargs=kwargs)
+    if mode not in ('r', 'rb'):
+      raise ValueError('Invalid mode: %r' % mode)
+    if kwargs:
+      raise TypeError('Unexpected keyword arguments: %r' % kwargs.keys())
+    if not self.exists:
+      raise BadFileError('File does not exist: %s' % self.real_path)
+    file_ent = self._file
+    if file_ent.content is not None:
+      return _ContentReader(_get_inline_content(file_ent))
+    content = _get_blob_cache(file_ent.path)
+    if content is not None:
+      return _ContentReader(content)
+    return blobstore.BlobReader(
+        _get_blob_key(file_ent), buffer_size=buffer_size)
+
   # TODO(user): remove _delete_old_blob, refactor into versions subclass.
   def write(self, content=None, blob=None, mime_type=None, meta=None,
             encoding=None, created=None, modified=None, created_by=None,
-            modified_by=None, _delete_old_blob=True):
+            modified_by=None, compression=None, _delete_old_blob=True,
+            _batch=None, _blob_size=None, _blob_md5_hash=None):
     """Write or update a File.
 
     Updates: if the File already exists, write will accept any of the given args
@@ -453,7 +606,16 @@ class File(object):
       modified: Optional datetime.datetime to override the modified property.
       created_by: Optional TitanUser to override the created_by property.
       modified_by: Optional TitanUser to override the modified_by property.
+      compression: Optional name of a compression codec, such as 'zlib', to
+          compress content before it is stored inline. Compressed content which
+          fits under MAX_CONTENT_SIZE is stored inline instead of in blobstore.
+          Content is stored uncompressed if compression does not shrink it.
       _delete_old_blob: Whether or not to delete the old blob if it changed.
+      _batch: Internal-only _WriteBatch used by Files.write_multi. If given,
+          the entity put and any side-effects are deferred to the batch.
+      _blob_size: Internal-only size of the given blob, if already known.
+      _blob_md5_hash: Internal-only md5 hash of the given blob, if already
+          known. Together with _blob_size, this avoids fetching its BlobInfo.
     Raises:
       TypeError: For missing arguments.
       ValueError: For invalid arguments.
@@ -463,34 +625,37 @@ class File(object):
     """
     logging.info('Writing Titan file: %s', self.real_path)
 
-    # Argument sanity checks.
-    _TitanFile.validate_meta_properties(meta)
-    is_content_update = content is not None or blob is not None
-    is_meta_update = (mime_type is not None or meta is not None
-                      or created is not None or modified is not None
-                      or created_by is not None or modified_by is not None)
-    if not is_content_update and not is_meta_update:
-      raise TypeError('Arguments expected, but none given.')
-    if not self.exists and is_meta_update and not is_content_update:
-      raise BadFileError('File does not exist: %s' % self.real_path)
-    if created is not None and not hasattr(created, 'timetuple'):
-      raise ValueError('"created" must be a datetime.datetime instance.')
-    if modified is not None and not hasattr(modified, 'timetuple'):
-      raise ValueError('"modified" must be a datetime.datetime instance.')
-    if created_by is not None and not isinstance(created_by, users.TitanUser):
-      raise ValueError('"created_by" must be a users.TitanUser instance.')
-    if modified_by is not None and not isinstance(modified_by, users.TitanUser):
-      raise ValueError('"modified_by" must be a users.TitanUser instance.')
-    if encoding is not None and content is None and blob is None:
-      raise TypeError(
-          '"content" or "blob" must be passed if "encoding" is passed.')
+    self._validate_write_args(
+        content=content, blob=blob, mime_type=mime_type, meta=meta,
+        encoding=encoding, created=created, modified=modified,
+        created_by=created_by, modified_by=modified_by,
+        compression=compression)
 
     # If given unicode, encode it as UTF-8 and flag it for future decoding.
     content, encoding = self._maybe_encode_content(content, encoding)
 
+    # The md5 hash is always of the uncompressed content.
+    uncompressed_content = content
+    content, compression = self._maybe_compress_content(content, compression)
+
     # If big enough, store content in blobstore. Must come after encoding.
     content, blob = self._maybe_write_to_blobstore(content, blob)
 
+    # Store the size and md5 hash so that reads never need the content.
+    size = None
+    md5_hash = None
+    if uncompressed_content is not None:
+      size = len(uncompressed_content)
+      md5_hash = hashlib.md5(uncompressed_content).hexdigest()
+    elif blob is not None and _blob_size is not None:
+      size = _blob_size
+      md5_hash = _blob_md5_hash
+    elif blob is not None:
+      blob_info = blobstore.BlobInfo.get(blob)
+      if blob_info:
+        size = blob_info.size
+        md5_hash = blob_info.md5_hash
+
     now = datetime.datetime.now()
     override_created_by = created_by is not None
     created_by = created_by or users.get_current_user()
@@ -523,14 +688,19 @@ class File(object):
           blobs=[],
           created_by=created_by,
           modified_by=modified_by,
-          md5_hash=None if blob else hashlib.md5(content).hexdigest(),
+          content_size=size,
+          md5_hash=md5_hash,
+          compression=compression,
       )
       # Add meta attributes.
       if meta:
         for key, value in meta.iteritems():
           setattr(file_ent, key, value)
       self._file_ent = file_ent
-      self._file_ent.put()
+      if _batch is not None:
+        _batch.add_file_ent(self._file_ent)
+      else:
+        self._file_ent.put()
       return self
 
     # Updating an existing _File.
@@ -554,9 +724,10 @@ class File(object):
       file_ent.blob = file_ent.blobs[0]
       file_ent.blobs = []
 
-    if content is not None and file_ent.content != content:
+    if content is not None and (file_ent.content != content
+                                or file_ent.compression != compression):
       file_ent.content = content
-      file_ent.md5_hash = hashlib.md5(content).hexdigest()
+      file_ent.compression = compression
       if file_ent.blob and _delete_old_blob:
         blob_to_delete = self.blob
       # Clear the current blob association for this file.
@@ -567,8 +738,12 @@ class File(object):
         blob_to_delete = self.blob
       # Associate the new blob to this file.
       file_ent.blob = blob
-      file_ent.md5_hash = None
       file_ent.content = None
+      file_ent.compression = None
+
+    if content is not None or blob is not None:
+      file_ent.content_size = size
+      file_ent.md5_hash = md5_hash
 
     if encoding != file_ent.encoding:
       file_ent.encoding = encoding
@@ -579,15 +754,77 @@ class File(object):
         if not hasattr(file_ent, key) or getattr(file_ent, key) != value:
           setattr(file_ent, key, value)
     self._file_ent = file_ent
-    self._file_ent.put()
+    if _batch is not None:
+      _batch.add_file_ent(self._file_ent)
+    else:
+      self._file_ent.put()
 
     if blob_to_delete and _delete_old_blob:
       # Delete the actual blobstore data after the file write to avoid
       # orphaned files.
-      _delete_blobs(blobs=[blob_to_delete], file_paths=[self.real_path])
+      if _batch is not None:
+        _batch.add_hook_item(
+            'files:delete_blobs', _delete_blobs_for_batch,
+            (blob_to_delete, self.real_path))
+      else:
+        _delete_blobs(blobs=[blob_to_delete], file_paths=[self.real_path])
 
     return self
 
+  def _validate_write_args(self, content=None, blob=None, mime_type=None,
+                           meta=None, encoding=None, created=None,
+                           modified=None, created_by=None, modified_by=None,
+                           compression=None, **unused_kwargs):
+    """Argument sanity checks for write(); see write() for the arguments."""
+    _TitanFile.validate_meta_properties(meta)
+    is_content_update = content is not None or blob is not None
+    is_meta_update = (mime_type is not None or meta is not None
+                      or created is not None or modified is not None
+                      or created_by is not None or modified_by is not None)
+    if not is_content_update and not is_meta_update:
+      raise TypeError('Arguments expected, but none given.')
+    if not self.exists and is_meta_update and not is_content_update:
+      raise BadFileError('File does not exist: %s' % self.real_path)
+    if created is not None and not hasattr(created, 'timetuple'):
+      raise ValueError('"created" must be a datetime.datetime instance.')
+    if modified is not None and not hasattr(modified, 'timetuple'):
+      raise ValueError('"modified" must be a datetime.datetime instance.')
+    if created_by is not None and not isinstance(created_by, users.TitanUser):
+      raise ValueError('"created_by" must be a users.TitanUser instance.')
+    if modified_by is not None and not isinstance(modified_by, users.TitanUser):
+      raise ValueError('"modified_by" must be a users.TitanUser instance.')
+    if encoding is not None and content is None and blob is None:
+      raise TypeError(
+          '"content" or "blob" must be passed if "encoding" is passed.')
+    if compression is not None and compression not in _compression_codecs:
+      raise ValueError('Unknown compression codec: %r' % compression)
+
+  @ndb.tasklet
+  def write_async(self, content=None, **kwargs):
+    """Asynchronously write or update a File.
+
+    The existence check is done with load_async() and the entity put and all
+    mixin side-effects go through a _WriteBatch, like Files.write_multi, so
+    both datastore RPCs overlap with other RPCs of the caller. The rest of
+    write(), such as uploading large content to blobstore, runs synchronously
+    once the file is loaded.
+
+    Args:
+      content: File contents. See write().
+      **kwargs: Other keyword arguments for write().
+    Raises:
+      ValueError: If given the internal "_batch" argument.
+    Returns:
+      An ndb.Future whose result is this File.
+    """
+    if '_batch' in kwargs:
+      raise ValueError('Invalid write argument: "_batch"')
+    yield self.load_async()
+    batch = _WriteBatch()
+    self.write(content=content, _batch=batch, **kwargs)
+    yield batch.commit_async()
+    raise ndb.Return(self)
+
   def delete(self, _delete_old_blob=True, _run_mixins_only=False):
     """Delete file.
 
@@ -609,6 +846,33 @@ class File(object):
     self._meta = None
     return self
 
+  @ndb.tasklet
+  def delete_async(self, _delete_old_blob=True):
+    """Asynchronously delete the file.
+
+    Like Files.delete, mixin side-effects run first and the delete RPC after.
+
+    Args:
+      _delete_old_blob: Internal-only flag to avoid deleting associated blobs.
+    Raises:
+      BadFileError: If the file does not exist, when the future is resolved.
+    Returns:
+      An ndb.Future whose result is this File.
+    """
+    yield self.load_async()
+    if not self.exists:
+      raise BadFileError('File does not exist: %s' % self.real_path)
+    self.delete(_delete_old_blob=_delete_old_blob, _run_mixins_only=True)
+    file_ent = self._file
+    yield file_ent.key.delete_async()
+    blob_key = _get_blob_key(file_ent)
+    if blob_key and _delete_old_blob and self._delete_blobs_with_file:
+      yield blobstore.delete_async(blob_key)
+      _clear_blob_cache_for_paths([self.real_path])
+    self._file_ent = None
+    self._meta = None
+    raise ndb.Return(self)
+
   def copy_to(self, destination_file, exclude_meta=None):
     """Copy this and all of its properties to a different path.
 
@@ -635,10 +899,12 @@ class File(object):
             del meta[key]
 
       destination_file.write(
-          content=self._file.content,
+          content=_get_inline_content(self._file),
           blob=self._file.blob,
           mime_type=self.mime_type,
-          meta=meta)
+          meta=meta,
+          encoding=self._file.encoding,
+          compression=self._file.compression)
       return self
     except:
       logging.exception('Error copying file: %s', self.path)
@@ -673,6 +939,8 @@ class File(object):
     Returns:
       A serializable dictionary of this File object's properties.
     """
+    # Avoid fetching the BlobInfo, only the key is needed.
+    blob_key = _get_blob_key(self._file)
     result = {
         'name': self.name,
         'path': self.path,
@@ -680,7 +948,7 @@ class File(object):
         'paths': self.paths,
         'mime_type': self.mime_type,
         'created': self.created,
-        'blob': str(self.blob.key()) if self.blob else None,
+        'blob': str(blob_key) if blob_key else None,
         'modified': self.modified,
         'created_by': str(self.created_by) if self.created_by else None,
         'modified_by': str(self.modified_by) if self.modified_by else None,
@@ -727,6 +995,10 @@ class FactoryState(object):
 # Internal FileFactoryState. See RegisterFileFactory().
 _global_file_factory = FactoryState()
 
+# Internal FactoryState for counting files without a query.
+# See register_file_counter().
+_global_file_counter = FactoryState()
+
 def register_file_factory(file_factory):
   """Register a global file factory, which returns a File subclass.
 
@@ -745,17 +1017,129 @@ def unregister_file_factory():
   """Clear the global file factory."""
   _global_file_factory.unregister()
 
+def register_file_counter(file_counter):
+  """Register a function which counts the files directly within a directory.
+
+  Files.count() uses it for non-recursive, unfiltered counts instead of
+  running a query, for example with the counters kept by the dirs module:
+
+    files.register_file_counter(dirs.count_files)
+
+  Args:
+    file_counter: A callable which takes a directory path and a "namespace"
+        keyword argument, and returns the number of files or None if it
+        cannot count the files of that directory.
+  """
+  _global_file_counter.register(file_counter)
+
+def unregister_file_counter():
+  """Clear the global file counter."""
+  _global_file_counter.unregister()
+
+def register_compression_codec(name, compress, decompress):
+  """Registers a compression codec for File.write(compression=name).
+
+  Codecs cannot be unregistered or changed once content has been stored with
+  them, since the name is recorded on each compressed file.
+
+  Args:
+    name: The name of the codec.
+    compress: A function which takes and returns a byte-string.
+    decompress: The inverse function of compress.
+  """
+  _compression_codecs[name] = (compress, decompress)
+
+def backfill_file_sizes(namespace=None, cursor=None,
+                        batch_size=DEFAULT_BATCH_SIZE):
+  """Migration to store "content_size" and "md5_hash" on pre-existing files.
+
+  Processes one batch of files, then defers itself to process the next batch
+  until all files in the namespace have been visited.
+
+  Usage:
+    deferred.defer(files.backfill_file_sizes, namespace='some-namespace')
+
+  Args:
+    namespace: The filesystem namespace, or None if the default namespace.
+    cursor: A web-safe cursor string of where to resume the migration.
+    batch_size: The number of files to process per task.
+  Returns:
+    The number of files updated in this batch.
+  """
+  query = _TitanFile.query(namespace=namespace)
+  file_ents, next_cursor, more = query.fetch_page(
+      batch_size, start_cursor=_make_cursor(cursor) if cursor else None)
+
+  file_ents = [file_ent for file_ent in file_ents
+               if file_ent.content_size is None]
+  blob_keys = [_get_blob_key(file_ent) for file_ent in file_ents
+               if file_ent.content is None and _get_blob_key(file_ent)]
+  blob_infos = {}
+  if blob_keys:
+    blob_infos = dict(zip(blob_keys, blobstore.BlobInfo.get(blob_keys)))
+
+  updated_file_ents = []
+  for file_ent in file_ents:
+    if file_ent.content is not None:
+      content = _get_inline_content(file_ent)
+      file_ent.content_size = len(content)
+      file_ent.md5_hash = hashlib.md5(content).hexdigest()
+    else:
+      blob_info = blob_infos.get(_get_blob_key(file_ent))
+      if not blob_info:
+        continue
+      file_ent.content_size = blob_info.size
+      file_ent.md5_hash = blob_info.md5_hash
+    updated_file_ents.append(file_ent)
+  ndb.put_multi(updated_file_ents)
+
+  if more and next_cursor:
+    # Imported here, since titan.tasks imports titan.files.
+    from titan.tasks import deferred
+    deferred.defer(backfill_file_sizes, namespace=namespace,
+                   cursor=next_cursor.urlsafe(), batch_size=batch_size)
+  return len(updated_file_ents)
+
 def register_file_mixins(mixin_classes):
   """Registers a factory that returns a dynamic subclass of File with mixins.
 
   This method will overwrite any previously-registered factory method.
 
+  The generated File subclasses are memoized per distinct combination of
+  applied mixins, so that creating many File objects does not create many
+  throwaway classes. Additionally, if every mixin which defines
+  "should_apply_mixin" also defines a "get_mixin_decision_key" classmethod,
+  the should_apply_mixin results are memoized per combination of decision keys.
+  A decision key must capture everything from the File kwargs which the
+  mixin's should_apply_mixin depends on, for example:
+
+    @classmethod
+    def get_mixin_decision_key(cls, **kwargs):
+      return kwargs['path'].startswith('/some/prefix/')
+
+  Decision keys should have a small number of distinct values, since every
+  distinct combination is memoized for the lifetime of the factory.
+
   Args:
     mixin_classes: A list of mixins classes in the order they will be applied.
   """
+  mixin_classes = tuple(mixin_classes)
+  decision_key_fns = _get_mixin_decision_key_fns(mixin_classes)
+  # Mapping of tuples of base classes to the generated File subclass.
+  dynamic_file_classes = {}
+  # Mapping of tuples of mixin decision keys to tuples of base classes.
+  memoized_decisions = {}
 
   def DynamicFileFactory(**kwargs):
     """Factory that dynamically creates a File subclass with mixins included."""
+    decision_key = None
+    if decision_key_fns is not None:
+      decision_key = tuple(
+          [fn(**kwargs) if fn else None for fn in decision_key_fns])
+      base_classes = memoized_decisions.get(decision_key)
+      if base_classes is not None:
+        return dynamic_file_classes[base_classes]
+
     base_classes = []
     shared_mixin_state = {}
     for mixin_cls in mixin_classes:
@@ -766,13 +1150,65 @@ def register_file_mixins(mixin_classes):
       if (not should_apply_mixin_fn
           or should_apply_mixin_fn(_mixin_state=shared_mixin_state, **kwargs)):
         base_classes.append(mixin_cls)
-    # Dynamically create a files.File subclass with all of the given mixins.
     base_classes.append(File)
-    return type('DynamicFile', tuple(base_classes), {})
+    base_classes = tuple(base_classes)
+
+    file_class = dynamic_file_classes.get(base_classes)
+    if file_class is None:
+      # Dynamically create a files.File subclass with all of the given mixins.
+      # Use setdefault so that concurrent requests share the same class.
+      file_class = dynamic_file_classes.setdefault(
+          base_classes, type('DynamicFile', base_classes, {}))
+    if decision_key is not None:
+      memoized_decisions[decision_key] = base_classes
+    return file_class
   register_file_factory(DynamicFileFactory)
 
+def _get_mixin_decision_key_fns(mixin_classes):
+  """Returns a list of each mixin's decision key function, or None.
+
+  Args:
+    mixin_classes: A tuple of mixin classes.
+  Returns:
+    A list parallel to mixin_classes containing either the mixin's
+    get_mixin_decision_key function or None if the mixin is always applied.
+    Returns None (disabling memoization of decisions) if any mixin has a
+    should_apply_mixin method without a corresponding decision key function.
+  """
+  decision_key_fns = []
+  for mixin_cls in mixin_classes:
+    should_apply_owner = _get_defining_class(mixin_cls, 'should_apply_mixin')
+    if should_apply_owner is None:
+      # Always applied.
+      decision_key_fns.append(None)
+      continue
+    # The decision key must be defined by the same class that defines
+    # should_apply_mixin, otherwise a subclass which overrides only
+    # should_apply_mixin would inherit a stale decision key.
+    decision_key_owner = _get_defining_class(
+        mixin_cls, 'get_mixin_decision_key')
+    if decision_key_owner is not should_apply_owner:
+      return None
+    decision_key_fns.append(mixin_cls.get_mixin_decision_key)
+  return decision_key_fns
+
+def _get_defining_class(cls, attr_name):
+  """Returns the class in cls's MRO which defines attr_name, or None."""
+  for klass in inspect.getmro(cls):
+    if attr_name in klass.__dict__:
+      return klass
+  return None
+
 class Files(collections.Mapping):
-  """A mapping of paths to File objects."""
+  """A mapping of paths to File objects.
+
+  Attributes:
+    namespace: The filesystem namespace, or None if the default namespace.
+    cursor: If this object is a page of a paginated listing, an ndb.Cursor
+        pointing to the next page, or None if there are no more results.
+    has_more: If this object is a page of a paginated listing, whether or not
+        more results may exist after this page.
+  """
 
   def __init__(self, paths=None, files=None, namespace=None, **kwargs):
     """Constructor.
@@ -786,6 +1222,8 @@ class Files(collections.Mapping):
       TypeError: If given both paths and files.
     """
     self.namespace = namespace
+    self.cursor = None
+    self.has_more = False
     if paths is not None and files is not None:
       raise TypeError('Exactly one of "paths" or "files" args must be given.')
     self._titan_files = {}
@@ -851,27 +1289,54 @@ class Files(collections.Mapping):
   def clear(self):
     self._titan_files = {}
 
-  def delete(self):
+  def delete(self, _delete_old_blob=True):
     """Delete all files in this container.
 
     This function does not error if the files are already deleted.
 
+    Args:
+      _delete_old_blob: Internal-only flag to avoid deleting associated blobs.
     Returns:
       Self-reference.
     """
+    return self.delete_async(_delete_old_blob=_delete_old_blob).get_result()
+
+  @ndb.tasklet
+  def delete_async(self, _delete_old_blob=True):
+    """Asynchronously delete all files in this container.
+
+    Args:
+      _delete_old_blob: Internal-only flag to avoid deleting associated blobs.
+    Returns:
+      An ndb.Future whose result is this Files object.
+    """
+    # Warm the in-context cache with a single batch get, so that mixins which
+    # check whether each file exists don't make an RPC per file.
+    yield ndb.get_multi_async([
+        ndb.Key(_TitanFile, titan_file.real_path,
+                namespace=titan_file.namespace)
+        for titan_file in self.itervalues()])
     for titan_file in self.itervalues():
       # Run all the mixins, but skip the actual delete RPC.
       # This may break mixins that expect the file to be synchronously deleted.
-      titan_file.delete(_run_mixins_only=True)
+      titan_file.delete(
+          _delete_old_blob=_delete_old_blob, _run_mixins_only=True)
 
     # Load the files to avoid iterative RPCs in _delete_blobs,
     # and to prevent errors from when the index hasn't caught up to deleted
     # files yet.
-    self.load()
+    yield self.load_async()
     real_paths = [f.real_path for f in self.values()]
-    blobs_to_delete = [f.blob for f in self.values() if f.blob]
+    blobs_to_delete = []
+    if _delete_old_blob:
+      blobs_to_delete = [f.blob for f in self.values()
+                         if f._delete_blobs_with_file and f.blob]
 
-    ndb.delete_multi([f._file.key for f in self.itervalues()])
+    yield ndb.delete_multi_async([f._file.key for f in self.itervalues()])
+    # Like File.delete, so that the files can be written again as new files.
+    for titan_file in self.itervalues():
+      titan_file._file_ent = None
+      titan_file._meta = None
 
     # Avoid orphaning files by deleting blobs after the delete_multi succeeds.
     # This introduces the other case where _delete_blobs may fail and
@@ -879,7 +1344,7 @@ class Files(collections.Mapping):
     if blobs_to_delete:
       _delete_blobs(blobs=blobs_to_delete, file_paths=real_paths)
 
-    return self
+    raise ndb.Return(self)
 
   def copy_to(self, dir_path, **kwargs):
     """Copy current files to the given dir_path.
@@ -888,14 +1353,19 @@ class Files(collections.Mapping):
       dir_path: The destination dir_path.
       namespace: The filesystem namespace, or None if the default namespace.
       strip_prefix: The directory prefix to strip from source paths.
-      timeout: The number of seconds to wait for futures to complete.
-          If timeout is given and expires, the function will return
-          without error but operations will continue in the background.
+      timeout: Deprecated and ignored; files are copied in synchronous batches.
       result_files: An optional Files object which will be populated
           with the destination File objects created during the copy.
       failed_files: An optional Files object which will be populated
-          with the source files that failed to copy.
-      max_workers: Number of workers to forge in threading.
+          with the destination files that failed to copy.
+      max_workers: Deprecated and ignored.
+      batch_size: The number of files to copy per batch of RPCs.
+      task_manager: An optional, existing tasks.TaskManager. If given, each
+          batch is copied in a deferred task associated to the task manager,
+          which reports progress and failures; failed_files is not populated.
+          Finalizing the task manager is left to the caller.
+    Raises:
+      CopyFilesError: If any file failed to copy.
     Returns:
       Self-reference.
     """
@@ -909,24 +1379,118 @@ class Files(collections.Mapping):
       dir_path: The destination dir_path.
       namespace: The filesystem namespace, or None if the default namespace.
       strip_prefix: The directory prefix to strip from source paths.
-      timeout: The number of seconds to wait for futures to complete.
-          If timeout is given and expires, the function will return
-          without error but operations will continue in the background.
+      timeout: Deprecated and ignored; files are moved in synchronous batches.
       result_files: An optional Files object which will be populated
           with the destination File objects created during the move.
       failed_files: An optional Files object which will be populated
-          with the source files that failed to move.
-      max_workers: Number of workers to forge in threading.
+          with the destination files that failed to move.
+      max_workers: Deprecated and ignored.
+      batch_size: The number of files to move per batch of RPCs.
+      task_manager: An optional, existing tasks.TaskManager. If given, each
+          batch is moved in a deferred task associated to the task manager,
+          which reports progress and failures; failed_files is not populated.
+          Finalizing the task manager is left to the caller.
+    Raises:
+      CopyFilesError: If any file failed to move.
     Returns:
       Self-reference.
     """
     self._move_or_copy_to(dir_path, is_move=True, **kwargs)
     return self
 
+  @classmethod
+  def write_multi(cls, files_data, namespace=None,
+                  batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    """Write or update many files at once.
+
+    All arguments are validated before anything is written. Existing entities
+    are fetched in one batch, the _TitanFile entities are written in chunked
+    batch puts, and mixin side-effects (such as directory updates or
+    microversion tasks) run once per batch instead of once per file.
+
+    Usage:
+      files.Files.write_multi({
+          '/foo/bar.html': 'Some content',
+          '/foo/baz.json': {'content': '{}', 'meta': {'color': 'blue'}},
+      })
+
+    Args:
+      files_data: A dictionary mapping absolute paths to either the content
+          of the file, or a dictionary of keyword arguments for File.write().
+      namespace: The filesystem namespace, or None if the default namespace.
+      batch_size: The max number of entities written in a single RPC.
+      **kwargs: Keyword arguments to pass through to File objects.
+    Raises:
+      TypeError: For missing arguments.
+      ValueError: For invalid paths or arguments.
+      BadFileError: If updating meta information on a non-existent file.
+    Returns:
+      A Files mapping of the written files.
+    """
+    return cls.write_multi_async(
+        files_data, namespace=namespace, batch_size=batch_size,
+        **kwargs).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def write_multi_async(cls, files_data, namespace=None,
+                        batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+    """Asynchronous version of write_multi.
+
+    Args:
+      files_data: See write_multi().
+      namespace: The filesystem namespace, or None if the default namespace.
+      batch_size: The max number of entities written in a single RPC.
+      **kwargs: Keyword arguments to pass through to File objects.
+    Returns:
+      An ndb.Future whose result is a Files mapping of the written files.
+    """
+    if not isinstance(files_data, collections.Mapping):
+      raise ValueError('"files_data" must be a mapping of paths to content.')
+    titan_files = cls(paths=files_data.keys(), namespace=namespace, **kwargs)
+
+    # Warm the in-context cache with a single batch get, so that the existence
+    # checks in validation and in write() do not each perform an RPC.
+    yield ndb.get_multi_async([
+        ndb.Key(_TitanFile, titan_file.real_path, namespace=namespace)
+        for titan_file in titan_files.itervalues()])
+
+    write_kwargs_map = {}
+    for path, file_data in files_data.iteritems():
+      if isinstance(file_data, collections.Mapping):
+        write_kwargs = dict(file_data)
+      else:
+        write_kwargs = {'content': file_data}
+      if '_batch' in write_kwargs:
+        raise ValueError('Invalid write argument: "_batch"')
+      titan_files[path]._validate_write_args(**write_kwargs)
+      write_kwargs_map[path] = write_kwargs
+
+    batch = _WriteBatch(batch_size=batch_size)
+    for path, write_kwargs in write_kwargs_map.iteritems():
+      titan_files[path].write(_batch=batch, **write_kwargs)
+    yield batch.commit_async()
+    raise ndb.Return(titan_files)
+
   def load(self):
     """If not loaded, load associated paths and remove non-existing ones."""
+    return self.load_async().get_result()
+
+  @ndb.tasklet
+  def load_async(self):
+    """Asynchronous version of load.
+
+    Returns:
+      An ndb.Future whose result is this Files object.
+    """
+    files_by_class = collections.defaultdict(list)
+    for titan_file in self.itervalues():
+      files_by_class[titan_file.__class__].append(titan_file)
+    yield [file_class._resolve_real_paths_async(class_files)
+           for file_class, class_files in files_by_class.iteritems()]
+
     real_path_to_paths = {f.real_path: f.path for f in self.itervalues()}
-    file_ents = _get_titan_file_ents(
+    file_ents = yield _get_titan_file_ents_async(
         real_path_to_paths.keys(), namespace=self.namespace)
     paths_to_clear = []
     for real_path in real_path_to_paths:
@@ -940,7 +1504,20 @@ class Files(collections.Mapping):
 
     for path in paths_to_clear:
       del self[path]
-    return self
+    raise ndb.Return(self)
+
+  @ndb.tasklet
+  def read_async(self):
+    """Asynchronously reads the content of all files.
+
+    Non-existent files are removed, like load().
+
+    Returns:
+      An ndb.Future whose result is a dictionary mapping paths to content.
+    """
+    yield self.load_async()
+    contents = yield _read_contents_async(self.values())
+    raise ndb.Return(contents)
 
   def serialize(self, full=False):
     """serialize the File object to native Python types.
@@ -952,51 +1529,63 @@ class Files(collections.Mapping):
       mapping of paths to serialized File objects found at a given path.
     """
     result = {}
+    if full:
+      # Read all content at once, instead of with RPCs for each file.
+      contents = _read_contents_async(self.values()).get_result()
     for path, titan_file in self._titan_files.iteritems():
-      result[path] = titan_file.serialize(full=full)
+      result[path] = titan_file.serialize()
+      if full:
+        result[path]['content'] = contents[path]
     return result
 
   def _move_or_copy_to(self, dir_path, namespace=None, is_move=False,
                        strip_prefix=None, timeout=None, result_files=None,
                        failed_files=None, max_workers=DEFAULT_MAX_WORKERS,
+                       batch_size=DEFAULT_BATCH_SIZE, task_manager=None,
                        **kwargs):
     """This encapsulate repeated logic for copy_to and move_to methods."""
     utils.validate_dir_path(dir_path)
     destination_map = utils.make_destination_paths_map(
         self.keys(), destination_dir_path=dir_path, strip_prefix=strip_prefix)
+    file_pairs = []
+    for source_path, destination_path in destination_map.iteritems():
+      destination_file = File(destination_path, namespace=namespace, **kwargs)
+      file_pairs.append((self[source_path], destination_file))
+    if result_files is not None:
+      result_files.update(Files(
+          files=[destination_file for _, destination_file in file_pairs],
+          namespace=namespace))
+
+    if task_manager is not None:
+      for file_pairs_chunk in utils.chunk_generator(
+          file_pairs, chunk_size=batch_size):
+        paths_chunk = []
+        for source_file, destination_file in file_pairs_chunk:
+          # The path and namespace are passed to the task separately.
+          source_kwargs = source_file._original_kwargs.copy()
+          del source_kwargs['path']
+          del source_kwargs['namespace']
+          paths_chunk.append(
+              (source_file.path, source_kwargs, destination_file.path))
+        first_source_path, _, first_destination_path = paths_chunk[0]
+        task_key = '%s:%s:%s' % ('move' if is_move else 'copy',
+                                 first_source_path, first_destination_path)
+        task_manager.defer_task(
+            task_key, _move_or_copy_paths, paths_chunk,
+            source_namespace=self.namespace, destination_namespace=namespace,
+            is_move=is_move, file_kwargs=kwargs)
+      return
 
-    future_results = []
-    if not futures:
-      raise ImportError(
-          'Moving or copying files requires the Python futures library: '
-          'http://code.google.com/p/pythonfutures/')
-    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-      for source_path, destination_path in destination_map.iteritems():
-        source_file = self[source_path]
-        destination_file = File(destination_path, namespace=namespace, **kwargs)
-        if result_files is not None:
-          result_files.update(
-              Files(files=[destination_file], namespace=namespace))
-        file_method = source_file.move_to if is_move else source_file.copy_to
-        future = executor.submit(file_method, destination_file)
-        future_results.append(future)
-      futures.wait(future_results, timeout=timeout)
     errors = []
-    for future in future_results:
-      try:
-        future.result()
-      except (CopyFileError, MoveFileError) as e:
-        if failed_files is not None:
-          # No namespace here, since this is a source file.
-          failed_files.update(Files(files=[e.titan_file]))
-        # Remove the failed file from successfully copied files collection.
-        if result_files is not None:
-          del result_files[e.titan_file.path]
-        logging.exception('Operation failed:')
-        errors.append(e)
-
-    # Important: clear the in-context cache since we changed state in threads.
-    ndb.get_context().clear_cache()
+    for file_pairs_chunk in utils.chunk_generator(
+        file_pairs, chunk_size=batch_size):
+      errors.extend(_move_or_copy_files(file_pairs_chunk, is_move=is_move))
+    for e in errors:
+      if failed_files is not None:
+        failed_files.update(Files(files=[e.titan_file], namespace=namespace))
+      # Remove the failed file from successfully copied files collection.
+      if result_files is not None:
+        del result_files[e.titan_file.path]
 
     if errors:
       raise CopyFilesError(
@@ -1011,7 +1600,8 @@ class Files(collections.Mapping):
 
   @classmethod
   def list(cls, dir_path, namespace=None, recursive=False, depth=None,
-           filters=None, limit=None, offset=None, order=None, **kwargs):
+           filters=None, limit=None, offset=None, order=None, cursor=None,
+           page_size=None, metadata_only=False, **kwargs):
     """Factory method to return a lazy Files mapping for the given dir.
 
     Args:
@@ -1022,21 +1612,105 @@ class Files(collections.Mapping):
           1 is one folder deep, 2 is two folders deep, etc.
       filters: An iterable of FileProperty comparisons, for example:
           [FileProperty('created_by') == 'example@example.com']
+          The file size is stored as FileProperty('content_size'), since
+          FileProperty('size') refers to the "size" meta property.
       order: An iterable of FileProperty objects to sort the result set.
       limit: An integer limiting the number of files returned.
       offset: Number of files to offset the query by.
+      cursor: An ndb.Cursor or a web-safe cursor string from a previous page's
+          "cursor" attribute. If given, only one page of results is returned.
+      page_size: The number of files in a page. If given, only one page of
+          results is returned and the "cursor" and "has_more" attributes of the
+          result are populated. Defaults to DEFAULT_PAGE_SIZE if only "cursor"
+          is given. Cannot be combined with "limit".
+      metadata_only: Whether to return read-only FileStub objects populated by
+          a projection query, instead of lazy File objects. This avoids
+          loading file content for listings. Requires the composite indexes
+          in titan/files/index.yaml, cannot be combined with equality filters
+          on the projected properties, and excludes files which have not been
+          migrated by backfill_file_sizes().
     Raises:
-      ValueError: If given an invalid depth argument.
+      ValueError: If given an invalid depth, cursor, or page_size argument.
     Returns:
       A populated Files mapping.
     """
     files_query = _create_files_query(
         dir_path, namespace=namespace, recursive=recursive, depth=depth,
         filters=filters, order=order)
-    # TODO(user): support cursors.
-    file_keys = files_query.fetch(limit=limit, offset=offset, keys_only=True)
-    titan_files = cls(
-        [key.id() for key in file_keys], namespace=namespace, **kwargs)
+    if metadata_only:
+      fetch_options = {'projection': FileStub._PROJECTION}
+    else:
+      fetch_options = {'keys_only': True}
+    if cursor is None and page_size is None:
+      results = files_query.fetch(limit=limit, offset=offset, **fetch_options)
+      return cls._make_files(results, namespace=namespace, **kwargs)
+
+    if limit is not None:
+      raise ValueError('"limit" cannot be combined with "page_size".')
+    page_size = _validate_page_size(page_size)
+    results, next_cursor, has_more = files_query.fetch_page(
+        page_size, start_cursor=_make_cursor(cursor), offset=offset,
+        **fetch_options)
+    return cls._make_page(
+        results, next_cursor, has_more, namespace=namespace, **kwargs)
+
+  @classmethod
+  def iter_list(cls, dir_path, namespace=None, recursive=False, depth=None,
+                filters=None, order=None, cursor=None,
+                page_size=DEFAULT_PAGE_SIZE, **kwargs):
+    """Generator of lazy Files mappings, one per page of the given dir.
+
+    While the caller processes a page, the query for the next page is already
+    running asynchronously.
+
+    Usage:
+      for titan_files in files.Files.iter_list('/some/dir', recursive=True):
+        titan_files.delete()
+
+    Args:
+      dir_path: Absolute directory path.
+      namespace: The filesystem namespace, or None if the default namespace.
+      recursive: Whether to list files recursively.
+      depth: If recursive, a positive integer to limit the recursion depth.
+      filters: An iterable of FileProperty comparisons.
+      order: An iterable of FileProperty objects to sort the result set.
+      cursor: An optional ndb.Cursor or web-safe cursor string to start from.
+      page_size: The number of files in each page.
+    Raises:
+      ValueError: If given an invalid depth, cursor, or page_size argument.
+    Yields:
+      Files mappings with the "cursor" and "has_more" attributes populated.
+    """
+    files_query = _create_files_query(
+        dir_path, namespace=namespace, recursive=recursive, depth=depth,
+        filters=filters, order=order)
+    page_size = _validate_page_size(page_size)
+    future = files_query.fetch_page_async(
+        page_size, start_cursor=_make_cursor(cursor), keys_only=True)
+    while future is not None:
+      file_keys, next_cursor, has_more = future.get_result()
+      future = None
+      if has_more and next_cursor:
+        # Prefetch the next page while the caller handles the current one.
+        future = files_query.fetch_page_async(
+            page_size, start_cursor=next_cursor, keys_only=True)
+      yield cls._make_page(
+          file_keys, next_cursor, has_more, namespace=namespace, **kwargs)
+
+  @classmethod
+  def _make_files(cls, results, namespace=None, **kwargs):
+    """Makes a Files mapping from keys-only or projection query results."""
+    if results and isinstance(results[0], _TitanFile):
+      return cls(files=[FileStub(file_ent) for file_ent in results],
+                 namespace=namespace)
+    return cls([key.id() for key in results], namespace=namespace, **kwargs)
+
+  @classmethod
+  def _make_page(cls, results, next_cursor, has_more, namespace=None,
+                 **kwargs):
+    titan_files = cls._make_files(results, namespace=namespace, **kwargs)
+    titan_files.has_more = bool(has_more and next_cursor)
+    titan_files.cursor = next_cursor if titan_files.has_more else None
     return titan_files
 
   @staticmethod
@@ -1056,6 +1730,12 @@ class Files(collections.Mapping):
     Returns:
       A count of files that match the query.
     """
+    if (not recursive and depth is None and not filters
+        and _global_file_counter.is_registered):
+      utils.validate_dir_path(dir_path)
+      num_files = _global_file_counter(dir_path, namespace=namespace)
+      if num_files is not None:
+        return num_files
     files_query = _create_files_query(
         dir_path, namespace=namespace, recursive=recursive, depth=depth,
         filters=filters)
@@ -1102,6 +1782,281 @@ class OrderedFiles(Files):
     for path in self._ordered_paths:
       yield path
 
+class FileStub(object):
+  """A read-only summary of a file, populated from a projection query.
+
+  FileStub objects are returned by Files.list(metadata_only=True). They expose
+  the subset of File attributes listed in PROPERTIES, plus the path-derived
+  attributes, without ever loading file content. Use File(stub.path) to get a
+  full File object.
+  """
+
+  PROPERTIES = (
+      'name',
+      'mime_type',
+      'created',
+      'modified',
+      'size',
+      'created_by',
+      'modified_by',
+  )
+
+  # The _TitanFile properties which back PROPERTIES.
+  _PROJECTION = (
+      'name',
+      'mime_type',
+      'created',
+      'modified',
+      'content_size',
+      'created_by',
+      'modified_by',
+  )
+
+  def __init__(self, file_ent):
+    """Constructor.
+
+    Args:
+      file_ent: A _TitanFile entity from a projection on _PROJECTION.
+    """
+    self._file_ent = file_ent
+
+  def __repr__(self):
+    return '<%s: %s namespace:%r>' % (
+        self.__class__.__name__, self.path, self.namespace)
+
+  @property
+  def path(self):
+    return self._file_ent.key.id()
+
+  @property
+  def real_path(self):
+    return self.path
+
+  @property
+  def dir_path(self):
+    return os.path.dirname(self.path)
+
+  @property
+  def namespace(self):
+    return self._file_ent.key.namespace() or None
+
+  @property
+  def name(self):
+    return self._file_ent.name
+
+  @property
+  def mime_type(self):
+    return self._file_ent.mime_type
+
+  @property
+  def created(self):
+    return self._file_ent.created
+
+  @property
+  def modified(self):
+    return self._file_ent.modified
+
+  @property
+  def size(self):
+    return self._file_ent.content_size
+
+  @property
+  def created_by(self):
+    return self._file_ent.created_by
+
+  @property
+  def modified_by(self):
+    return self._file_ent.modified_by
+
+  @property
+  def exists(self):
+    return True
+
+  def serialize(self, full=False):
+    """Serializes the stub to native Python types.
+
+    Args:
+      full: Unsupported, since stubs never have content.
+    Raises:
+      ValueError: If "full" is given.
+    Returns:
+      A serializable dictionary of the projected file properties.
+    """
+    if full:
+      raise ValueError('FileStub objects cannot be serialized with content.')
+    result = {
+        'path': self.path,
+        'real_path': self.real_path,
+    }
+    for name in FileStub.PROPERTIES:
+      result[name] = getattr(self, name)
+    for name in ('created_by', 'modified_by'):
+      result[name] = str(result[name]) if result[name] else None
+    return result
+
+class _WriteBatch(object):
+  """Collects entity writes and side-effects for Files.write_multi.
+
+  File.write() and mixins add entities and "hook items" to the batch instead of
+  doing RPCs directly. On commit, all entities are written in chunks, then each
+  registered hook function is called exactly once with the list of its items.
+
+  Usage (inside of a File.write override):
+    if _batch is not None:
+      _batch.add_hook_item('mymixin:tasks', _add_tasks, task)
+  """
+
+  def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+    self._batch_size = batch_size
+    self._file_ents = []
+    # Mapping of hook names to two-tuples of (func, items).
+    self._hooks = collections.OrderedDict()
+
+  def add_file_ent(self, file_ent):
+    self._file_ents.append(file_ent)
+
+  def add_hook_item(self, name, func, item):
+    """Adds an item to be passed to func once all entities are written.
+
+    Args:
+      name: A unique name for the hook, usually prefixed by the module name.
+      func: A callable which will be given a list of all items of this hook.
+      item: An arbitrary object to add to the hook's list of items.
+    """
+    if name not in self._hooks:
+      self._hooks[name] = (func, [])
+    self._hooks[name][1].append(item)
+
+  def commit(self):
+    """Writes all entities in chunks, then runs hooks."""
+    self.commit_async().get_result()
+
+  @ndb.tasklet
+  def commit_async(self):
+    """Asynchronous version of commit."""
+    put_futures = []
+    for file_ents in utils.chunk_generator(
+        self._file_ents, chunk_size=self._batch_size):
+      put_futures.extend(ndb.put_multi_async(file_ents))
+    # Raise the first error, if any, before running side-effects.
+    yield put_futures
+    for func, items in self._hooks.itervalues():
+      func(items)
+
+class _ContentReader(object):
+  """Read-only file-like object over in-memory content, like BlobReader."""
+
+  def __init__(self, content):
+    self._fp = cStringIO.StringIO(content)
+
+  def __getattr__(self, name):
+    # Delegate read, readline, readlines, seek, tell, close, etc.
+    return getattr(self._fp, name)
+
+  def __iter__(self):
+    return iter(self._fp)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._fp.close()
+
+class _FileWriter(object):
+  """Write-only file-like object which streams content to a File.
+
+  Attributes:
+    closed: Whether or not the writer has been closed.
+    md5_hash: The hex md5 hash of the content written so far.
+    size: The number of bytes written so far.
+  """
+
+  def __init__(self, titan_file, buffer_size=DEFAULT_BUFFER_SIZE,
+               write_kwargs=None):
+    self._titan_file = titan_file
+    self._buffer_size = buffer_size
+    self._write_kwargs = write_kwargs or {}
+    self._buffer = []
+    self._num_buffered_bytes = 0
+    self._blobstore_writer = None
+    self._md5 = hashlib.md5()
+    self.size = 0
+    self.closed = False
+
+  @property
+  def md5_hash(self):
+    return self._md5.hexdigest()
+
+  def write(self, content):
+    """Appends a byte-string to the file."""
+    if self.closed:
+      raise ValueError('I/O operation on closed file.')
+    if isinstance(content, unicode):
+      raise TypeError(
+          'Streamed content must be a byte string. Encode unicode content and '
+          'pass "encoding" to open() instead.')
+    self._md5.update(content)
+    self.size += len(content)
+    self._buffer.append(content)
+    self._num_buffered_bytes += len(content)
+    # Content is kept in memory until it is too large to be stored inline.
+    if (self.size > MAX_CONTENT_SIZE
+        and self._num_buffered_bytes >= self._buffer_size):
+      self._flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def close(self):
+    """Writes the File. Does nothing if already closed."""
+    if self.closed:
+      return
+    self.closed = True
+    if self._blobstore_writer is None and self.size <= MAX_CONTENT_SIZE:
+      content = ''.join(self._buffer)
+      self._buffer = []
+      self._titan_file.write(content=content, **self._write_kwargs)
+      return
+
+    self._flush()
+    blob_key = self._blobstore_writer.close()
+    # Blob de-duping, like utils.write_to_blobstore: if the content is the same
+    # as the old file's blob, keep the old blob.
+    old_blobinfo = self._titan_file.blob if self._titan_file.exists else None
+    if old_blobinfo and old_blobinfo.md5_hash == self.md5_hash:
+      blobstore.delete(blob_key)
+      blob_key = old_blobinfo.key()
+    self._titan_file.write(
+        blob=blob_key, _blob_size=self.size, _blob_md5_hash=self.md5_hash,
+        **self._write_kwargs)
+    _clear_blob_cache_for_paths([self._titan_file.real_path])
+
+  def _flush(self):
+    if self._blobstore_writer is None:
+      self._blobstore_writer = utils.BlobstoreWriter(
+          mime_type=self._write_kwargs.get('mime_type'))
+    content = ''.join(self._buffer)
+    self._buffer = []
+    self._num_buffered_bytes = 0
+    self._blobstore_writer.write(content)
+
+  def _abort(self):
+    self.closed = True
+    self._buffer = []
+    if self._blobstore_writer is not None:
+      # Unfinalized blobstore files cannot be deleted, so finalize first.
+      blobstore.delete(self._blobstore_writer.close())
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    elif not self.closed:
+      self._abort()
+
 class FileProperty(ndb.GenericProperty):
   """A convenience wrapper for creating filters for Files.list.
 
@@ -1135,7 +2090,10 @@ class _TitanFile(ndb.Expando):
     blobs: Deprecated; use "blob" instead.
     created_by: A users.TitanUser of who first created the file, or None.
     modified_by: A users.TitanUser of who last modified the file, or None.
-    md5_hash: Pre-computed md5 hash of the entity's content or blob.
+    content_size: The number of bytes of the entity's uncompressed content.
+        Not named "size", which would collide with existing meta properties.
+    md5_hash: Pre-computed md5 hash of the entity's uncompressed content.
+    compression: The name of the codec which compressed "content", or None.
   """
   name = ndb.StringProperty()
   dir_path = ndb.StringProperty()
@@ -1150,7 +2108,9 @@ class _TitanFile(ndb.Expando):
   blobs = ndb.BlobKeyProperty(repeated=True)  # Deprecated; use "blob" instead.
   created_by = users.TitanUserProperty()
   modified_by = users.TitanUserProperty()
+  content_size = ndb.IntegerProperty()
   md5_hash = ndb.StringProperty(indexed=False)
+  compression = ndb.StringProperty(indexed=False)
 
   BASE_PROPERTIES = frozenset((
       'name',
@@ -1166,7 +2126,9 @@ class _TitanFile(ndb.Expando):
       'blobs',
       'created_by',
       'modified_by',
+      'content_size',
       'md5_hash',
+      'compression',
   ))
 
   RESERVED_PROPERTIES = frozenset((
@@ -1227,14 +2189,19 @@ def _get_titan_file_ents(paths, namespace=None):
   Returns:
     An OrderedDict mapping paths to file entities which exist.
   """
-  file_ents = ndb.get_multi(
+  return _get_titan_file_ents_async(paths, namespace=namespace).get_result()
+
+@ndb.tasklet
+def _get_titan_file_ents_async(paths, namespace=None):
+  """Asynchronous version of _get_titan_file_ents."""
+  file_ents = yield ndb.get_multi_async(
       [ndb.Key(_TitanFile, path, namespace=namespace) for path in paths])
   # Use an OrderedDict to preserve the alphabetical ordering from the query.
   file_objs = collections.OrderedDict()
   for f in file_ents:
     if f:
       file_objs[f.path] = f
-  return file_objs
+  raise ndb.Return(file_objs)
 
 def _get_file_entities(titan_files):
   """Get _TitanFile entities from File objects; use sparingly."""
@@ -1280,44 +2247,277 @@ def _create_files_query(dir_path, namespace=None, recursive=False, depth=None,
     files_query = files_query.order(*order)
   return files_query
 
+def _make_cursor(cursor):
+  """Returns an ndb.Cursor from a cursor or web-safe cursor string."""
+  if cursor is None or isinstance(cursor, ndb.Cursor):
+    return cursor
+  if not isinstance(cursor, basestring):
+    raise ValueError('Invalid cursor: %r' % cursor)
+  try:
+    return ndb.Cursor(urlsafe=cursor)
+  except (datastore_errors.BadValueError, TypeError):
+    raise ValueError('Invalid cursor: %r' % cursor)
+
+def _validate_page_size(page_size):
+  if page_size is None:
+    return DEFAULT_PAGE_SIZE
+  if not isinstance(page_size, (int, long)) or page_size <= 0:
+    raise ValueError('page_size must be a positive integer.')
+  return page_size
+
+def _move_or_copy_files(file_pairs, is_move=False):
+  """Copies or moves a batch of files.
+
+  Source and destination entities are fetched in one batch. Destinations are
+  written as a single _WriteBatch from the source entities, reusing blob keys
+  without reading any blob content.
+
+  Args:
+    file_pairs: A list of (source File, destination File) tuples. All sources
+        must be in the same namespace, and all destinations likewise.
+    is_move: Whether or not to delete the source files after copying them.
+  Returns:
+    A list of CopyFileError or MoveFileError objects for failed destinations.
+  """
+  error_class = MoveFileError if is_move else CopyFileError
+  # Warm the in-context cache with a single batch get.
+  ndb.get_multi([
+      ndb.Key(_TitanFile, titan_file.real_path, namespace=titan_file.namespace)
+      for file_pair in file_pairs for titan_file in file_pair])
+
+  errors = []
+  existing_pairs = []
+  for source_file, destination_file in file_pairs:
+    if source_file.exists:
+      existing_pairs.append((source_file, destination_file))
+    else:
+      logging.error('Error copying file, does not exist: %s', source_file.path)
+      errors.append(error_class(destination_file))
+  if not existing_pairs:
+    return errors
+
+  # Delete existing destinations first so that none of their properties
+  # survive, but never delete blobs which are shared with a source file.
+  source_blob_keys = set(
+      _get_blob_key(source_file._file) for source_file, _ in existing_pairs)
+  existing_destination_files = [
+      destination_file for _, destination_file in existing_pairs
+      if destination_file.exists]
+  if existing_destination_files:
+    blob_keys_to_delete = []
+    for destination_file in existing_destination_files:
+      blob_key = _get_blob_key(destination_file._file)
+      if (blob_key and blob_key not in source_blob_keys
+          and destination_file._delete_blobs_with_file):
+        blob_keys_to_delete.append(blob_key)
+    Files(files=existing_destination_files,
+          namespace=existing_destination_files[0].namespace).delete(
+              _delete_old_blob=False)
+    if blob_keys_to_delete:
+      blobstore.delete(blob_keys_to_delete)
+    _clear_blob_cache_for_paths(
+        [destination_file.real_path
+         for destination_file in existing_destination_files])
+
+  batch = _WriteBatch(batch_size=len(existing_pairs))
+  written_pairs = []
+  for source_file, destination_file in existing_pairs:
+    logging.info('Copying Titan file: %s --> %s', source_file.real_path,
+                 destination_file.real_path)
+    file_ent = source_file._file
+    try:
+      destination_file.write(
+          content=_get_inline_content(file_ent),
+          blob=_get_blob_key(file_ent),
+          mime_type=source_file.mime_type,
+          meta=source_file.meta.serialize(),
+          encoding=file_ent.encoding,
+          compression=file_ent.compression,
+          _batch=batch)
+    except:
+      logging.exception('Error copying file: %s', source_file.path)
+      errors.append(error_class(destination_file))
+    else:
+      written_pairs.append((source_file, destination_file))
+  try:
+    batch.commit()
+  except:
+    logging.exception('Error writing batch of copied files.')
+    errors.extend(error_class(destination_file)
+                  for _, destination_file in written_pairs)
+    return errors
+
+  if is_move and written_pairs:
+    source_files = [source_file for source_file, _ in written_pairs]
+    try:
+      # Blobs now belong to the destination files.
+      Files(files=source_files, namespace=source_files[0].namespace).delete(
+          _delete_old_blob=False)
+    except:
+      logging.exception('Error deleting moved files.')
+      errors.extend(error_class(destination_file)
+                    for _, destination_file in written_pairs)
+  return errors
+
+def _move_or_copy_paths(paths, source_namespace=None,
+                        destination_namespace=None, is_move=False,
+                        file_kwargs=None):
+  """Deferred task to copy or move a batch of files.
+
+  Args:
+    paths: A list of (source path, source File kwargs, destination path).
+    source_namespace: The namespace of the source files.
+    destination_namespace: The namespace of the destination files.
+    is_move: Whether or not to delete the source files after copying them.
+    file_kwargs: Keyword arguments to pass through to destination File objects.
+  Raises:
+    CopyFilesError: If any file failed to copy, which fails the task.
+  """
+  file_pairs = []
+  for source_path, source_kwargs, destination_path in paths:
+    source_file = File(source_path, namespace=source_namespace, **source_kwargs)
+    destination_file = File(
+        destination_path, namespace=destination_namespace,
+        **(file_kwargs or {}))
+    file_pairs.append((source_file, destination_file))
+  errors = _move_or_copy_files(file_pairs, is_move=is_move)
+  if errors:
+    raise CopyFilesError(
+        'Failed to copy files: \n%s' % '\n'.join([str(e) for e in errors]))
+
+def _get_blob_key(file_ent):
+  if file_ent.blob:
+    return file_ent.blob
+  # Backwards-compatibility with deprecated "blobs" property.
+  return file_ent.blobs[0] if file_ent.blobs else None
+
 def _delete_blobs(blobs, file_paths):
   blobstore.delete([b.key() for b in blobs])
   _clear_blob_cache_for_paths(file_paths)
 
+def _delete_blobs_for_batch(blobs_and_paths):
+  """_WriteBatch hook to delete replaced blobs after the batch is written."""
+  blobs = [blob for blob, _ in blobs_and_paths]
+  file_paths = [path for _, path in blobs_and_paths]
+  _delete_blobs(blobs=blobs, file_paths=file_paths)
+
 def _read_content_or_blob(titan_file):
-  file_ent = _get_file_entities(titan_file)
-  if not file_ent:
-    raise BadFileError('File does not exist: %s' % titan_file.path)
-  if file_ent.content is not None:
-    content = file_ent.content
-  else:
-    content = _get_blob_cache(file_ent.path)
-    if content is None:
-      blob = file_ent.blob
-      if not file_ent.blob:
-        # Backwards-compatibility with deprecated "blobs" property:
-        blob = blobstore.BlobInfo.get(file_ent.blobs[0])
-      if not isinstance(blob, blobstore.BlobInfo):
-        blob = blobstore.BlobInfo(blob)
-      try:
-        content = blob.open().read()
-      except blobstore.BlobNotFoundError:
-        raise blobstore.BlobNotFoundError(
-            'Blob associated to path was not found: %s' % titan_file.path)
-      _store_blob_cache(file_ent.path, content)
-  if file_ent.encoding:
-    return content.decode(file_ent.encoding)
-  return content
+  return _read_contents_async([titan_file]).get_result()[titan_file.path]
+
+@ndb.tasklet
+def _read_contents_async(titan_files):
+  """Reads the content of many files with batched RPCs.
+
+  The blob cache is read and written with a single sharded_cache call each,
+  and uncached blobs are fetched in parallel.
+
+  Args:
+    titan_files: An iterable of File objects.
+  Raises:
+    BadFileError: If any of the files does not exist.
+  Returns:
+    An ndb.Future whose result is a dictionary mapping paths to content.
+  """
+  titan_files = list(titan_files)
+  yield [titan_file.load_async() for titan_file in titan_files
+         if not titan_file.is_loaded]
+  file_ents = {}
+  for titan_file in titan_files:
+    file_ent = _get_file_entities(titan_file)
+    if not file_ent:
+      raise BadFileError('File does not exist: %s' % titan_file.path)
+    file_ents[titan_file.path] = file_ent
+
+  blob_file_ents = [file_ent for file_ent in file_ents.itervalues()
+                    if file_ent.content is None]
+  blob_cache = {}
+  if blob_file_ents:
+    blob_cache = _get_blob_cache_multi(
+        [file_ent.path for file_ent in blob_file_ents])
+  uncached_file_ents = [file_ent for file_ent in blob_file_ents
+                        if file_ent.path not in blob_cache]
+  blob_contents = yield [
+      _fetch_blob_async(
+          _get_blob_key(file_ent), file_ent.content_size, file_ent.path)
+      for file_ent in uncached_file_ents]
+  if uncached_file_ents:
+    fetched_blob_cache = dict(zip(
+        [file_ent.path for file_ent in uncached_file_ents], blob_contents))
+    _store_blob_cache_multi(fetched_blob_cache)
+    blob_cache.update(fetched_blob_cache)
+
+  contents = {}
+  for path, file_ent in file_ents.iteritems():
+    if file_ent.content is not None:
+      content = _get_inline_content(file_ent)
+    else:
+      content = blob_cache[file_ent.path]
+    if file_ent.encoding:
+      content = content.decode(file_ent.encoding)
+    contents[path] = content
+  raise ndb.Return(contents)
+
+@ndb.tasklet
+def _fetch_blob_async(blob_key, size, path):
+  """Fetches the content of a blob, with parallel fetch_data RPCs."""
+  if size is None:
+    # Backwards-compatibility with entities which predate "content_size".
+    blob_info = blobstore.BlobInfo.get(blob_key)
+    if not blob_info:
+      raise blobstore.BlobNotFoundError(
+          'Blob associated to path was not found: %s' % path)
+    size = blob_info.size
+  try:
+    chunks = yield [
+        _fetch_data_async(
+            blob_key, start,
+            min(start + blobstore.MAX_BLOB_FETCH_SIZE, size) - 1)
+        for start in xrange(0, size, blobstore.MAX_BLOB_FETCH_SIZE)]
+  except blobstore.BlobNotFoundError:
+    raise blobstore.BlobNotFoundError(
+        'Blob associated to path was not found: %s' % path)
+  raise ndb.Return(''.join(chunks))
+
+@ndb.tasklet
+def _fetch_data_async(blob_key, start_index, end_index):
+  # Wrap the UserRPC in a tasklet so that many fetches can run in parallel.
+  data = yield blobstore.fetch_data_async(blob_key, start_index, end_index)
+  raise ndb.Return(data)
+
+def _get_inline_content(file_ent):
+  """Returns the uncompressed inline content of a _TitanFile, or None."""
+  if file_ent.content is None or not file_ent.compression:
+    return file_ent.content
+  decompress = _compression_codecs[file_ent.compression][1]
+  return decompress(file_ent.content)
 
 def _get_blob_cache(path):
   """Get a blob's content from the sharded cache."""
   return sharded_cache.Get(_BLOB_MEMCACHE_PREFIX + path)
 
+def _get_blob_cache_multi(paths):
+  """Get many blobs' content from the sharded cache, keyed by path."""
+  cache_keys = [_BLOB_MEMCACHE_PREFIX + path for path in paths]
+  prefix_length = len(_BLOB_MEMCACHE_PREFIX)
+  return dict((key[prefix_length:], content) for key, content
+              in sharded_cache.GetMulti(cache_keys).iteritems())
+
 def _store_blob_cache(path, content):
-  """Set a blob's content in the sharded cache."""
+  """Set a blob's content in the sharded cache, if small enough."""
+  if len(content) > MAX_BLOB_CACHE_SIZE:
+    return False
   return sharded_cache.Set(_BLOB_MEMCACHE_PREFIX + path, content)
 
+def _store_blob_cache_multi(contents):
+  """Set many blobs' content in the sharded cache, if small enough."""
+  mapping = {}
+  for path, content in contents.iteritems():
+    if len(content) <= MAX_BLOB_CACHE_SIZE:
+      mapping[_BLOB_MEMCACHE_PREFIX + path] = content
+  if not mapping:
+    return False
+  return sharded_cache.SetMulti(mapping)
+
 def _clear_blob_cache_for_paths(paths):
   """Delete blobs from the sharded cache."""
-  for path in paths:
-    sharded_cache.Delete(_BLOB_MEMCACHE_PREFIX + path)
+  sharded_cache.DeleteMulti([_BLOB_MEMCACHE_PREFIX + path for path in paths])
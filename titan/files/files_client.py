@@ -301,7 +301,7 @@ class RemoteFiles(collections.Mapping):
   def clear(self):
     self._titan_files = {}
 
-  def list(self, dir_path, recursive=False, depth=None):
+  def list(self, dir_path, recursive=False, depth=None, page_size=None):
     """Method to populate the current RemoteFiles mapping for the given dir.
 
     This method knowingly diverges from the API as it doesn't return a
@@ -313,6 +313,8 @@ class RemoteFiles(collections.Mapping):
       recursive: Whether to list files recursively.
       depth: If recursive, a positive integer to limit the recusion depth.
           1 is one folder deep, 2 is two folders deep, etc.
+      page_size: If given, page through the directory listing with this
+          many paths per request, instead of listing it in a single request.
 
     """
     params = [('dir_path', dir_path), ('ids_only', 'true')]
@@ -320,19 +322,28 @@ class RemoteFiles(collections.Mapping):
       params.append(('recursive', 'true'))
     if depth is not None:
       params.append(('depth', depth))
-
-    url = '%s?%s' % (FILES_API_PATH_BASE, urllib.urlencode(params))
-
-    response = self._titan_client.fetch_url(url)
-    self._verify_response(response)
-    data = json.loads(response.content)
+    if page_size is not None:
+      params.append(('page_size', page_size))
 
     if self._titan_files:
       self._titan_files = {}
 
-    for path in data['paths']:
-      self._titan_files[path] = RemoteFile(path=path,
-                                           _titan_client=self._titan_client)
+    cursor = None
+    while True:
+      page_params = params[:]
+      if cursor:
+        page_params.append(('cursor', cursor))
+      url = '%s?%s' % (FILES_API_PATH_BASE, urllib.urlencode(page_params))
+      response = self._titan_client.fetch_url(url)
+      self._verify_response(response)
+      data = json.loads(response.content)
+
+      for path in data['paths']:
+        self._titan_files[path] = RemoteFile(path=path,
+                                             _titan_client=self._titan_client)
+      cursor = data.get('cursor')
+      if not data.get('has_more') or not cursor:
+        break
     return self
 
   def delete(self):
@@ -144,6 +144,9 @@ class FilesHandler(handlers.BaseHandler):
       recursive = False if recursive == 'false' else True
       ids_only = self.request.get('ids_only', 'false')
       ids_only = False if ids_only == 'false' else True
+      # Optionally list only file metadata, without loading file content.
+      metadata_only = self.request.get('metadata_only', 'false')
+      metadata_only = False if metadata_only == 'false' else True
       depth = self.request.get('depth', None)
       if depth:
         try:
@@ -151,12 +154,29 @@ class FilesHandler(handlers.BaseHandler):
         except ValueError:
           self.error(400)
           self.response.out.write('Invalid depth parameter')
+      # Optional pagination. If either "cursor" or "page_size" is given, a
+      # single page is returned along with the cursor for the next page.
+      cursor = self.request.get('cursor', None)
+      page_size = self.request.get('page_size', None)
+      is_paged = cursor is not None or page_size is not None
       try:
+        if page_size is not None:
+          page_size = int(page_size)
         titan_files = files.OrderedFiles.list(dir_path=dir_path,
                                               recursive=recursive,
-                                              depth=depth)
-        if ids_only:
-          result = {'paths': titan_files.keys()}
+                                              depth=depth,
+                                              cursor=cursor or None,
+                                              page_size=page_size,
+                                              metadata_only=metadata_only)
+        if ids_only or is_paged:
+          if ids_only:
+            result = {'paths': titan_files.keys()}
+          else:
+            result = {'files': titan_files}
+          if is_paged:
+            result['cursor'] = (
+                titan_files.cursor.urlsafe() if titan_files.cursor else None)
+            result['has_more'] = titan_files.has_more
           self.write_json_response(result)
           return
       except ValueError:
@@ -235,7 +255,29 @@ class DirsHandler(handlers.BaseHandler):
     dir_path = self.request.get('dir_path')
     if not dir_path:
       self.abort(400)
-    titan_dirs = dirs.Dirs.list(dir_path)
+    # Optional pagination. If either "cursor" or "page_size" is given, a
+    # single page is returned along with the cursor for the next page.
+    cursor = self.request.get('cursor', None)
+    page_size = self.request.get('page_size', None)
+    is_paged = cursor is not None or page_size is not None
+    try:
+      if page_size is not None:
+        page_size = int(page_size)
+      # Fetch the dir entities with the query, since they are serialized.
+      titan_dirs = dirs.Dirs.list(
+          dir_path, cursor=cursor or None, page_size=page_size, load=True)
+    except ValueError:
+      self.error(400)
+      _MaybeLogException('Invalid parameter')
+      return
+    if is_paged:
+      result = {
+          'dirs': titan_dirs,
+          'cursor': titan_dirs.cursor.urlsafe() if titan_dirs.cursor else None,
+          'has_more': titan_dirs.has_more,
+      }
+      self.write_json_response(result)
+      return
     self.write_json_response(titan_dirs)
 
 class DirsProcessDataHandler(handlers.BaseHandler):
@@ -244,8 +286,16 @@ class DirsProcessDataHandler(handlers.BaseHandler):
   def get(self):
     """GET handler; must be GET because it is run from a cron job."""
     runtime = self.request.get('runtime', dirs.DEFAULT_CRON_RUNTIME_SECONDS)
-    dir_task_consumer = dirs.DirTaskConsumer()
-    results = dir_task_consumer.process_windows_with_backoff(runtime=int(runtime))
+    shard = self.request.get('shard')
+    try:
+      runtime = int(runtime)
+      dir_task_consumer = dirs.DirTaskConsumer(
+          shard=int(shard) if shard else None)
+    except ValueError:
+      self.error(400)
+      _MaybeLogException('Invalid parameter')
+      return
+    results = dir_task_consumer.process_windows_with_backoff(runtime=runtime)
     self.write_json_response(results)
 
 def _GetExtraParams(request_params):
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed, reference-counted storage of file blobs.
+
+Identical blob content is stored once across all paths, changesets and
+namespaces. Blobs are keyed by the md5 hash of their content and each file
+which points to a blob holds one reference to it. Copying a file, or
+committing a versioned file, only adds a reference instead of writing the
+content again. When the last reference is released, the blob is garbage
+collected by a background task after a grace period.
+
+Content small enough to be stored inline in the file entity is unaffected.
+
+Usage:
+  files.register_file_mixins([content_store.ContentStoreMixin])
+  files.File('/a/big.bin').write(big_content)
+  files.File('/b/big.bin').write(big_content)  # Only adds a reference.
+"""
+
+import datetime
+import hashlib
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from titan import files
+from titan.common import utils
+from titan.files.mixins import versions
+from titan.tasks import deferred
+
+# Seconds to wait before deleting content after its last reference is released.
+# This must be longer than any delay between a blob being handed out and a
+# reference to it being acquired, such as for pending microversion tasks.
+GC_GRACE_SECONDS = 24 * 60 * 60
+
+# All content lives in the default namespace so it is shared across namespaces.
+_CONTENT_NAMESPACE = ''
+
+class ContentStoreMixin(files.File):
+  """Mixin to store blobs in the content-addressed store."""
+
+  # Blobs are released by reference in delete(), not deleted by Files.delete().
+  _delete_blobs_with_file = False
+
+  def _maybe_write_to_blobstore(self, content, blob, force_blobstore=False):
+    if content and blob:
+      raise TypeError('Exactly one of "content" or "blob" must be given.')
+    if force_blobstore or content and len(content) > files.MAX_CONTENT_SIZE:
+      blob = put_content(content)
+      files._store_blob_cache(self.real_path, content)
+      content = None
+    return content, blob
+
+  @utils.compose_method_kwargs
+  def write(self, **kwargs):
+    """Write method. See superclass docstring."""
+    delete_old_blob = kwargs['_delete_old_blob']
+    kwargs['_delete_old_blob'] = False
+    batch = kwargs['_batch']
+
+    # Duplicate some method calls from files.File.write so that the resulting
+    # blob is known before the reference to it is acquired.
+    kwargs['content'], kwargs['encoding'] = self._maybe_encode_content(
+        kwargs['content'], kwargs['encoding'])
+    kwargs['content'], kwargs['blob'] = self._maybe_write_to_blobstore(
+        kwargs['content'], kwargs['blob'])
+
+    old_blob_key = files._get_blob_key(self._file) if self.exists else None
+    acquired = False
+    if kwargs['blob'] is not None and kwargs['blob'] != old_blob_key:
+      # Acquire before writing: a failed write leaks a reference instead of
+      # letting the content be collected while a file points to it.
+      kwargs['blob'] = acquire_blob(kwargs['blob'])
+      acquired = True
+
+    result = super(ContentStoreMixin, self).write(**kwargs)
+    new_blob_key = files._get_blob_key(self._file)
+
+    if self._is_versioned:
+      # The versions mixin may branch the blob from the base changeset's file
+      # without it being passed in, so make sure the new version holds a
+      # reference. Versioned files never release references.
+      if new_blob_key and not acquired:
+        acquire_blob(new_blob_key)
+      return result
+
+    if old_blob_key and (acquired or new_blob_key != old_blob_key):
+      release_args = (old_blob_key, self.real_path, delete_old_blob)
+      if batch is not None:
+        batch.add_hook_item(
+            'content_store:release', _release_blobs_for_batch, release_args)
+      else:
+        _release_blob(*release_args)
+    return result
+
+  @utils.compose_method_kwargs
+  def delete(self, **kwargs):
+    """Delete method. See superclass docstring."""
+    delete_old_blob = kwargs['_delete_old_blob']
+    kwargs['_delete_old_blob'] = False
+    old_blob_key = files._get_blob_key(self._file) if self.exists else None
+    result = super(ContentStoreMixin, self).delete(**kwargs)
+    if old_blob_key and not self._is_versioned:
+      _release_blob(old_blob_key, self.real_path, delete_old_blob)
+    return result
+
+  @property
+  def _is_versioned(self):
+    return isinstance(self, versions.FileVersioningMixin)
+
+class _TitanContent(ndb.Model):
+  """Model for one piece of stored content, keyed by its md5 hash.
+
+  Attributes:
+    blob: The BlobKey of the content.
+    refcount: The number of files which point to the blob.
+    owns_blob: Whether the blob was written by the store and may be deleted
+        by garbage collection. Blobs adopted from plain blob writes are
+        only deduplicated, never deleted.
+    modified: Last time the entity changed. Used for the collection grace
+        period.
+  """
+  blob = ndb.BlobKeyProperty(indexed=False)
+  refcount = ndb.IntegerProperty(default=0, indexed=False)
+  owns_blob = ndb.BooleanProperty(default=False, indexed=False)
+  modified = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def get_by_md5(cls, md5_hash):
+    return cls.get_by_id(md5_hash, namespace=_CONTENT_NAMESPACE)
+
+def put_content(content):
+  """Stores content, reusing an existing blob with the same content.
+
+  This does not acquire a reference; the returned blob is expected to be
+  written to a file shortly afterwards.
+
+  Args:
+    content: A byte-string.
+  Returns:
+    The BlobKey of the stored content.
+  """
+  md5_hash = hashlib.md5(content).hexdigest()
+  content_ent = _TitanContent.get_by_md5(md5_hash)
+  if content_ent:
+    return content_ent.blob
+
+  new_blob_key = utils.write_to_blobstore(content)
+
+  def _transaction():
+    content_ent = _TitanContent.get_by_md5(md5_hash)
+    if content_ent:
+      return content_ent.blob, False
+    content_ent = _TitanContent(
+        id=md5_hash, namespace=_CONTENT_NAMESPACE,
+        blob=new_blob_key, refcount=0, owns_blob=True)
+    content_ent.put()
+    return new_blob_key, True
+
+  blob_key, created = ndb.transaction(_transaction)
+  if created:
+    # Collect the content if it never ends up being referenced by a file.
+    _defer_collect_garbage(md5_hash)
+  else:
+    # Lost a race to another writer of the same content.
+    blobstore.delete(new_blob_key)
+  return blob_key
+
+def acquire_blob(blob_key):
+  """Adds a reference to a blob, adopting it into the store if needed.
+
+  Args:
+    blob_key: The BlobKey to reference.
+  Returns:
+    The BlobKey which should be stored. This may differ from the given blob if
+    the store already has a blob with the same content.
+  """
+  blob_info = blobstore.BlobInfo.get(blob_key)
+  if not blob_info:
+    return blob_key
+  md5_hash = blob_info.md5_hash
+
+  def _transaction():
+    content_ent = _TitanContent.get_by_md5(md5_hash)
+    if not content_ent:
+      content_ent = _TitanContent(
+          id=md5_hash, namespace=_CONTENT_NAMESPACE,
+          blob=blob_key, refcount=0, owns_blob=False)
+    content_ent.refcount += 1
+    content_ent.put()
+    return content_ent.blob
+
+  return ndb.transaction(_transaction)
+
+def collect_garbage(md5_hash, grace_seconds=GC_GRACE_SECONDS):
+  """Deletes content which has been unreferenced for the grace period.
+
+  Args:
+    md5_hash: The md5 hash of the content.
+    grace_seconds: The number of seconds the content must be unreferenced.
+  Returns:
+    True if the content was deleted, False otherwise.
+  """
+  cutoff = datetime.datetime.now() - datetime.timedelta(seconds=grace_seconds)
+
+  def _transaction():
+    content_ent = _TitanContent.get_by_md5(md5_hash)
+    if (not content_ent or content_ent.refcount > 0
+        or content_ent.modified > cutoff):
+      return None
+    content_ent.key.delete()
+    return content_ent
+
+  content_ent = ndb.transaction(_transaction)
+  if not content_ent:
+    return False
+  if content_ent.owns_blob:
+    blobstore.delete(content_ent.blob)
+  return True
+
+def _release_blob(blob_key, path, delete_unmanaged_blob):
+  """Releases a file's reference to a blob.
+
+  Args:
+    blob_key: The BlobKey which the file pointed to.
+    path: The real path of the file, used to clear the blob cache.
+    delete_unmanaged_blob: Whether to directly delete the blob if it is not
+        managed by the store, such as blobs written before the store existed.
+  """
+  files._clear_blob_cache_for_paths([path])
+  blob_info = blobstore.BlobInfo.get(blob_key)
+  if not blob_info:
+    return
+  md5_hash = blob_info.md5_hash
+
+  def _transaction():
+    content_ent = _TitanContent.get_by_md5(md5_hash)
+    if not content_ent or content_ent.blob != blob_key:
+      return None
+    content_ent.refcount = max(content_ent.refcount - 1, 0)
+    content_ent.put()
+    return content_ent.refcount
+
+  refcount = ndb.transaction(_transaction)
+  if refcount is None:
+    if delete_unmanaged_blob:
+      blobstore.delete(blob_key)
+  elif refcount == 0:
+    _defer_collect_garbage(md5_hash)
+
+def _release_blobs_for_batch(release_args_list):
+  """files._WriteBatch hook to release blobs replaced in the batch."""
+  for blob_key, path, delete_unmanaged_blob in release_args_list:
+    _release_blob(blob_key, path, delete_unmanaged_blob)
+
+def _defer_collect_garbage(md5_hash):
+  deferred.defer(collect_garbage, md5_hash, _countdown=GC_GRACE_SECONDS)
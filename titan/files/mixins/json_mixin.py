@@ -59,6 +59,10 @@ class JsonMixin(files.File):
       return False
     return kwargs['path'].endswith('.json')
 
+  @classmethod
+  def get_mixin_decision_key(cls, **kwargs):
+    return kwargs['path'].endswith('.json')
+
   @utils.compose_method_kwargs
   def __init__(self, **kwargs):
     self._json = UnsetValue
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-instance LRU cache of file entities and content, in front of memcache.
+
+Hot files, such as configuration files read on nearly every request, are
+served from instance memory instead of from ndb and the sharded blob cache.
+
+File entities are used without any RPC for TTL_SECONDS after they are cached.
+After that, the entity is reloaded, but cached blob content is kept as long as
+the file's md5 hash has not changed. Writes and deletes through this mixin
+invalidate the local entry; writes from other instances are only seen once
+the TTL has passed.
+
+Hit, miss and eviction counts are recorded with Titan Stats.
+
+Usage:
+  # The mixin must be registered last, so that other mixins (such as versions)
+  # can determine the real path before the local cache is consulted.
+  files.register_file_mixins([..., local_cache.LocalCacheMixin])
+"""
+
+import collections
+import threading
+import time
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from titan import files
+from titan import stats
+
+# The max number of bytes of entities and content cached per instance.
+MAX_BYTES = 32 * 1024 * 1024  # 32 MiB
+
+# Seconds to use a cached file entity before reloading it.
+TTL_SECONDS = 5
+
+class LocalCacheMixin(files.File):
+  """Mixin to serve file entities and content from an in-process cache."""
+
+  @property
+  def _file(self):
+    if self.is_loaded:
+      return super(LocalCacheMixin, self)._file
+    self._file_ent = _local_cache.get_file_ent(self.namespace, self.real_path)
+    if self._file_ent:
+      return super(LocalCacheMixin, self)._file
+    file_ent = super(LocalCacheMixin, self)._file
+    _local_cache.set_file_ent(file_ent)
+    return file_ent
+
+  @ndb.tasklet
+  def load_async(self):
+    if not self.is_loaded:
+      self._file_ent = _local_cache.get_file_ent(
+          self.namespace, self.real_path)
+      if not self._file_ent:
+        yield super(LocalCacheMixin, self).load_async()
+        if self._file_ent:
+          _local_cache.set_file_ent(self._file_ent)
+    raise ndb.Return(self)
+
+  @property
+  def content(self):
+    file_ent = self._file
+    if file_ent.content is not None or not file_ent.md5_hash:
+      # Inline content is already cached as part of the entity.
+      return super(LocalCacheMixin, self).content
+    content = _local_cache.get_content(
+        self.namespace, self.real_path, file_ent.md5_hash)
+    if content is None:
+      content = super(LocalCacheMixin, self).content
+      _local_cache.set_content(
+          self.namespace, self.real_path, file_ent.md5_hash, content,
+          size=file_ent.content_size)
+    return content
+
+  def write(self, *args, **kwargs):
+    batch = kwargs.get('_batch')
+    result = super(LocalCacheMixin, self).write(*args, **kwargs)
+    _local_cache.invalidate(self.namespace, self.real_path)
+    if batch is not None:
+      # Also invalidate after the batch is committed, in case the old entity
+      # was cached again in between.
+      batch.add_hook_item(
+          'local_cache:invalidate', _invalidate_for_batch,
+          (self.namespace, self.real_path))
+    return result
+
+  def delete(self, *args, **kwargs):
+    result = super(LocalCacheMixin, self).delete(*args, **kwargs)
+    _local_cache.invalidate(self.namespace, self.real_path)
+    return result
+
+class _LocalCache(object):
+  """A thread-safe LRU cache bounded by the total size of its values."""
+
+  def __init__(self, max_bytes=MAX_BYTES, ttl_seconds=TTL_SECONDS):
+    self.max_bytes = max_bytes
+    self.ttl_seconds = ttl_seconds
+    self.size = 0
+    self._lock = threading.Lock()
+    # Mapping of keys to three-tuples of (value, size, expiration time).
+    self._entries = collections.OrderedDict()
+
+  def get_file_ent(self, namespace, path):
+    """Returns a copy of a cached _TitanFile entity, or None."""
+    serialized_ent = self._get(('file', namespace, path))
+    if serialized_ent is None:
+      return None
+    entity_proto = entity_pb.EntityProto(serialized_ent)
+    return _model_adapter.pb_to_entity(entity_proto)
+
+  def set_file_ent(self, file_ent):
+    # Store the serialized entity, so that every File object gets its own copy
+    # and the exact size is known.
+    serialized_ent = _model_adapter.entity_to_pb(file_ent).Encode()
+    self._set(('file', file_ent.namespace or None, file_ent.path),
+              serialized_ent, size=len(serialized_ent),
+              expires=time.time() + self.ttl_seconds)
+
+  def get_content(self, namespace, path, md5_hash):
+    """Returns cached content of a file if its md5 hash matches, or None."""
+    cached = self._get(('content', namespace, path))
+    if cached is None or cached[0] != md5_hash:
+      return None
+    return cached[1]
+
+  def set_content(self, namespace, path, md5_hash, content, size):
+    self._set(('content', namespace, path), (md5_hash, content), size=size)
+
+  def invalidate(self, namespace, path):
+    with self._lock:
+      for key in (('file', namespace, path), ('content', namespace, path)):
+        if key in self._entries:
+          self.size -= self._entries.pop(key)[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def _get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None and entry[2] is not None and entry[2] < time.time():
+        self.size -= entry[1]
+        entry = None
+      if entry is not None:
+        # Move the entry to the most recently used end.
+        self._entries[key] = entry
+    _log_counter('files/local_cache/hits' if entry else
+                 'files/local_cache/misses')
+    return entry[0] if entry else None
+
+  def _set(self, key, value, size, expires=None):
+    num_evicted = 0
+    with self._lock:
+      if key in self._entries:
+        self.size -= self._entries.pop(key)[1]
+      if size > self.max_bytes:
+        return
+      while self.size + size > self.max_bytes:
+        _, evicted_entry = self._entries.popitem(last=False)
+        self.size -= evicted_entry[1]
+        num_evicted += 1
+      self._entries[key] = (value, size, expires)
+      self.size += size
+    if num_evicted:
+      _log_counter('files/local_cache/evictions', num_evicted)
+
+def reset(max_bytes=MAX_BYTES, ttl_seconds=TTL_SECONDS):
+  """Clears the cache of this instance and sets its limits.
+
+  Args:
+    max_bytes: The max number of bytes of entities and content to cache.
+    ttl_seconds: Seconds to use a cached file entity before reloading it.
+  """
+  global _local_cache
+  _local_cache = _LocalCache(max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+
+def _invalidate_for_batch(namespaces_and_paths):
+  """files._WriteBatch hook to invalidate written files."""
+  for namespace, path in namespaces_and_paths:
+    _local_cache.invalidate(namespace, path)
+
+def _log_counter(name, value=1):
+  counter = stats.Counter(name)
+  counter.offset(value)
+  stats.log_counters([counter], counters_func=make_all_counters)
+
+def make_all_counters():
+  """Make a new list of all counters which can be aggregated and saved."""
+  return [
+      stats.Counter('files/local_cache/hits'),
+      stats.Counter('files/local_cache/misses'),
+      stats.Counter('files/local_cache/evictions'),
+  ]
+
+_model_adapter = ndb.ModelAdapter()
+_local_cache = _LocalCache()
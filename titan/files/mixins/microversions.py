@@ -58,6 +58,11 @@ class MicroversioningMixin(files.File):
       mixin_state['is_microversions_enabled'] = True
     return True
 
+  @classmethod
+  def get_mixin_decision_key(cls, **kwargs):
+    # should_apply_mixin only depends on the presence of a changeset.
+    return 'changeset' in kwargs
+
   @utils.compose_method_kwargs
   def write(self, **kwargs):
     """Write method. See superclass docstring."""
@@ -75,6 +80,8 @@ class MicroversioningMixin(files.File):
         kwargs['content'], kwargs['blob'])
 
     kwargs['_delete_old_blob'] = False
+    # The batch is not picklable and is not needed by the microversion task.
+    batch = kwargs.pop('_batch')
     file_kwargs = self._original_kwargs.copy()
     file_kwargs.update({'path': self.path})
 
@@ -96,9 +103,13 @@ class MicroversioningMixin(files.File):
       kwargs['content'], kwargs['blob'] = self._maybe_write_to_blobstore(
           kwargs['content'], kwargs['blob'], force_blobstore=True)
       task = taskqueue.Task(method='PULL', payload=pickle.dumps(data))
-    task.add(queue_name=TASKQUEUE_NAME)
+    if batch is not None:
+      # Add all of the batch's tasks in a few RPCs after it is committed.
+      batch.add_hook_item('microversions:tasks', _add_tasks_for_batch, task)
+    else:
+      task.add(queue_name=TASKQUEUE_NAME)
 
-    return super(MicroversioningMixin, self).write(**kwargs)
+    return super(MicroversioningMixin, self).write(_batch=batch, **kwargs)
 
   @utils.compose_method_kwargs
   def delete(self, **kwargs):
@@ -121,6 +132,13 @@ class MicroversioningMixin(files.File):
 
     return super(MicroversioningMixin, self).delete(**kwargs)
 
+def _add_tasks_for_batch(tasks):
+  """files._WriteBatch hook to add microversion tasks in bulk."""
+  queue = taskqueue.Queue(TASKQUEUE_NAME)
+  for tasks_chunk in utils.chunk_generator(
+      tasks, chunk_size=taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks_chunk)
+
 def process_data(max_tasks=DEFAULT_MAX_TASKS, allow_transient_errors=False):
   """Process a batch of microversions tasks and commit them."""
   vcs = versions.VersionControlService()
@@ -17,6 +17,7 @@
 
 import random
 
+from google.appengine.ext import ndb
 from titan import files
 from titan import stats
 
@@ -61,7 +62,26 @@ class StatsRecorderMixin(files.File):
     finally:
       self._stop_stats_recording(unique_counter_name)
 
+  @ndb.tasklet
+  def load_async(self):
+    if self.is_loaded:
+      result = yield super(StatsRecorderMixin, self).load_async()
+      raise ndb.Return(result)
+    unique_counter_name = _UniqueCounterName('files/File/load')
+    self._start_stats_recording(unique_counter_name)
+    try:
+      result = yield super(StatsRecorderMixin, self).load_async()
+    finally:
+      self._stop_stats_recording(unique_counter_name)
+    raise ndb.Return(result)
+
   def write(self, *args, **kwargs):
+    batch = kwargs.get('_batch')
+    if batch is not None:
+      # Record one invocation per file, but log all counters once per batch.
+      batch.add_hook_item(
+          'stats_recorder:write', _log_write_counters_for_batch, self.path)
+      return super(StatsRecorderMixin, self).write(*args, **kwargs)
     unique_counter_name = _UniqueCounterName('files/File/write')
     self._start_stats_recording(unique_counter_name)
     try:
@@ -107,6 +127,12 @@ class _UniqueCounterName(object):
   def __hash__(self):
     return id(self) + self.random_offset
 
+def _log_write_counters_for_batch(paths):
+  """files._WriteBatch hook to log write counters for all written files."""
+  write_counter = stats.Counter('files/File/write')
+  write_counter.offset(len(paths))
+  stats.log_counters([write_counter], counters_func=make_all_counters)
+
 def make_all_counters():
   """Make a new list of all counters which can be aggregated and saved."""
   counters = [
@@ -19,11 +19,17 @@ Documentation:
   http://googlecloudplatform.github.io/titan/files/versions.html
 """
 
+import bisect
+import collections
 import hashlib
+import json
 import logging
 import os
 import re
+import threading
+import zlib
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from titan.common import strong_counters
@@ -48,8 +54,24 @@ VERSIONS_PATH_BASE_REGEX = re.compile('^/_titan/ver/([0-9]+)')
 # For formating "/_titan/ver/123/some/file/path"
 VERSIONS_PATH_FORMAT = '/_titan/ver/%d%s'
 
+# The max number of decoded manifest shards cached per instance.
+MANIFEST_CACHE_LOCAL_MAX_SHARDS = 200
+# The max number of file pointers at HEAD cached per instance.
+FILE_POINTER_CACHE_LOCAL_MAX_PATHS = 10000
+# The number of changeset numbers reserved at once by each instance for new
+# staging changesets. Unused reserved numbers are skipped.
+CHANGESET_NUM_BLOCK_SIZE = 20
+
 _CHANGESET_COUNTER_NAME = 'num_changesets'
 _MAX_MANIFEST_SHARD_PATHS = 1000
+_MANIFEST_MEMCACHE_PREFIX = 'titan-manifest:'
+_FILE_POINTER_MEMCACHE_PREFIX = 'titan-pointer:'
+_CHANGESET_SEQUENCER_ID = 'sequencer'
+# NOTE: This must never change, since pointers are found by their shard. A
+# commit may touch every shard, so this must also leave room for the other
+# entity groups of the commit within the limit of 25 entity groups in a
+# cross-group transaction.
+_NUM_FILE_POINTER_SHARDS = 16
 
 class Error(Exception):
   pass
@@ -101,6 +123,11 @@ class FileVersioningMixin(dirs.DirManagerMixin, files.File):
       mixin_state['is_versions_enabled'] = True
     return True
 
+  @classmethod
+  def get_mixin_decision_key(cls, **unused_kwargs):
+    # should_apply_mixin only depends on the shared mixin state.
+    return None
+
   @utils.compose_method_kwargs
   def __init__(self, path, **kwargs):
     # If given, this File represents the file at the given changeset.
@@ -155,9 +182,8 @@ class FileVersioningMixin(dirs.DirManagerMixin, files.File):
     if not self.changeset:
       # No associated changeset. Dynamically pick the file entity based on
       # the latest FilePointers.
-      root_file_pointer = _FilePointer.get_root_key(namespace=self.namespace)
-      file_pointer = _FilePointer.get_by_id(
-          self.path, parent=root_file_pointer, namespace=self.namespace)
+      file_pointer = _get_file_pointers_async(
+          [self.path], namespace=self.namespace).get_result()[self.path]
       if file_pointer:
         # Associate to the final changeset.
         self.changeset = Changeset(
@@ -177,6 +203,57 @@ class FileVersioningMixin(dirs.DirManagerMixin, files.File):
       raise files.BadFileError('File does not exist: %s' % self.path)
     return file_ent
 
+  @ndb.tasklet
+  def load_async(self):
+    """Asynchronously loads the file entity. See superclass docstring."""
+    if not self.changeset:
+      file_pointers = yield _get_file_pointers_async(
+          [self.path], namespace=self.namespace)
+      file_pointer = file_pointers[self.path]
+      if not file_pointer:
+        # The file does not exist, leave it unloaded.
+        raise ndb.Return(self)
+      self.changeset = Changeset(
+          file_pointer.changeset_num,
+          namespace=self.namespace).linked_changeset
+      self._composite_key_elements['changeset'] = str(self.changeset.num)
+    yield super(FileVersioningMixin, self).load_async()
+    raise ndb.Return(self)
+
+  @classmethod
+  @ndb.tasklet
+  def _resolve_real_paths_async(cls, titan_files):
+    """Determines the real paths of many files read through manifests.
+
+    The result is the same as of each file's real_path, but files at the same
+    changeset are resolved with one batch of RPCs instead of several RPCs per
+    file.
+
+    Args:
+      titan_files: A list of File objects of this class.
+    Returns:
+      An ndb.Future which is resolved once the real paths are determined.
+    """
+    files_by_changeset = collections.defaultdict(list)
+    head_files_by_namespace = collections.defaultdict(list)
+    for titan_file in titan_files:
+      if (titan_file._real_path is not None
+          or not titan_file._enable_manifested_views):
+        continue
+      changeset = titan_file.changeset
+      if changeset:
+        files_by_changeset[(changeset.namespace, changeset.num)].append(
+            titan_file)
+      else:
+        head_files_by_namespace[titan_file.namespace].append(titan_file)
+    futures = [_resolve_real_paths_at_changeset_async(changeset_files)
+               for changeset_files in files_by_changeset.itervalues()]
+    futures += [_resolve_real_paths_at_head_async(head_files)
+                for head_files in head_files_by_namespace.itervalues()]
+    yield futures
+    yield super(FileVersioningMixin, cls)._resolve_real_paths_async(
+        titan_files)
+
   @property
   def created_by(self):
     created_by = super(FileVersioningMixin, self).created_by
@@ -402,6 +479,33 @@ class FileVersioningMixin(dirs.DirManagerMixin, files.File):
     finally:
       self.__set_enable_manifested_views(True)
 
+  @ndb.tasklet
+  def write_async(self, **kwargs):
+    """Asynchronous write method. See superclass docstring."""
+    _require_file_has_changeset(self)
+    # Load the file from the changeset, like write() does.
+    self.__set_enable_manifested_views(False)
+    try:
+      result = yield super(FileVersioningMixin, self).write_async(**kwargs)
+    finally:
+      self.__set_enable_manifested_views(True)
+    raise ndb.Return(result)
+
+  def delete_async(self, **kwargs):
+    """Asynchronously mark the file for deletion upon commit.
+
+    Args:
+      **kwargs: Keyword arguments for delete_async.
+    Raises:
+      InvalidChangesetError: If a changeset was not associated to this file,
+          when the future is resolved.
+    Returns:
+      An ndb.Future whose result is this File.
+    """
+    # Blobs are never deleted when using versions.
+    kwargs.pop('_delete_old_blob', None)
+    return self.write_async(content='', _mark_version_for_delete=True)
+
 # ------------------------------------------------------------------------------
 
 class Changeset(object):
@@ -455,9 +559,8 @@ class Changeset(object):
   def changeset_ent(self):
     """Lazy-load the _Changeset entity."""
     if not self._changeset_ent:
-      root_changeset = _Changeset.get_root_key(namespace=self.namespace)
-      self._changeset_ent = _Changeset.get_by_id(
-          str(self._num), parent=root_changeset, namespace=self.namespace)
+      self._changeset_ent = _get_changeset_ents_async(
+          [self._num], namespace=self.namespace).get_result()[0]
       if not self._changeset_ent:
         raise ChangesetNotFoundError('Changeset %s does not exist.' % self._num)
     return self._changeset_ent
@@ -536,6 +639,13 @@ class Changeset(object):
   def _num_manifest_shards(self):
     return self.changeset_ent.num_manifest_shards
 
+  @property
+  def _manifest_shard_changeset_nums(self):
+    """The numbers of the changesets which wrote each manifest shard."""
+    # Manifests saved before shards were shared only point to their own shards.
+    return (self.changeset_ent.manifest_shard_changeset_nums
+            or [self.num] * self._num_manifest_shards)
+
   @property
   def exists(self):
     try:
@@ -543,25 +653,59 @@ class Changeset(object):
     except ChangesetError:
       return False
 
-  def _get_manifest_shard_ent(self, path):
-    """Get the shard entity which may contain the given path."""
-    shard_index = _get_manifest_shard_index(path, self._num_manifest_shards)
-    shard_id = _make_manifest_shard_id(self, shard_index)
-    parent = _ChangesetManifestShard.get_root_key(
-        final_changeset_num=self.num, namespace=self.namespace)
-    return _ChangesetManifestShard.get_by_id(id=shard_id, parent=parent)
+  def _get_manifest_shard_key(self, path):
+    """Get the key of the manifest shard which may contain the given path."""
+    start_paths = self.changeset_ent.manifest_shard_start_paths
+    if start_paths:
+      shard_index = bisect.bisect_right(start_paths, path) - 1
+      shard_name = start_paths[shard_index]
+    else:
+      # Manifest saved before shards were sorted by path.
+      shard_index = _get_manifest_shard_index(path, self._num_manifest_shards)
+      shard_name = shard_index
+    return _make_manifest_shard_key(
+        self._manifest_shard_changeset_nums[shard_index], shard_name,
+        namespace=self.namespace)
 
-  def get_file_from_manifest(self, path, **kwargs):
-    """Gets a file through the manifest.
+  def _get_manifest_shard_keys_for_dir(self, dir_path):
+    """Get the keys of the manifest shards which may contain files in a dir.
 
     Args:
-      path: The file path to look into the manifest.
-      **kwargs: Other keyword args to pass through to the File object.
+      dir_path: A directory path, with a trailing slash.
+    Returns:
+      A list of ndb.Key objects of the manifest shards whose range of paths
+      overlaps with the dir's subtree.
+    """
+    start_paths = self.changeset_ent.manifest_shard_start_paths
+    if not start_paths:
+      # Manifest saved before shards were sorted by path.
+      return _make_manifest_shard_keys(self)
+    # All paths in the subtree sort from the dir path up to the dir path with
+    # its trailing slash incremented to the next character.
+    end_path = dir_path[:-1] + chr(ord('/') + 1)
+    first_index = bisect.bisect_right(start_paths, dir_path) - 1
+    end_index = bisect.bisect_left(start_paths, end_path)
+    shard_changeset_nums = self._manifest_shard_changeset_nums
+    return [
+        _make_manifest_shard_key(
+            shard_changeset_nums[i], start_paths[i], namespace=self.namespace)
+        for i in range(first_index, end_index)]
+
+  def _get_manifest_shard(self, path):
+    """Get the paths_to_changeset_num of the shard which may contain path."""
+    return _get_manifest_shards([self._get_manifest_shard_key(path)])[0]
+
+  def _get_changeset_nums_from_manifest(self, paths):
+    """Looks up many paths in the manifest, reading each shard only once.
+
+    Args:
+      paths: An iterable of file paths to look up in the manifest.
     Raises:
       NoManifestError: If the status of the changeset is not 'submitted', or
           if a manifest was not saved at this changeset.
     Returns:
-      The file's associated Changeset, or None if the file doesn't exist.
+      A dictionary mapping the given paths which exist at this changeset to
+      the number of the last final changeset which changed them.
     """
     if self.status != ChangesetStatus.submitted:
       raise NoManifestError(
@@ -573,8 +717,32 @@ class Changeset(object):
           'Changeset {:d} was not committed with a manifest.'.format(
               self.num))
 
-    manifest_shard_ent = self._get_manifest_shard_ent(path=path)
-    paths_to_changeset_num = manifest_shard_ent.paths_to_changeset_num
+    paths_by_shard_key = collections.defaultdict(list)
+    for path in paths:
+      paths_by_shard_key[self._get_manifest_shard_key(path)].append(path)
+    shard_keys = paths_by_shard_key.keys()
+    manifest_shards = _get_manifest_shards(shard_keys)
+
+    paths_to_changeset_num = {}
+    for shard_key, manifest_shard in zip(shard_keys, manifest_shards):
+      for path in paths_by_shard_key[shard_key]:
+        if path in manifest_shard:
+          paths_to_changeset_num[path] = manifest_shard[path]
+    return paths_to_changeset_num
+
+  def get_file_from_manifest(self, path, **kwargs):
+    """Gets a file through the manifest.
+
+    Args:
+      path: The file path to look into the manifest.
+      **kwargs: Other keyword args to pass through to the File object.
+    Raises:
+      NoManifestError: If the status of the changeset is not 'submitted', or
+          if a manifest was not saved at this changeset.
+    Returns:
+      The file's associated Changeset, or None if the file doesn't exist.
+    """
+    paths_to_changeset_num = self._get_changeset_nums_from_manifest([path])
     if path not in paths_to_changeset_num:
       # We know deterministically that the given file did not exist
       # at this changeset.
@@ -854,8 +1022,12 @@ class Changeset(object):
 class _Changeset(ndb.Model):
   """Model representing a changeset.
 
-  All _Changeset entities are in the same entity group, as well as all
-  _FileVersion entities. An example entity group relationship might look like:
+  Each _Changeset entity is the root of its own entity group, so that creating
+  and updating changesets does not contend with other changesets. Commits are
+  ordered by the namespace's _ChangesetSequencer instead.
+
+  Changesets created before this were all in the same entity group, as well
+  as their _FileVersion entities, and are still read from there:
 
   _Changeset 0 (root ancestor, non-existent)
   |
@@ -879,6 +1051,12 @@ class _Changeset(ndb.Model):
     base_changeset: A reference to the current base for staging changesets.
     num_manifest_shards: The number of shards of the filesystem manifest. Only
         set for final changesets and only if the manifest was saved.
+    manifest_shard_changeset_nums: For each manifest shard, the number of the
+        changeset which wrote it. Shards without changed paths are shared
+        with the base changeset's manifest instead of being written again.
+    manifest_shard_start_paths: For each manifest shard, the first path of
+        its range of sorted paths. Empty for manifests saved before shards
+        were sorted by path, which are sharded by the hash of each path.
   """
   # NOTE: This model should be kept as lightweight as possible. Anything
   # else added here increases the amount of time that commit() will take,
@@ -894,6 +1072,9 @@ class _Changeset(ndb.Model):
   linked_changeset = ndb.KeyProperty(kind='_Changeset')
   base_changeset = ndb.KeyProperty(kind='_Changeset')
   num_manifest_shards = ndb.IntegerProperty()
+  manifest_shard_changeset_nums = ndb.IntegerProperty(
+      repeated=True, indexed=False)
+  manifest_shard_start_paths = ndb.StringProperty(repeated=True, indexed=False)
 
   def __repr__(self):
     return ('<_Changeset %d namespace:%r status:%s base_changeset:%r '
@@ -903,17 +1084,52 @@ class _Changeset(ndb.Model):
 
   @staticmethod
   def get_root_key(namespace):
-    """Get the root key, the parent of all changeset entities."""
-    # All changesets are in the same entity group by being children of the
+    """Get the root key, the parent of all legacy changeset entities."""
+    # Legacy changesets are in the same entity group by being children of the
     # arbitrary, non-existent "0" changeset.
     return ndb.Key(_Changeset, '0', namespace=namespace)
 
+  @staticmethod
+  def make_key(changeset_num, namespace):
+    # NDB can support integer keys, but this needs to be a string for
+    # support of legacy IDs created when using db.
+    return ndb.Key(_Changeset, str(changeset_num), namespace=namespace)
+
+class _ChangesetSequencer(ndb.Model):
+  """Model which orders the commits of a namespace.
+
+  There is one sequencer entity per namespace. It is only written by commits
+  and by reservations of blocks of changeset numbers, so it is the only
+  entity group which all commits of a namespace share.
+
+  Attributes:
+    key.id(): Always "sequencer".
+    next_num: The lowest changeset number which is not yet allocated.
+    head_num: The number of the last submitted changeset, or 0 if no changeset
+        has been submitted.
+  """
+  # Like strong counters, memcache is not used to guarantee strong consistency.
+  _use_cache = False
+  _use_memcache = False
+
+  next_num = ndb.IntegerProperty(required=True, indexed=False)
+  head_num = ndb.IntegerProperty(required=True, indexed=False)
+
+  @staticmethod
+  def make_key(namespace):
+    return ndb.Key(
+        _ChangesetSequencer, _CHANGESET_SEQUENCER_ID, namespace=namespace)
+
 class _ChangesetManifestShard(ndb.Model):
   """Model for one shard of a snapshot of a filesystem manifest at a changeset.
 
+  Shards are immutable once written, and may be part of the manifests of
+  later changesets which did not change any of the shard's paths.
+
   Attributes:
-    key.id(): The key for this model is "<changeset_num>:<shard_num>".
-        Example: "3:0" is the first shard for Changeset 3.
+    key.id(): The key for this model is "<changeset_num>:<start_path>".
+        Example: "3:/" is the first shard written by Changeset 3. Manifests
+        saved before shards were sorted by path use "<changeset_num>:<index>".
     paths_to_changeset_num: A manifest of filesystem paths to the last
         changeset that affected the path.
   """
@@ -930,6 +1146,156 @@ class _ChangesetManifestShard(ndb.Model):
     return ndb.Key(
         _ChangesetManifestShard, final_changeset_num, namespace=namespace)
 
+class _ManifestShardCache(object):
+  """Instance-local LRU and memcache cache of manifest shards.
+
+  Manifest shards never change after they are committed, so cached shards
+  never need to be invalidated. In memcache, shards are stored as compressed
+  JSON strings.
+  """
+
+  def __init__(self, max_local_shards=MANIFEST_CACHE_LOCAL_MAX_SHARDS):
+    self.max_local_shards = max_local_shards
+    self._lock = threading.Lock()
+    # Mapping of shard keys to paths_to_changeset_num dictionaries, ordered
+    # from least to most recently used.
+    self._local_shards = collections.OrderedDict()
+
+  def get_multi(self, shard_keys):
+    """Returns a dictionary of the given keys to cached shards."""
+    manifest_shards = {}
+    with self._lock:
+      for shard_key in shard_keys:
+        manifest_shard = self._local_shards.pop(shard_key, None)
+        if manifest_shard is not None:
+          # Move the shard to the most recently used end.
+          self._local_shards[shard_key] = manifest_shard
+          manifest_shards[shard_key] = manifest_shard
+    missing_keys = dict(
+        (shard_key.urlsafe(), shard_key) for shard_key in shard_keys
+        if shard_key not in manifest_shards)
+    if missing_keys:
+      serialized_shards = memcache.get_multi(
+          missing_keys.keys(), key_prefix=_MANIFEST_MEMCACHE_PREFIX)
+      memcache_shards = dict(
+          (missing_keys[key], json.loads(zlib.decompress(serialized_shard)))
+          for key, serialized_shard in serialized_shards.iteritems())
+      self._set_local(memcache_shards)
+      manifest_shards.update(memcache_shards)
+    return manifest_shards
+
+  def set_multi(self, manifest_shards):
+    """Caches a dictionary of shard keys to paths_to_changeset_num dicts."""
+    self._set_local(manifest_shards)
+    memcache.set_multi(
+        dict((shard_key.urlsafe(), zlib.compress(json.dumps(manifest_shard)))
+             for shard_key, manifest_shard in manifest_shards.iteritems()),
+        key_prefix=_MANIFEST_MEMCACHE_PREFIX)
+
+  def clear(self):
+    with self._lock:
+      self._local_shards.clear()
+
+  def _set_local(self, manifest_shards):
+    with self._lock:
+      for shard_key, manifest_shard in manifest_shards.iteritems():
+        self._local_shards.pop(shard_key, None)
+        self._local_shards[shard_key] = manifest_shard
+      while len(self._local_shards) > self.max_local_shards:
+        self._local_shards.popitem(last=False)
+
+class _FilePointerCache(object):
+  """Instance-local LRU and memcache cache of file pointers at HEAD.
+
+  Cached pointers are keyed by the number of the last submitted changeset,
+  which readers get from the namespace's _ChangesetSequencer. Pointers only
+  change on commit, so a commit invalidates all cached pointers of its
+  namespace without writing to the cache.
+  Each pointer is cached as a (changeset_num, final_changeset_num) tuple, or
+  as None if the file does not exist at HEAD.
+  """
+
+  def __init__(self, max_local_paths=FILE_POINTER_CACHE_LOCAL_MAX_PATHS):
+    self.max_local_paths = max_local_paths
+    self._lock = threading.Lock()
+    # Mapping of (namespace, head_num, path) tuples to pointers, ordered from
+    # least to most recently used.
+    self._local_pointers = collections.OrderedDict()
+
+  def get_multi(self, paths, head_num, namespace=None):
+    """Returns a dictionary of the given paths to cached pointers."""
+    pointers = {}
+    with self._lock:
+      for path in paths:
+        local_key = (namespace, head_num, path)
+        if local_key in self._local_pointers:
+          # Move the pointer to the most recently used end.
+          pointers[path] = self._local_pointers.pop(local_key)
+          self._local_pointers[local_key] = pointers[path]
+    missing_paths = [path for path in paths if path not in pointers]
+    if missing_paths:
+      memcache_pointers = memcache.get_multi(
+          missing_paths, key_prefix=self._make_key_prefix(head_num),
+          namespace=namespace)
+      # Non-existent files are stored in memcache as 0.
+      memcache_pointers = dict(
+          (path, tuple(pointer) if pointer else None)
+          for path, pointer in memcache_pointers.iteritems())
+      self._set_local(memcache_pointers, head_num, namespace=namespace)
+      pointers.update(memcache_pointers)
+    return pointers
+
+  def set_multi(self, pointers, head_num, namespace=None):
+    """Caches a dictionary of paths to pointers at the given HEAD."""
+    self._set_local(pointers, head_num, namespace=namespace)
+    memcache.set_multi(
+        dict((path, pointer or 0) for path, pointer in pointers.iteritems()),
+        key_prefix=self._make_key_prefix(head_num), namespace=namespace)
+
+  def clear(self):
+    with self._lock:
+      self._local_pointers.clear()
+
+  def _make_key_prefix(self, head_num):
+    return '%s%d:' % (_FILE_POINTER_MEMCACHE_PREFIX, head_num)
+
+  def _set_local(self, pointers, head_num, namespace=None):
+    with self._lock:
+      for path, pointer in pointers.iteritems():
+        local_key = (namespace, head_num, path)
+        self._local_pointers.pop(local_key, None)
+        self._local_pointers[local_key] = pointer
+      while len(self._local_pointers) > self.max_local_paths:
+        self._local_pointers.popitem(last=False)
+
+class _ChangesetNumAllocator(object):
+  """Instance-local blocks of changeset numbers for new staging changesets.
+
+  Numbers are reserved from the namespace's _ChangesetSequencer in blocks of
+  CHANGESET_NUM_BLOCK_SIZE, so most new staging changesets do not write to
+  the sequencer at all.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Mapping of namespaces to lists of reserved, unused changeset numbers.
+    self._reserved_nums = collections.defaultdict(list)
+
+  def allocate(self, namespace=None):
+    """Returns an unused changeset number, reserving a block if needed."""
+    with self._lock:
+      if self._reserved_nums[namespace]:
+        return self._reserved_nums[namespace].pop(0)
+    changeset_nums = _reserve_changeset_nums(
+        CHANGESET_NUM_BLOCK_SIZE, namespace=namespace)
+    with self._lock:
+      self._reserved_nums[namespace].extend(changeset_nums[1:])
+    return changeset_nums[0]
+
+  def clear(self):
+    with self._lock:
+      self._reserved_nums.clear()
+
 class FileVersion(object):
   """Metadata about a committed file version.
 
@@ -962,9 +1328,15 @@ class FileVersion(object):
     """Lazy-load the _FileVersion entity."""
     if not self._file_version_ent:
       file_version_id = _FileVersion.make_key_name(self._changeset, self._path)
+      changeset_key = self._changeset.changeset_ent.key
+      if changeset_key.parent():
+        # Legacy versions are children of their changeset.
+        parent = changeset_key
+      else:
+        parent = _FilePointer.get_shard_root_key(
+            self._path, namespace=self.namespace)
       self._file_version_ent = _FileVersion.get_by_id(
-          file_version_id, parent=self._changeset.changeset_ent.key,
-          namespace=self.namespace)
+          file_version_id, parent=parent, namespace=self.namespace)
       if not self._file_version_ent:
         raise FileVersionError('No file version of %s at %s.'
                                % (self._path, self._changeset.num))
@@ -1036,7 +1408,9 @@ class FileVersion(object):
 class _FileVersion(ndb.Model):
   """Model representing metadata about a committed file version.
 
-  A _FileVersion entity will only exist for committed file changes.
+  A _FileVersion entity will only exist for committed file changes. It is in
+  the same entity group as the _FilePointer of its path, or for versions
+  committed before pointers were sharded, a child of its final changeset.
 
   Attributes:
     key.id(): '<changeset num>:<path>', such as '123:/foo.html'.
@@ -1074,8 +1448,11 @@ class _FileVersion(ndb.Model):
 class _FilePointer(ndb.Model):
   """Pointer from a root file path to its current file version.
 
-  All _FilePointers are in the same entity group. As such, the entities
-  are updated atomically to point a set of files at new versions.
+  _FilePointers are sharded by the hash of their path into a fixed number of
+  entity groups, which are updated atomically by a commit to point a set of
+  files at new versions. Pointers committed before sharding are all in one
+  legacy entity group, and are moved to their shard when the file is next
+  committed.
 
   Attributes:
     key.id(): Root file path string. Example: '/foo.html'
@@ -1098,10 +1475,27 @@ class _FilePointer(ndb.Model):
 
   @staticmethod
   def get_root_key(namespace):
-    # The parent of all _FilePointers is a non-existent _FilePointer arbitrarily
-    # named '/', since no file path can be a single slash.
+    # The parent of all legacy _FilePointers is a non-existent _FilePointer
+    # arbitrarily named '/', since no file path can be a single slash.
     return ndb.Key(_FilePointer, '/', namespace=namespace)
 
+  @staticmethod
+  def get_shard_root_key(path, namespace):
+    """Get the root key of the entity group of a path's pointer."""
+    # Shard roots are non-existent _FilePointers named ':<index>', which are
+    # never absolute file paths.
+    path_hash_num = int(hashlib.md5(path.encode('utf-8')).hexdigest(), 16)
+    return ndb.Key(
+        _FilePointer, ':%d' % (path_hash_num % _NUM_FILE_POINTER_SHARDS),
+        namespace=namespace)
+
+  @staticmethod
+  def make_key(path, namespace):
+    return ndb.Key(
+        _FilePointer, path,
+        parent=_FilePointer.get_shard_root_key(path, namespace=namespace),
+        namespace=namespace)
+
 class VersionControlService(object):
   """A service object providing version control methods."""
 
@@ -1115,77 +1509,49 @@ class VersionControlService(object):
     Returns:
       A Changeset.
     """
-    return self._new_changeset(
-        status=ChangesetStatus.staging,
-        created_by=created_by, namespace=namespace)
-
-  def _new_changeset(self, status, created_by, namespace,
-                     nested_transaction=False):
-    """Create a changeset with the given status."""
     utils.validate_namespace(namespace)
-
-    def transaction():
-      """The changeset creation transaction."""
-      new_changeset_num = strong_counters.Increment(
-          _CHANGESET_COUNTER_NAME, namespace=namespace, nested_transaction=True)
-
-      base_changeset_key = None
-      # Set the base_changeset, but only for new staging changesets.
-      if status == ChangesetStatus.staging:
-        base_changeset = self.get_last_submitted_changeset(namespace=namespace)
-        if base_changeset:
-          base_changeset_key = base_changeset.changeset_ent.key
-
-      changeset_ent = _Changeset(
-          # NDB properties:
-          # NDB can support integer keys, but this needs to be a string for
-          # support of legacy IDs created when using db.
-          id=str(new_changeset_num),
-          parent=_Changeset.get_root_key(namespace=namespace),
-          namespace=namespace,
-          # Model properties:
-          num=new_changeset_num,
-          status=status,
-          base_changeset=base_changeset_key)
-      if created_by:
-        changeset_ent.created_by = created_by
-      else:
-        changeset_ent.created_by = users.get_current_user()
-      changeset_ent.put()
-      staging_changeset = Changeset(
-          num=new_changeset_num,
-          namespace=namespace,
-          # TODO(user): maybe pass _base_changeset_ent for optimization.
-          changeset_ent=changeset_ent)
-      return staging_changeset
-
-    if nested_transaction:
-      return transaction()
-    # xg-transaction between the StrongCounter and query over _Changeset when
-    # calling get_last_submitted_changeset().
-    return ndb.transaction(transaction, xg=True)
+    # Staging changesets take their number from a block reserved by this
+    # instance, instead of from the sequencer which orders commits.
+    changeset_num = _changeset_num_allocator.allocate(namespace=namespace)
+    base_changeset_key = None
+    base_changeset = self.get_last_submitted_changeset(namespace=namespace)
+    if base_changeset:
+      base_changeset_key = base_changeset.changeset_ent.key
+    return self._new_changeset(
+        changeset_num, status=ChangesetStatus.staging, created_by=created_by,
+        namespace=namespace, base_changeset_key=base_changeset_key)
+
+  def _new_changeset(self, changeset_num, status, created_by, namespace,
+                     base_changeset_key=None):
+    """Create a changeset with the given number and status."""
+    changeset_ent = _Changeset(
+        # NDB properties:
+        key=_Changeset.make_key(changeset_num, namespace=namespace),
+        # Model properties:
+        num=changeset_num,
+        status=status,
+        base_changeset=base_changeset_key)
+    if created_by:
+      changeset_ent.created_by = created_by
+    else:
+      changeset_ent.created_by = users.get_current_user()
+    changeset_ent.put()
+    return Changeset(
+        num=changeset_num, namespace=namespace, changeset_ent=changeset_ent)
 
   def get_last_submitted_changeset(self, namespace=None):
     """Returns a Changeset object of the last submitted changeset.
 
     Args:
       namespace: The datastore namespace, or None for the default namespace.
-    Raises:
-      ChangesetError: If no changesets currently exist.
     Returns:
-      A Changeset.
+      A Changeset, or None if no changeset has been submitted.
     """
-    changeset_root_key = _Changeset.get_root_key(namespace=namespace)
-    # Use an ancestor query to maintain strong consistency.
-    changeset_query = _Changeset.query(
-        ancestor=changeset_root_key, namespace=namespace)
-    changeset_query = changeset_query.filter(
-        _Changeset.status == ChangesetStatus.submitted)
-    changeset_query = changeset_query.order(-_Changeset.num)
-    latest_changeset = list(changeset_query.fetch(1))
-    if not latest_changeset:
+    # Get the sequencer by key to maintain strong consistency.
+    head_num = _get_changeset_sequencer(namespace=namespace).head_num
+    if not head_num:
       return None
-    return Changeset(num=latest_changeset[0].num, namespace=namespace)
+    return Changeset(num=head_num, namespace=namespace)
 
   def get_file_versions(self, path, namespace=None, limit=1000):
     """Get FileVersion objects of the revisions of this file path.
@@ -1197,18 +1563,28 @@ class VersionControlService(object):
     Returns:
       A list of FileVersion objects, ordered from latest to earliest.
     """
-    changeset_root_key = _Changeset.get_root_key(namespace=namespace)
-    file_version_ents = _FileVersion.query(
-        ancestor=changeset_root_key, namespace=namespace)
-    file_version_ents = file_version_ents.filter(_FileVersion.path == path)
+    # Use ancestor queries to maintain strong consistency. Versions are in the
+    # entity group of the path's pointer, or in the legacy changeset group.
+    futures = []
+    for ancestor_key in (
+        _FilePointer.get_shard_root_key(path, namespace=namespace),
+        _Changeset.get_root_key(namespace=namespace)):
+      file_version_query = _FileVersion.query(
+          ancestor=ancestor_key, namespace=namespace)
+      file_version_query = file_version_query.filter(_FileVersion.path == path)
+      file_version_query = file_version_query.order(-_FileVersion.created)
+      futures.append(file_version_query.fetch_async(limit=limit))
+    file_version_ents = []
+    for future in futures:
+      file_version_ents.extend(future.get_result())
 
     # Order in descending chronological order, which will also happen to
     # order by changeset_num.
-    file_version_ents = file_version_ents.order(-_FileVersion.created)
+    file_version_ents.sort(key=lambda ent: ent.created, reverse=True)
 
     # Encapsulate all the _FileVersion objects in public FileVersion objects.
     file_versions = []
-    for file_version_ent in file_version_ents.fetch(limit=limit):
+    for file_version_ent in file_version_ents[:limit]:
       file_version = FileVersion(
           path=file_version_ent.path,
           namespace=namespace,
@@ -1220,23 +1596,22 @@ class VersionControlService(object):
     return file_versions
 
   def _verify_staging_changeset_ready_for_commit(
-      self, namespace, staging_changeset, save_manifest):
+      self, staging_changeset, base_changeset, head_num, save_manifest):
     if not save_manifest:
       return
 
     # Fail-fast: save_manifest is True and base_changeset is not up to date.
-    last_changeset = self.get_last_submitted_changeset(namespace=namespace)
-    if staging_changeset.base_changeset != last_changeset:
+    if (base_changeset.num if base_changeset else 0) != head_num:
       raise InvalidBaseChangesetCommitError(
           'Changeset {:d} with base_changeset {} needs rebase to head before '
           'commit. Last committed changeset: {}.'.format(
               staging_changeset.num,
-              getattr(staging_changeset.base_changeset, 'num', None),
-              getattr(last_changeset, 'num', None)))
+              getattr(base_changeset, 'num', None),
+              head_num or None))
 
     # Fail-fast: save_manifest is True and no manifest exists on base_changeset.
-    if (staging_changeset.base_changeset  # May be None if first changeset.
-        and not staging_changeset.base_changeset.has_manifest):
+    if (base_changeset  # May be None if first changeset.
+        and not base_changeset.has_manifest):
       raise NoBaseManifestCommitError(
           'The base_changeset for changeset {:d} was not originally committed '
           'with a manifest, so the manifest shards cannot be copied.'.format(
@@ -1282,27 +1657,58 @@ class VersionControlService(object):
     # Fail if rebase is needed or the base manifest is missing and needed.
     # This is also in the _commit path below to guarantee strong consistency,
     # but is duplicated here as an optimization to fail outside the transaction.
+    # This also makes sure that the sequencer exists before the transaction,
+    # since a new sequencer is initialized from the legacy entity groups.
     namespace = staging_changeset.namespace
+    sequencer = _get_changeset_sequencer(namespace=namespace)
     self._verify_staging_changeset_ready_for_commit(
-        namespace, staging_changeset, save_manifest=save_manifest)
+        staging_changeset, staging_changeset.base_changeset,
+        sequencer.head_num, save_manifest=save_manifest)
 
     transaction_func = (
         lambda: self._commit(staging_changeset, staged_files, save_manifest))
-    final_changeset = ndb.transaction(transaction_func, xg=True)
-    return final_changeset
+    return ndb.transaction(transaction_func, xg=True)
 
   def _commit(self, staging_changeset, staged_files, save_manifest):
-    """Commit a staged changeset."""
-    # Fail if rebase is needed or the base manifest is missing and needed.
+    """Commit a staged changeset.
+
+    Every commit of a namespace writes its _ChangesetSequencer, so commits of
+    the same namespace conflict from when the sequencer is read until the
+    transaction commits. To keep that window short, the sequencer is read
+    after all other entities, and everything is written right after it.
+    """
     namespace = staging_changeset.namespace
     base_changeset = staging_changeset.base_changeset
-    self._verify_staging_changeset_ready_for_commit(
-        namespace, staging_changeset, save_manifest=save_manifest)
 
-    final_changeset = self._new_changeset(
-        status=ChangesetStatus.presubmit,
-        created_by=staging_changeset.created_by,
-        namespace=namespace, nested_transaction=True)
+    # Get a mapping of paths to current _FilePointers (or None), and the base
+    # manifest shards which have changed paths.
+    file_pointers_future = _get_file_pointers_async(
+        staged_files.keys(), namespace=namespace)
+    base_manifest = None
+    if save_manifest and base_changeset and base_changeset.has_manifest:
+      base_manifest = _get_base_manifest(base_changeset, staged_files.keys())
+    file_pointers = file_pointers_future.get_result()
+
+    # Take the final changeset's number from the sequencer, so that final
+    # changeset numbers increase in commit order. Fail if rebase is needed or
+    # the base manifest is missing and needed.
+    sequencer = _ChangesetSequencer.make_key(namespace).get()
+    self._verify_staging_changeset_ready_for_commit(
+        staging_changeset, base_changeset, sequencer.head_num,
+        save_manifest=save_manifest)
+    final_changeset_num = sequencer.next_num
+    sequencer.next_num += 1
+    sequencer.head_num = final_changeset_num
+    final_changeset_ent = _Changeset(
+        key=_Changeset.make_key(final_changeset_num, namespace=namespace),
+        num=final_changeset_num,
+        status=ChangesetStatus.submitted,
+        created_by=(staging_changeset.created_by
+                    or users.get_current_user()),
+        linked_changeset=staging_changeset.changeset_ent.key)
+    final_changeset = Changeset(
+        num=final_changeset_num, namespace=namespace,
+        changeset_ent=final_changeset_ent)
 
     changes = ['%s: %s' % (f.meta.status, f.path)
                for f in staged_files.values()]
@@ -1312,75 +1718,34 @@ class VersionControlService(object):
         staging_changeset.num, namespace, final_changeset.num,
         len(staged_files), '\n'.join(changes))
 
-    # Copy the manifest data from the base_changeset to the final_changeset.
-    # TODO(user): optimize this by pulling the data reading for small
-    # manifests out of the commit path.
+    # Make the manifest shards with changed paths. Unchanged shards are shared
+    # with the base_changeset's manifest.
     new_manifest_shards = []
     if save_manifest:
-      new_manifest = {}
-      # If this isn't the first-ever committed changeset, copy the old manifest.
-      if staging_changeset.base_changeset:
-        full_manifest = _fetch_full_manifest(base_changeset)
-        new_manifest.update(full_manifest)
-
+      manifest_changes = {}
       for staged_file in staged_files.itervalues():
         if staged_file.meta.status == FileStatus.deleted:
           # Remove from new manifest if it existed in previous manifests.
-          new_manifest.pop(staged_file.path, None)
+          manifest_changes[staged_file.path] = None
         else:
           # New file or edited file: point to the current final_changeset.
-          new_manifest[staged_file.path] = final_changeset.num
-
-      # Split up the new_manifest into shards by hashing each path and modding
-      # it into the right bucket. Hashing the paths provides a relatively even
-      # distribution over the available buckets, and also provides a
-      # deterministic O(1) way to know which manifest shard a path may exist in.
-      num_manifest_shards = len(new_manifest) / _MAX_MANIFEST_SHARD_PATHS + 1
-      manifest_buckets = [{}] * num_manifest_shards
-      while new_manifest:
-        path, changeset_num = new_manifest.popitem()
-        index = _get_manifest_shard_index(path, num_manifest_shards)
-        manifest_buckets[index][path] = changeset_num
-
-      # Create the new manifest entities.
-      parent = _ChangesetManifestShard.get_root_key(
-          final_changeset_num=final_changeset.num, namespace=namespace)
-      for i, manifest_bucket in enumerate(manifest_buckets):
-        shard_ent = _ChangesetManifestShard(
-            id=_make_manifest_shard_id(final_changeset, i),
-            paths_to_changeset_num=manifest_bucket, parent=parent)
-        new_manifest_shards.append(shard_ent)
-
-    # Update status of the staging and final changesets.
+          manifest_changes[staged_file.path] = final_changeset.num
+      new_manifest_shards, shard_start_paths, shard_changeset_nums = (
+          _make_manifest_shards(
+              final_changeset, base_manifest, manifest_changes))
+      final_changeset_ent.num_manifest_shards = len(shard_changeset_nums)
+      final_changeset_ent.manifest_shard_changeset_nums = shard_changeset_nums
+      final_changeset_ent.manifest_shard_start_paths = shard_start_paths
+
+    # Update status of the staging changeset.
     staging_changeset_ent = staging_changeset.changeset_ent
     staging_changeset_ent.status = ChangesetStatus.deleted_by_submit
-    staging_changeset_ent.linked_changeset = final_changeset.changeset_ent.key
-    final_changeset_ent = final_changeset.changeset_ent
-    final_changeset_ent.status = ChangesetStatus.submitted
-    final_changeset_ent.linked_changeset = staging_changeset.changeset_ent.key
-    if save_manifest:
-      final_changeset_ent.num_manifest_shards = num_manifest_shards
-    ndb.put_multi([
-        staging_changeset_ent,
-        final_changeset_ent,
-    ])
-
-    # Get a mapping of paths to current _FilePointers (or None).
-    file_pointers = {}
-    root_file_pointer = _FilePointer.get_root_key(namespace=namespace)
-    ordered_paths = staged_files.keys()
-    file_pointer_keys = []
-    for path in ordered_paths:
-      key = ndb.Key(
-          _FilePointer, path, parent=root_file_pointer, namespace=namespace)
-      file_pointer_keys.append(key)
-    file_pointer_ents = ndb.get_multi(file_pointer_keys)
-    for i, file_pointer_ent in enumerate(file_pointer_ents):
-      file_pointers[ordered_paths[i]] = file_pointer_ent
+    staging_changeset_ent.linked_changeset = final_changeset_ent.key
 
+    root_file_pointer = _FilePointer.get_root_key(namespace=namespace)
     new_file_versions = []
     updated_file_pointers = []
-    deleted_file_pointers = []
+    deleted_file_pointer_keys = []
     for path, titan_file in staged_files.iteritems():
       file_pointer = file_pointers[titan_file.path]
 
@@ -1394,7 +1759,8 @@ class VersionControlService(object):
           # NDB args:
           id=_FileVersion.make_key_name(final_changeset, titan_file.path),
           namespace=namespace,
-          parent=final_changeset.changeset_ent.key,
+          parent=_FilePointer.get_shard_root_key(
+              titan_file.path, namespace=namespace),
           # Model args:
           path=titan_file.path,
           changeset_num=final_changeset.num,
@@ -1405,35 +1771,32 @@ class VersionControlService(object):
           status=status)
       new_file_versions.append(new_file_version)
 
-      # Create or change the _FilePointer for this file.
-      if not file_pointer and status != FileStatus.deleted:
-        # New file, setup the pointer.
-        file_pointer = _FilePointer(id=titan_file.path,
-                                    parent=root_file_pointer,
-                                    changeset_num=staging_changeset.num,
-                                    namespace=namespace)
-      elif file_pointer:
-        # Important: the file pointer is pointed to the staged changeset number,
-        # since a file is not copied on commit from ver/1/file to ver/2/file.
-        file_pointer.changeset_num = staging_changeset.num
-
       # Files versions marked as "deleted" should delete the _FilePointer.
       if status == FileStatus.deleted:
         # Only delete file_pointer if it exists.
         if file_pointer:
-          deleted_file_pointers.append(file_pointer)
-      else:
-        updated_file_pointers.append(file_pointer)
-
-    # For all file changes and updated pointers, do the RPCs.
-    if new_file_versions:
-      ndb.put_multi(new_file_versions)
-    if updated_file_pointers:
-      ndb.put_multi(updated_file_pointers)
-    if deleted_file_pointers:
-      ndb.delete_multi([p.key for p in deleted_file_pointers])
-    if new_manifest_shards:
-      ndb.put_multi(new_manifest_shards)
+          deleted_file_pointer_keys.append(file_pointer.key)
+        continue
+
+      # Create or change the _FilePointer for this file, in its shard.
+      if file_pointer and file_pointer.key.parent() == root_file_pointer:
+        # Move the pointer out of the legacy entity group.
+        deleted_file_pointer_keys.append(file_pointer.key)
+      # Important: the file pointer is pointed to the staged changeset number,
+      # since a file is not copied on commit from ver/1/file to ver/2/file.
+      updated_file_pointers.append(_FilePointer(
+          key=_FilePointer.make_key(titan_file.path, namespace=namespace),
+          changeset_num=staging_changeset.num))
+
+    # Do all of the writes at once.
+    futures = [ndb.put_multi_async(
+        [sequencer, staging_changeset_ent, final_changeset_ent]
+        + new_file_versions + updated_file_pointers + new_manifest_shards)]
+    if deleted_file_pointer_keys:
+      futures.append(ndb.delete_multi_async(deleted_file_pointer_keys))
+    ndb.Future.wait_all(futures)
+    for future in futures:
+      future.check_success()
 
     logging.info('Submitted staging changeset %d as final changeset %d.',
                  staging_changeset.num, final_changeset.num)
@@ -1446,20 +1809,132 @@ def _get_manifest_shard_index(path, num_manifest_shards):
 
 def _make_manifest_shard_keys(changeset):
   """Gets a list of ndb.Key objects for all of a changeset's manifest shards."""
-  num_shards = changeset._num_manifest_shards
-  namespace = changeset.namespace
-  ids = [_make_manifest_shard_id(changeset, i) for i in range(num_shards)]
-  keys = []
+  shard_names = (changeset.changeset_ent.manifest_shard_start_paths
+                 or range(changeset._num_manifest_shards))
+  return [
+      _make_manifest_shard_key(
+          changeset_num, shard_name, namespace=changeset.namespace)
+      for changeset_num, shard_name
+      in zip(changeset._manifest_shard_changeset_nums, shard_names)]
+
+def _make_manifest_shard_key(changeset_num, shard_name, namespace):
+  """Gets the ndb.Key of a manifest shard written by the given changeset.
+
+  Args:
+    changeset_num: The number of the changeset which wrote the shard.
+    shard_name: The first path of the shard's range of paths, or the shard's
+        index for manifests saved before shards were sorted by path.
+    namespace: The datastore namespace.
+  Returns:
+    An ndb.Key.
+  """
   parent = _ChangesetManifestShard.get_root_key(
-      changeset.num, namespace=namespace)
-  for shard_id in ids:
-    shard_key = ndb.Key(
-        _ChangesetManifestShard, shard_id, namespace=namespace, parent=parent)
-    keys.append(shard_key)
-  return keys
-
-def _make_manifest_shard_id(changeset, shard_index):
-  return '{:d}:{:d}'.format(changeset.num, shard_index)
+      changeset_num, namespace=namespace)
+  shard_id = '{:d}:{}'.format(changeset_num, shard_name)
+  return ndb.Key(
+      _ChangesetManifestShard, shard_id, namespace=namespace, parent=parent)
+
+def _get_base_manifest(base_changeset, paths):
+  """Gets the parts of the base_changeset's manifest which may contain paths.
+
+  Only the base_changeset's shards which contain the given paths are read.
+  If the base manifest was saved before shards were sorted by path, the whole
+  manifest is read into a single range.
+
+  Args:
+    base_changeset: The base Changeset, which must have a manifest.
+    paths: An iterable of the paths which will be changed.
+  Raises:
+    CommitError: If some of the base_changeset's manifest shards are missing.
+  Returns:
+    A three-tuple of the list of the first path of each shard of the base
+    manifest, the list of the changeset numbers which wrote each shard, and a
+    dictionary mapping the indexes of the shards which contain the given paths
+    to a copy of their manifests.
+  """
+  namespace = base_changeset.namespace
+  if not base_changeset.changeset_ent.manifest_shard_start_paths:
+    return ['/'], [None], {0: _fetch_full_manifest(base_changeset)}
+  start_paths = list(base_changeset.changeset_ent.manifest_shard_start_paths)
+  shard_changeset_nums = list(base_changeset._manifest_shard_changeset_nums)
+  shard_indexes = sorted(set(
+      bisect.bisect_right(start_paths, path) - 1 for path in paths))
+  manifest_shards = _get_manifest_shards([
+      _make_manifest_shard_key(
+          shard_changeset_nums[i], start_paths[i], namespace=namespace)
+      for i in shard_indexes])
+  manifest_buckets = {}
+  for i, manifest_shard in zip(shard_indexes, manifest_shards):
+    manifest_buckets[i] = dict(manifest_shard)
+  return start_paths, shard_changeset_nums, manifest_buckets
+
+def _make_manifest_shards(final_changeset, base_manifest, manifest_changes):
+  """Makes the manifest shards which must be written for a new changeset.
+
+  Shards hold contiguous ranges of the sorted paths, and the manifest keeps
+  the first path of each shard. A path's shard is found by binary search, and
+  the files of a directory's subtree are only in the shards whose ranges
+  overlap with it.
+
+  Only the base_changeset's shards which contain changed paths are copied and
+  written again; the new manifest points to all other shards of the base.
+  Changed shards which grow too large are split, and changed shards which
+  become empty are merged into the previous shard. The whole manifest is only
+  split into new shards for the first-ever commit, or if the base manifest
+  was saved before shards were sorted by path.
+
+  Args:
+    final_changeset: The Changeset being committed.
+    base_manifest: The result of _get_base_manifest() for the changed paths,
+        or None for the first-ever commit.
+    manifest_changes: A dictionary mapping changed paths to the new changeset
+        number, or to None for deleted paths.
+  Returns:
+    A three-tuple of the list of _ChangesetManifestShard entities to put, the
+    list of the first path of each shard of the new manifest, and the list of
+    the changeset numbers which wrote each shard of the new manifest.
+  """
+  namespace = final_changeset.namespace
+  if base_manifest:
+    start_paths, shard_changeset_nums, manifest_buckets = base_manifest
+  else:
+    start_paths, shard_changeset_nums, manifest_buckets = ['/'], [None], {0: {}}
+
+  for path, changeset_num in manifest_changes.iteritems():
+    manifest_bucket = manifest_buckets[
+        bisect.bisect_right(start_paths, path) - 1]
+    if changeset_num is None:
+      manifest_bucket.pop(path, None)
+    else:
+      manifest_bucket[path] = changeset_num
+
+  # Replace each changed shard with new shards. Go from the last to the first
+  # shard, so that the indexes of shards which are not yet replaced are kept.
+  new_manifest_shards = []
+  for i in sorted(manifest_buckets, reverse=True):
+    manifest_bucket = manifest_buckets[i]
+    if not manifest_bucket and i:
+      # Empty range, which the previous shard's range now covers.
+      del start_paths[i]
+      del shard_changeset_nums[i]
+      continue
+    paths = sorted(manifest_bucket)
+    num_splits = len(paths) / _MAX_MANIFEST_SHARD_PATHS + 1
+    split_size = max(-(-len(paths) // num_splits), 1)
+    # The first new shard keeps the range's first path, so that the ranges
+    # of all shards still cover every possible path.
+    new_start_paths = [start_paths[i]] + paths[split_size::split_size]
+    start_paths[i:i + 1] = new_start_paths
+    shard_changeset_nums[i:i + 1] = [final_changeset.num] * len(new_start_paths)
+    for j, start_path in enumerate(new_start_paths):
+      shard_paths = paths[j * split_size:(j + 1) * split_size]
+      shard_ent = _ChangesetManifestShard(
+          key=_make_manifest_shard_key(
+              final_changeset.num, start_path, namespace=namespace),
+          paths_to_changeset_num=dict(
+              (path, manifest_bucket[path]) for path in shard_paths))
+      new_manifest_shards.append(shard_ent)
+  return new_manifest_shards, start_paths, shard_changeset_nums
 
 def _make_versioned_path(path, changeset):
   """Return a two-tuple of (versioned paths, is_multiple)."""
@@ -1469,25 +1944,313 @@ def _make_versioned_path(path, changeset):
     raise TypeError('path argument must be a string: %r' % path)
   return VERSIONS_PATH_FORMAT % (changeset.num, path)
 
+@ndb.tasklet
+def _resolve_real_paths_at_changeset_async(titan_files):
+  """Sets the real paths of versioned files read at the same changeset.
+
+  This follows the rules of FileVersioningMixin.real_path: files are first
+  looked up in the changeset itself, then in the manifest.
+
+  Args:
+    titan_files: A list of versioned File objects at the same changeset.
+  Raises:
+    NotImplementedError: For unknown changeset statuses.
+  Returns:
+    An ndb.Future which is resolved once the real paths are set.
+  """
+  changeset = titan_files[0].changeset
+  namespace = changeset.namespace
+  status = changeset.status
+  # The changeset whose files are read first, and the changeset whose
+  # manifest is read for all other files.
+  files_changeset = None
+  manifest_changeset = None
+  if status == ChangesetStatus.staging:
+    files_changeset = changeset
+    manifest_changeset = changeset.base_changeset
+  elif status == ChangesetStatus.submitted:
+    files_changeset = changeset.linked_changeset
+    manifest_changeset = changeset
+  elif status in (ChangesetStatus.deleted_by_submit, ChangesetStatus.deleted):
+    manifest_changeset = changeset.base_changeset
+  elif status != ChangesetStatus.presubmit:
+    raise NotImplementedError('Changeset status: "{}".'.format(status))
+
+  # Point to a non-existent changeset by default.
+  null_changeset = Changeset(0, namespace=namespace)
+  real_paths = dict(
+      (f.path, _make_versioned_path(f.path, null_changeset))
+      for f in titan_files)
+  manifest_paths = set(real_paths)
+
+  if files_changeset:
+    if files_changeset._finalized_files:
+      changeset_paths = files_changeset.associated_paths & manifest_paths
+    else:
+      # Like Changeset.__contains__, also count files marked for delete.
+      versioned_paths = [_make_versioned_path(path, files_changeset)
+                         for path in manifest_paths]
+      file_ents = yield files._get_titan_file_ents_async(
+          versioned_paths, namespace=namespace)
+      changeset_paths = set(VERSIONS_PATH_BASE_REGEX.sub('', versioned_path)
+                            for versioned_path in file_ents)
+    for path in changeset_paths:
+      real_paths[path] = _make_versioned_path(path, files_changeset)
+    manifest_paths -= changeset_paths
+
+  if manifest_changeset and manifest_paths:
+    paths_to_changeset_num = (
+        manifest_changeset._get_changeset_nums_from_manifest(manifest_paths))
+    # Files are stored under the staging changeset linked to the final one.
+    final_changeset_nums = list(set(paths_to_changeset_num.itervalues()))
+    final_changeset_ents = yield _get_changeset_ents_async(
+        final_changeset_nums, namespace=namespace)
+    linked_changesets = {}
+    for num, changeset_ent in zip(final_changeset_nums, final_changeset_ents):
+      final_changeset = Changeset(
+          num, namespace=namespace, changeset_ent=changeset_ent)
+      linked_changesets[num] = final_changeset.linked_changeset
+    for path, num in paths_to_changeset_num.iteritems():
+      real_paths[path] = _make_versioned_path(path, linked_changesets[num])
+
+  for titan_file in titan_files:
+    titan_file._real_path = real_paths[titan_file.path]
+
+@ndb.tasklet
+def _resolve_real_paths_at_head_async(titan_files):
+  """Sets the changesets and real paths of files read at HEAD.
+
+  Like FileVersioningMixin._file, each file is associated to the final
+  changeset of its _FilePointer, but all pointers are read with one batch
+  get and are cached until the next commit.
+
+  Args:
+    titan_files: A list of versioned File objects without a changeset, all in
+        the same namespace.
+  Returns:
+    An ndb.Future which is resolved once the real paths are set.
+  """
+  namespace = titan_files[0].namespace
+  # Get HEAD from the sequencer by key, which is strongly consistent, so that
+  # pointers cached at an older HEAD are never used after a commit.
+  sequencer = yield _ChangesetSequencer.make_key(namespace).get_async()
+  if not sequencer:
+    sequencer = _get_changeset_sequencer(namespace=namespace)
+  head_num = sequencer.head_num
+
+  paths = [f.path for f in titan_files]
+  pointers = _file_pointer_cache.get_multi(
+      paths, head_num, namespace=namespace)
+  missing_paths = [path for path in paths if path not in pointers]
+  if missing_paths:
+    file_pointers = yield _get_file_pointers_async(
+        missing_paths, namespace=namespace)
+    file_pointer_ents = [file_pointers[path] for path in missing_paths]
+    # Resolve each distinct changeset to its final changeset once.
+    changeset_nums = list(set(
+        ent.changeset_num for ent in file_pointer_ents if ent))
+    changeset_ents = yield _get_changeset_ents_async(
+        changeset_nums, namespace=namespace)
+    final_changeset_nums = {}
+    for num, changeset_ent in zip(changeset_nums, changeset_ents):
+      final_changeset_nums[num] = Changeset(
+          num, namespace=namespace,
+          changeset_ent=changeset_ent).linked_changeset_num
+    new_pointers = {}
+    for path, ent in zip(missing_paths, file_pointer_ents):
+      new_pointers[path] = None
+      if ent:
+        new_pointers[path] = (
+            ent.changeset_num, final_changeset_nums[ent.changeset_num])
+    _file_pointer_cache.set_multi(new_pointers, head_num, namespace=namespace)
+    pointers.update(new_pointers)
+
+  null_changeset = Changeset(0, namespace=namespace)
+  for titan_file in titan_files:
+    pointer = pointers[titan_file.path]
+    if pointer is None:
+      # The file does not exist at HEAD.
+      titan_file._real_path = _make_versioned_path(
+          titan_file.path, null_changeset)
+      continue
+    changeset_num, final_changeset_num = pointer
+    titan_file.changeset = Changeset(final_changeset_num, namespace=namespace)
+    titan_file._composite_key_elements['changeset'] = str(final_changeset_num)
+    # Files are stored under the pointer's content changeset.
+    titan_file._real_path = VERSIONS_PATH_FORMAT % (
+        changeset_num, titan_file.path)
+
+@ndb.tasklet
+def _get_changeset_ents_async(changeset_nums, namespace):
+  """Gets _Changeset entities by number, from either entity group layout.
+
+  Args:
+    changeset_nums: A list of changeset numbers.
+    namespace: The datastore namespace, or None for the default namespace.
+  Returns:
+    An ndb.Future which is resolved to a list of _Changeset entities, or None
+    for each changeset which does not exist, in the order of changeset_nums.
+  """
+  changeset_ents = yield ndb.get_multi_async(
+      [_Changeset.make_key(num, namespace=namespace) for num in changeset_nums])
+  # Only fall back to the legacy entity group for changesets not found.
+  legacy_indexes = [i for i, ent in enumerate(changeset_ents) if not ent]
+  if legacy_indexes:
+    root_changeset = _Changeset.get_root_key(namespace=namespace)
+    legacy_changeset_ents = yield ndb.get_multi_async([
+        ndb.Key(_Changeset, str(changeset_nums[i]), parent=root_changeset,
+                namespace=namespace)
+        for i in legacy_indexes])
+    for i, changeset_ent in zip(legacy_indexes, legacy_changeset_ents):
+      changeset_ents[i] = changeset_ent
+  raise ndb.Return(changeset_ents)
+
+@ndb.tasklet
+def _get_file_pointers_async(paths, namespace):
+  """Gets the _FilePointers of root paths, from either entity group layout.
+
+  Args:
+    paths: A list of root file paths.
+    namespace: The datastore namespace, or None for the default namespace.
+  Returns:
+    An ndb.Future which is resolved to a dictionary of the paths to their
+    _FilePointer entities, or None for files which do not exist.
+  """
+  root_file_pointer = _FilePointer.get_root_key(namespace=namespace)
+  file_pointer_keys = [
+      _FilePointer.make_key(path, namespace=namespace) for path in paths]
+  file_pointer_keys += [
+      ndb.Key(_FilePointer, path, parent=root_file_pointer,
+              namespace=namespace)
+      for path in paths]
+  file_pointer_ents = yield ndb.get_multi_async(file_pointer_keys)
+  # A commit moves a legacy pointer to its shard, so at most one exists.
+  file_pointers = {}
+  for i, path in enumerate(paths):
+    file_pointers[path] = (
+        file_pointer_ents[i] or file_pointer_ents[len(paths) + i])
+  raise ndb.Return(file_pointers)
+
+def _get_changeset_sequencer(namespace):
+  """Gets the _ChangesetSequencer of a namespace, creating it if needed."""
+  sequencer = _ChangesetSequencer.make_key(namespace).get()
+  if sequencer:
+    return sequencer
+  return _create_changeset_sequencer(namespace)
+
+@ndb.non_transactional
+def _create_changeset_sequencer(namespace):
+  """Creates the _ChangesetSequencer of a namespace.
+
+  The sequencer continues from the legacy changeset counter and the last
+  submitted changeset in the legacy changeset entity group, if any.
+
+  Args:
+    namespace: The datastore namespace, or None for the default namespace.
+  Returns:
+    The _ChangesetSequencer entity.
+  """
+
+  def transaction():
+    sequencer_key = _ChangesetSequencer.make_key(namespace)
+    sequencer = sequencer_key.get()
+    if sequencer:
+      # Created concurrently.
+      return sequencer
+    counter = strong_counters.StrongCounter.get_by_id(
+        _CHANGESET_COUNTER_NAME, namespace=namespace)
+    changeset_root_key = _Changeset.get_root_key(namespace=namespace)
+    changeset_query = _Changeset.query(
+        ancestor=changeset_root_key, namespace=namespace)
+    changeset_query = changeset_query.filter(
+        _Changeset.status == ChangesetStatus.submitted)
+    changeset_query = changeset_query.order(-_Changeset.num)
+    last_changeset_ent = changeset_query.get()
+    sequencer = _ChangesetSequencer(
+        key=sequencer_key,
+        next_num=(counter.count if counter else 0) + 1,
+        head_num=last_changeset_ent.num if last_changeset_ent else 0)
+    sequencer.put()
+    return sequencer
+
+  # xg-transaction between the sequencer, the legacy StrongCounter and the
+  # ancestor query over legacy _Changesets.
+  return ndb.transaction(transaction, xg=True)
+
+@ndb.non_transactional
+def _reserve_changeset_nums(count, namespace):
+  """Reserves a block of consecutive changeset numbers.
+
+  Args:
+    count: The number of changeset numbers to reserve.
+    namespace: The datastore namespace, or None for the default namespace.
+  Returns:
+    A list of the reserved changeset numbers.
+  """
+  _get_changeset_sequencer(namespace=namespace)
+
+  def transaction():
+    sequencer = _ChangesetSequencer.make_key(namespace).get()
+    first_num = sequencer.next_num
+    sequencer.next_num += count
+    sequencer.put()
+    return range(first_num, first_num + count)
+
+  return ndb.transaction(transaction)
+
+@ndb.non_transactional
+def _get_manifest_shards(manifest_shard_keys):
+  """Gets manifest shards through the cache, outside of any transaction.
+
+  Shards are immutable, but shared shards belong to the entity groups of many
+  changesets, so reading them in the commit transaction could exceed the limit
+  of entity groups in a cross-group transaction.
+
+  Args:
+    manifest_shard_keys: A list of ndb.Key objects of manifest shards.
+  Raises:
+    CommitError: If any of the manifest shards do not exist.
+  Returns:
+    A list of the shards' paths_to_changeset_num dictionaries, which are
+    shared with the cache and must not be modified.
+  """
+  manifest_shards = _manifest_cache.get_multi(manifest_shard_keys)
+  missing_keys = [key for key in manifest_shard_keys
+                  if key not in manifest_shards]
+  if missing_keys:
+    # Don't also store the large shard entities in ndb's memcache.
+    shard_ents = ndb.get_multi(missing_keys, use_memcache=False)
+    if not all(shard_ents):
+      raise CommitError(
+          'Expected complete manifest shards, but got: {!r}'.format(
+              shard_ents))
+    missing_shards = dict(
+        (shard_ent.key, shard_ent.paths_to_changeset_num)
+        for shard_ent in shard_ents)
+    _manifest_cache.set_multi(missing_shards)
+    manifest_shards.update(missing_shards)
+  return [manifest_shards[key] for key in manifest_shard_keys]
+
 def _fetch_full_manifest(base_changeset):
   full_manifest = {}
-  manifest_shard_keys = _make_manifest_shard_keys(base_changeset)
-  manifest_shards = ndb.get_multi(manifest_shard_keys)
-  if not all(manifest_shards):
-    raise CommitError(
-        'Expected complete manifest shards, but got: {!r}'.format(
-            manifest_shards))
+  manifest_shards = _get_manifest_shards(
+      _make_manifest_shard_keys(base_changeset))
   for manifest_shard in manifest_shards:
-    full_manifest.update(manifest_shard.paths_to_changeset_num)
+    full_manifest.update(manifest_shard)
   return full_manifest
 
 def _list_manifested_paths(changeset, dir_path, recursive=False):
-  paths_to_changeset_num = _fetch_full_manifest(changeset)
-
   # Add trailing slash.
   if dir_path != '/' and not dir_path.endswith('/'):
     dir_path += '/'
 
+  # Only read the manifest shards which may contain files in the dir.
+  paths_to_changeset_num = {}
+  manifest_shards = _get_manifest_shards(
+      changeset._get_manifest_shard_keys_for_dir(dir_path))
+  for manifest_shard in manifest_shards:
+    paths_to_changeset_num.update(manifest_shard)
+
   desired_start_depth = dir_path.count('/') - 1
   new_paths_to_changeset_num = {}
   # Limit paths by dir_path and recursive.
@@ -1528,3 +2291,7 @@ def _verify_versioned_paths(paths):
   for path in paths if is_multiple else [paths]:
     if not VERSIONS_PATH_BASE_REGEX.match(path):
       raise ValueError('Not a versioned file path: %s' % path)
+
+_manifest_cache = _ManifestShardCache()
+_file_pointer_cache = _FilePointerCache()
+_changeset_num_allocator = _ChangesetNumAllocator()